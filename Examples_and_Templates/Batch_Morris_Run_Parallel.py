@@ -24,17 +24,16 @@ import msx_toolkit as msx
 import pandas as pd
 import MSXPY_toolkit as mpy
 import multiprocessing as mp
-import pickle
 
 
 #Import the processes that will be use in the main process only
 if __name__=='__main__':
-    from SALib.sample import morris as morris_s
     import time
 
 #%% Select initial variables
 
-# pickle_file is the name of the pickle file with the saved simulation results
+# store_dir is the name of the directory with the saved simulation results, 
+#which can be read with mpy.RunResultStore
 
 # seed is the random seed for reproducability of the input parameter values
 
@@ -66,8 +65,8 @@ if __name__=='__main__':
 #Number of trajectories to run for the models
 traj=3
 
-#Set the name of the pickle file
-pickle_file=r'Examples_and_Templates\Pickle Files\beaker_morris.pkl'
+#Set the name of the directory the results are saved in
+store_dir=r'Examples_and_Templates\Run Stores\beaker_morris'
 
 #Set the seed so the morris trajectories are the same every time
 seed=4
@@ -93,26 +92,6 @@ msx_file= r'INP_and_MSX_Files\Beaker-NH2CL_JV_TOC.msx'
 days=3
 
 
-#%% Import and run hydraulic simulaiton
-
-#Close any files that were already open
-epa.ENclose()
-msx.MSXclose()
-
-#open the inp file
-epa.ENopen(inp_file,'report.rpt')
-
-#open msx file
-msx.MSXopen(msx_file)
-
-
-#Set the duration of the model evaluation
-epa.ENsettimeparam(0, days*24*3600)
-
-#Solve the hydraulics of the model
-msx.MSXsolveH()
-    
-
 #%% Set up the problem dictionary
 
 
@@ -130,9 +109,18 @@ node='1'
 #main process and not in any of the subprocesses
 if __name__=='__main__':
     
-    #Define constants_vary and species_vary as global variables because they are
-    #used in the parallel function but it is a bit messy to have them in the 
-    #function arguments
+    #Open the model in the main process to get the base values of the parameters.
+    #Each of the subprocesses opens its own copy of the model once when it starts
+    
+    #Close any files that were already open
+    epa.ENclose()
+    msx.MSXclose()
+    
+    #open the inp file
+    epa.ENopen(inp_file,'report.rpt')
+    
+    #open msx file
+    msx.MSXopen(msx_file)
     
     #Get the values of the constants
     cons=mpy.GetConstants(constants_vary)
@@ -180,15 +168,17 @@ if __name__=='__main__':
         'bounds': bounds
     }
 
-#%% Function to execute model evaluations
+#%% Function to set the parameters of each model evaluation
 
-#Define the function to be used in the parallel process
-def beaker_sa(param_row):
+#Define the function used by the subprocesses to set the parameter values of a 
+#model evaluation. The model is opened and its hydraulics solved once in each 
+#subprocess by mpy.RunParallel, which then runs MSXRunQual after this function
+def beaker_set(param_row):
     node='1'
     #Separate the values of the constants to the initial concentrations for ease of
     #manipulation later
     con_values=param_row[0:len(constants_vary)]
-    species_values=param_row[len(constants_vary):]
+    species_values=param_row[len(constants_vary):].copy()
     
 
     # #Convert from the S1 and S2 values to DOC1 and DOC2 Concentrations
@@ -208,11 +198,6 @@ def beaker_sa(param_row):
     #Set the constant values in the model
     mpy.SetConstants(constants_vary,con_values)
 
-    #run the model
-    my_results=mpy.MSXRunQual(links=[],by_species='no')       
-    
-    return my_results 
-
 
 #%% Run models using parallelization
 
@@ -221,15 +206,17 @@ def beaker_sa(param_row):
 if __name__=='__main__':
         
     
-    #Get a list of all files in directory before the model evaluations
-    files_before=os.listdir()
+    #Solve the hydraulics once and save them to a file which all of the subprocesses
+    #read, instead of each subprocess solving them. The file is kept in the 
+    #Hydraulics_Cache folder and reused the next time the script is run
+    hyd_file=mpy.GetHydraulicsFile(inp_file,days=days)
     
     #Create a variable of the names of variables used in sensitivty analysis
     var_names=problem['names']
     
     #Generate parameter values
     print('Running Morris with ' +str(traj)+ ' trajectories')
-    param_values=morris_s.sample(problem,N=1000,optimal_trajectories=traj,seed=seed)
+    param_values=mpy.MorrisSample(problem,N=1000,optimal_trajectories=traj,seed=seed)
     
     #Save the parameter values for later
     param_values_beaker=param_values
@@ -240,49 +227,32 @@ if __name__=='__main__':
     #Get the number of available cores
     cores=int(np.round(mp.cpu_count()*.85,0))
     
+    #Variables saved with the results
+    meta={}
+    meta['traj']=traj
+    meta['constants_vary']=constants_vary
+    meta['species_vary']=species_vary
+    
     print('Running Models')
     t1=time.time()
-    #Run the results using a map for parallelization
-    try:
-        mp.set_start_method('forkserver')
-    except:
-        a=1+1
-    pool=mp.Pool(processes=cores)
-    results=pool.map(beaker_sa,param_values)
-    pool.close()
-    pool.join()
+    #Run the results in parallel. Each subprocess opens the model and solves the
+    #hydraulics once, and then evaluates its share of the rows of param_values
+    #The results of each model are written to store_dir as soon as they finish
+    mpy.RunParallelToStore(beaker_set,param_values,store_dir,inp_file,msx_file,days=days,
+                           run_kwargs={'links':[]},problem=problem,hyd_file=hyd_file,
+                           processes=cores,meta=meta)
     t2=time.time()
     print(t2-t1)
-    #Run the results using a map for parallelization
-    #results=list(map(beaker_sa,param_values[0:2,:]))
+    mpy.HydraulicsCacheReport(n_workers=cores)
     
     
     
     #Close epanet and msx models
     epa.ENclose()
     msx.MSXclose()
-    #Get a list of all files in directory after model evaluations
-    files_after=os.listdir()
-    
-    #Get the files that were created during model runs
-    new_files=list(set(files_after).difference(files_before))
-    
-    #Remove binary files that were generated during model evaluations
-    for file in new_files:
-        os.remove(file)
-    
-    #assemble variables to be saved to pickle file into a dictionary
-    to_pickle={}
-    to_pickle['problem']=problem
-    to_pickle['results']=results
-    to_pickle['constants_vary']=constants_vary
-    to_pickle['species_vary']=species_vary
-    to_pickle['param_values']=param_values
-    
-    #Save Results as a pickle file
-    #Save the simulation results as a pickle
-    with open(pickle_file,'wb') as pfile:
-        pickle.dump(to_pickle,pfile)
+    #Remove the scratch files of this process; those of the subprocesses are
+    #removed when each of them exits
+    mpy.CleanScratch()
         
     print('Complete')
     
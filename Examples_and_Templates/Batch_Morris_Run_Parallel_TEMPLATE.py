@@ -29,13 +29,13 @@ import epanet_toolkit as epa
 import msx_toolkit as msx
 import pandas as pd
 import mf_msx_toolkit as mf
+import MSXPY_toolkit as mpy
 import multiprocessing as mp
 import pickle
 
 
 #Import the processes that will be use in the main process only
 if __name__=='__main__':
-    from SALib.sample import morris as morris_s
     import time
 
 
@@ -215,7 +215,7 @@ if __name__=='__main__':
     
     #Generate parameter values
     print('Running Morris with ' +str(traj)+ ' trajectories')
-    param_values=morris_s.sample(problem,N=1000,optimal_trajectories=traj,seed=seed)
+    param_values=mpy.MorrisSample(problem,N=1000,optimal_trajectories=traj,seed=seed)
     
     #Save the parameter values for later
     param_values_beaker=param_values
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Model evaluations of the batch (beaker) Method of Morris analysis with the batch
+reactor solver of batch_toolkit instead of EPANET MSX. The reactions of all of the
+samples are integrated at once as one system of ODEs, and the results are saved to a
+run store in the same format as Batch_Morris_Run_Parallel.py
+"""
+
+#%% Import Packages
+import os
+import sys
+import time
+
+main_folder = os.path.dirname(os.getcwd())
+
+sys.path.insert(0,main_folder+'\Function_Libraries')
+#Set working directory
+os.chdir(main_folder)
+
+import numpy as np
+import pandas as pd
+import batch_toolkit as bt
+import MSXPY_toolkit as mpy
+
+#%% Select initial variables
+
+#See Batch_Morris_Run_Parallel.py for a description of each variable
+
+traj=3
+
+store_dir=r'Examples_and_Templates\Run Stores\beaker_morris_reactor'
+
+seed=4
+
+constants_vary=['k1','k2','k3','k4','k6','k7','k8','k9','k10','k12','k13',
+                'k14','k11CO3','k11OCL','k11OH','kDOC1','kDOC2','AC1','AC2','AC3']
+
+species_vary=['DOC1','DOC2','TOTNH','TOTCO']
+
+bounds_range=pd.read_csv('bounds.csv',header=None,index_col=0)
+
+inp_file= r'INP_and_MSX_Files\beaker.inp'
+
+msx_file= r'INP_and_MSX_Files\Beaker-NH2CL_JV_TOC.msx'
+
+days=3
+
+#The node of the beaker, whose initial concentrations are used
+node='1'
+
+#Compare the base values of the parameters with EPANET MSX at the end
+validate=True
+
+#%% Set up the problem dictionary
+
+#The reactor is built from the msx file alone, and has the same base values of the
+#constants and initial concentrations as the msx model
+reactor=bt.BatchReactor(msx_file,node=node)
+
+cons=np.array([reactor.constants[reactor.constant_names.index(name)] for name in constants_vary])
+initial_con=np.array([reactor.initial[reactor.species_names.index(name)] for name in species_vary])
+
+TOC=1.5
+s1=.016
+s2=.57
+
+i_cons=np.append(cons,[TOC,s1,s2])
+i_cons=np.append(i_cons,initial_con[2:])
+
+var_names=constants_vary.copy()
+var_names.append('TOC')
+var_names.append('S1')
+var_names.append('S2')
+var_names=var_names + species_vary[2:]
+
+i_cons=i_cons.reshape((-1,1))
+
+high_cons=np.zeros((len(i_cons),1))
+low_cons=np.zeros((len(i_cons),1))
+
+for i in range(len(i_cons)):
+    high_cons[i]=(1+bounds_range.loc[var_names[i],1]/100)*i_cons[i]
+    low_cons[i]=(1-bounds_range.loc[var_names[i],1]/100)*i_cons[i]
+
+bounds=np.hstack((low_cons,high_cons))
+
+problem = {
+    'num_vars': len(var_names),
+    'names': var_names,
+    'bounds': bounds
+}
+
+#%% Values of the constants and initial concentrations of every sample
+
+def beaker_values(param_values):
+    #Same conversion as beaker_set in Batch_Morris_Run_Parallel.py, for all of the
+    #samples at once. Returns dictionaries of the values of each constant and
+    #initial concentration
+    con_values=param_values[:,0:len(constants_vary)]
+    species_values=param_values[:,len(constants_vary):].copy()
+
+    #Convert from the TOC, S1 and S2 values to DOC1 and DOC2 concentrations
+    species_values[:,1]=species_values[:,1]*species_values[:,0]/12000
+    species_values[:,2]=species_values[:,2]*species_values[:,0]/12000
+
+    constants={name:con_values[:,i] for i,name in enumerate(constants_vary)}
+    initial={name:species_values[:,i+1] for i,name in enumerate(species_vary)}
+    return constants,initial
+
+#%% Run models
+
+print('Running Morris with ' +str(traj)+ ' trajectories')
+param_values=mpy.MorrisSample(problem,N=1000,optimal_trajectories=traj,seed=seed)
+
+meta={}
+meta['traj']=traj
+meta['constants_vary']=constants_vary
+meta['species_vary']=species_vary
+meta['problem']=problem
+meta['param_values']=param_values
+
+constants,initial=beaker_values(param_values)
+
+#The results are reported at every msx timestep, like MSXRunQual
+times=bt.BatchReportTimes(reactor,days)
+
+print('Running Models')
+t1=time.time()
+bt.BatchRunToStore(reactor,times,store_dir,constants=constants,initial=initial,meta=meta)
+t2=time.time()
+print(t2-t1)
+
+#%% Compare with EPANET MSX
+
+#The batch reactor solves the equilibrium species exactly, while EPANET MSX stops
+#its Newton iterations at its tolerance, so small differences are expected
+if validate:
+    epa=mpy.epa
+    msx=mpy.msx
+    epa.ENopen(inp_file,'report.rpt')
+    msx.MSXopen(msx_file)
+    epa.ENsettimeparam(0,int(days*24*3600))
+    msx.MSXsolveH()
+
+    msx_results=mpy.MSXRunQual(by_species='no',nodes=[node],links=[])['node'][node]
+    reactor_results=reactor.run(times)[0]
+
+    for i,name in enumerate(reactor.species_names):
+        scale=np.maximum(np.abs(msx_results[name].values),reactor.atol[i])
+        print(name.ljust(10) + ' max relative difference ' +
+              str(np.max(np.abs(reactor_results[:,i]-msx_results[name].values)/scale)))
+
+    msx.MSXclose()
+    epa.ENclose()
+
+print('Complete')
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the per-step cost of extracting water quality results during a
+step-wise MSX simulation: one msx.MSXgetqual call per (element, species) cell
+versus one msx.MSXqualreader.read() call for all cells
+"""
+
+#%% Import Packages
+import os
+import sys
+import time
+
+main_folder = os.path.dirname(os.getcwd())
+
+sys.path.insert(0,main_folder+'\Function_Libraries')
+#Set working directory
+os.chdir(main_folder)
+
+import numpy as np
+import epanet_toolkit as epa
+import msx_toolkit as msx
+
+#%% Select initial variables
+
+inp_file=r'INP_and_MSX_Files/Net1.inp'
+
+msx_file=r'INP_and_MSX_Files/Net1-NH2CL_JV_TOC.msx'
+
+#Number of days to run the model
+days=1
+
+#Number of quality steps to time each method over
+n_steps=100
+
+#%% Open the model and solve the hydraulics
+
+epa.ENopen(inp_file,'report.rpt')
+msx.MSXopen(msx_file)
+epa.ENsettimeparam(0, int(days*24*3600))
+msx.MSXsolveH()
+
+node_ind=np.arange(1,epa.ENgetcount(0)+1)
+link_ind=np.arange(1,epa.ENgetcount(2)+1)
+species_ind=np.arange(1,msx.MSXgetcount(3)+1)
+
+#%% Per-cell extraction (previous MSXRunQual implementation)
+
+msx.MSXinit(0)
+t_cell=0
+for k in range(n_steps):
+    msx.MSXstep()
+    t1=time.perf_counter()
+    for j in range(len(node_ind)):
+        for i in range(len(species_ind)):
+            msx.MSXgetqual(0,int(node_ind[j]),int(species_ind[i]))
+    for j in range(len(link_ind)):
+        for i in range(len(species_ind)):
+            msx.MSXgetqual(1,int(link_ind[j]),int(species_ind[i]))
+    t_cell+=time.perf_counter()-t1
+
+#%% Bulk extraction
+
+node_reader=msx.MSXqualreader(0,node_ind,species_ind)
+link_reader=msx.MSXqualreader(1,link_ind,species_ind)
+
+msx.MSXinit(0)
+t_bulk=0
+for k in range(n_steps):
+    msx.MSXstep()
+    t1=time.perf_counter()
+    node_reader.read()
+    link_reader.read()
+    t_bulk+=time.perf_counter()-t1
+
+cells=(len(node_ind)+len(link_ind))*len(species_ind)
+print('Cells per step: '+str(cells))
+print('Per-cell MSXgetqual: '+str(t_cell/n_steps*1e6)+' us per step')
+print('MSXqualreader:       '+str(t_bulk/n_steps*1e6)+' us per step')
+print('Speedup: '+str(t_cell/t_bulk))
+
+epa.ENclose()
+msx.MSXclose()
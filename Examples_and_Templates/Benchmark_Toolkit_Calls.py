@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the cost of single toolkit calls: calls per second of the hottest
+getters and setters of epanet_toolkit and msx_toolkit, which call function pointers
+prototyped with argtypes/restype (see _prototypes in each module) with python ints
+and floats and prebuilt references to shared out values, versus
+- the previous wrappers, which built ctypes objects for every argument and every out
+  value on each call, through unprototyped function pointers
+- the same wrappers as now without the prototypes, which wrap each float in a ctypes
+  object but let ctypes pass the ints and references as they are
+"""
+
+#%% Import Packages
+import os
+import sys
+import time
+import ctypes
+
+main_folder = os.path.dirname(os.getcwd())
+
+sys.path.insert(0,main_folder+'\Function_Libraries')
+#Set working directory
+os.chdir(main_folder)
+
+import epanet_toolkit as epa
+import msx_toolkit as msx
+
+#%% Select initial variables
+
+inp_file=r'INP_and_MSX_Files/Net1.inp'
+
+msx_file=r'INP_and_MSX_Files/Net1-NH2CL_JV_TOC.msx'
+
+#Number of calls to time each function over
+n_calls=100000
+
+#%% Previous wrappers
+
+#lib[name] returns a new function pointer, without the argtypes and restype which
+#load_library() set on the one the toolkit modules call
+def unprototyped(lib, name):
+    return lib[name]
+
+epa_lib=epa.load_library()
+msx_lib=msx.load_library()
+
+_ENgetnodevalue=unprototyped(epa_lib,'ENgetnodevalue')
+_ENsetnodevalue=unprototyped(epa_lib,'ENsetnodevalue')
+_MSXgetqual=unprototyped(msx_lib,'MSXgetqual')
+_MSXgetconstant=unprototyped(msx_lib,'MSXgetconstant')
+_MSXsetconstant=unprototyped(msx_lib,'MSXsetconstant')
+_MSXsetinitqual=unprototyped(msx_lib,'MSXsetinitqual')
+
+def old_ENgetnodevalue(index, paramcode):
+    j= ctypes.c_float()
+    ierr= _ENgetnodevalue(index, paramcode, ctypes.byref(j))
+    if ierr!=0: raise epa.ENtoolkitError(ierr)
+    return j.value
+
+def old_ENsetnodevalue(index, paramcode, value):
+    ierr= _ENsetnodevalue(ctypes.c_int(index), ctypes.c_int(paramcode), ctypes.c_float(value))
+    if ierr!=0: raise epa.ENtoolkitError(ierr)
+
+def old_MSXgetqual(type,ind,spe):
+    qual = ctypes.c_double()
+    ierr= _MSXgetqual(ctypes.c_int(type),ctypes.c_int(ind),ctypes.c_int(spe),ctypes.byref(qual))
+    if ierr!=0: raise msx.MSXtoolkitError(ierr)
+    return qual.value
+
+def old_MSXgetconstant(ind):
+    const = ctypes.c_double()
+    ierr= _MSXgetconstant(ind,ctypes.byref(const))
+    if ierr!=0: raise msx.MSXtoolkitError(ierr)
+    return const.value
+
+def old_MSXsetconstant(ind,value):
+    ierr= _MSXsetconstant(ctypes.c_int(ind),ctypes.c_double(value))
+    if ierr!=0: raise msx.MSXtoolkitError(ierr)
+
+def old_MSXsetinitqual(type,ind,spe,value):
+    ierr= _MSXsetinitqual(ctypes.c_int(type),ctypes.c_int(ind),ctypes.c_int(spe),ctypes.c_double(value))
+    if ierr!=0: raise msx.MSXtoolkitError(ierr)
+
+#%% Current wrappers without the prototypes
+
+def unproto_ENgetnodevalue(index, paramcode):
+    ierr= _ENgetnodevalue(index, paramcode, epa._float_ref)
+    if ierr!=0: raise epa.ENtoolkitError(ierr)
+    return epa._float_out.value
+
+def unproto_ENsetnodevalue(index, paramcode, value):
+    ierr= _ENsetnodevalue(int(index), int(paramcode), ctypes.c_float(value))
+    if ierr!=0: raise epa.ENtoolkitError(ierr)
+
+def unproto_MSXgetqual(type,ind,spe):
+    ierr= _MSXgetqual(msx._location_type(type),int(ind),int(spe),msx._double_ref)
+    if ierr!=0: raise msx.MSXtoolkitError(ierr)
+    return msx._double_out.value
+
+def unproto_MSXgetconstant(ind):
+    ierr= _MSXgetconstant(ind,msx._double_ref)
+    if ierr!=0: raise msx.MSXtoolkitError(ierr)
+    return msx._double_out.value
+
+def unproto_MSXsetconstant(ind,value):
+    ierr= _MSXsetconstant(int(ind),ctypes.c_double(value))
+    if ierr!=0: raise msx.MSXtoolkitError(ierr)
+
+def unproto_MSXsetinitqual(type,ind,spe,value):
+    ierr= _MSXsetinitqual(msx._location_type(type),int(ind),int(spe),ctypes.c_double(value))
+    if ierr!=0: raise msx.MSXtoolkitError(ierr)
+
+#%% Open the model
+
+epa.ENopen(inp_file,'report.rpt')
+msx.MSXopen(msx_file)
+msx.MSXsolveH()
+msx.MSXinit(0)
+msx.MSXstep()
+
+def calls_per_second(func, *args):
+    t1=time.perf_counter()
+    for k in range(n_calls):
+        func(*args)
+    return n_calls/(time.perf_counter()-t1)
+
+benchmarks=[('ENgetnodevalue', old_ENgetnodevalue, unproto_ENgetnodevalue, epa.ENgetnodevalue, (1,0)),
+            ('ENsetnodevalue', old_ENsetnodevalue, unproto_ENsetnodevalue, epa.ENsetnodevalue, (1,0,710.)),
+            ('MSXgetqual',     old_MSXgetqual,     unproto_MSXgetqual,     msx.MSXgetqual,     (0,1,1)),
+            ('MSXgetconstant', old_MSXgetconstant, unproto_MSXgetconstant, msx.MSXgetconstant, (1,)),
+            ('MSXsetconstant', old_MSXsetconstant, unproto_MSXsetconstant, msx.MSXsetconstant, (1,msx.MSXgetconstant(1))),
+            ('MSXsetinitqual', old_MSXsetinitqual, unproto_MSXsetinitqual, msx.MSXsetinitqual, (0,1,1,msx.MSXgetinitqual(0,1,1)))]
+
+#%% Time the calls
+
+print('Calls per second:'.ljust(20)+'previous'.rjust(12)+'unprototyped'.rjust(14)+'current'.rjust(12)+'speedup'.rjust(10))
+for name, old, unproto, new, args in benchmarks:
+    old_rate=calls_per_second(old,*args)
+    unproto_rate=calls_per_second(unproto,*args)
+    new_rate=calls_per_second(new,*args)
+    print(name.ljust(20)+str(int(old_rate)).rjust(12)+str(int(unproto_rate)).rjust(14)+str(int(new_rate)).rjust(12)+('%.2f' % (new_rate/old_rate)).rjust(10))
+
+epa.ENclose()
+msx.MSXclose()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Check that the results of a sample of batch_toolkit.BatchReactor do not depend on
+the other samples it is integrated with: the base sample of the beaker model is run
+alone and stacked with other samples, and each result is compared with a reference
+run alone with tolerances 10000 times tighter. A stacked sample must be at least as
+accurate as the same sample alone, since the tolerances of a stacked system are
+scaled so that every sample meets its own
+"""
+
+#%% Import Packages
+import os
+import sys
+
+main_folder = os.path.dirname(os.getcwd())
+
+sys.path.insert(0,main_folder+'\Function_Libraries')
+#Set working directory
+os.chdir(main_folder)
+
+import numpy as np
+import batch_toolkit as bt
+
+#%% Select initial variables
+
+msx_file=r'INP_and_MSX_Files/Beaker-NH2CL_JV_TOC.msx'
+
+days=3
+
+#Constants which differ between the samples, by up to 50% of their base values
+constants_vary=['k1','k2','k3','k4','kDOC1','kDOC2']
+
+#Numbers of samples the base sample is stacked with
+stack_sizes=[3,30,200]
+
+#%% Run the base sample alone, stacked and with tight tolerances
+
+reactor=bt.BatchReactor(msx_file,node='1')
+times=bt.BatchReportTimes(reactor,days)
+base={name:np.array([reactor.constants[reactor.constant_names.index(name)]]) for name in constants_vary}
+
+alone=reactor.run(times,constants=base)[0]
+
+rtol=reactor.rtol
+atol=reactor.atol.copy()
+reactor.rtol=rtol*1e-4
+reactor.atol=atol*1e-4
+reference=reactor.run(times,constants=base)[0]
+reactor.rtol=rtol
+reactor.atol=atol
+
+#Errors in units of the tolerances of the model
+scale=rtol*np.abs(reference)+atol
+error_alone=np.max(np.abs(alone-reference)/scale)
+
+rng=np.random.default_rng(0)
+print('Sample'.ljust(20)+'error / tolerance'.rjust(20)+'difference from alone / tolerance'.rjust(36))
+print('alone'.ljust(20)+('%.2f' % error_alone).rjust(20))
+for n in stack_sizes:
+    constants={name:np.append(value,value*rng.uniform(0.5,1.5,n-1)) for name,value in base.items()}
+    stacked=reactor.run(times,constants=constants)[0]
+    error=np.max(np.abs(stacked-reference)/scale)
+    difference=np.max(np.abs(stacked-alone)/scale)
+    print(('stacked with '+str(n-1)).ljust(20)+('%.2f' % error).rjust(20)+('%.2f' % difference).rjust(36))
+    if error>error_alone:
+        raise Exception('The base sample stacked with ' + str(n-1) + ' others is less accurate than alone')
+    if difference>2*error_alone:
+        raise Exception('The base sample stacked with ' + str(n-1) + ' others differs from the sample alone by more than their errors')
+
+print('Complete')
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of msx_compiler on the beaker model:
+- evaluate gives the same rates, equilibrium residuals and formulas as the
+  expressions of the msx file translated token by token into python, as the batch
+  reactor evaluated them before msx_compiler
+- jacobian matches central finite differences of evaluate
+- circular references between [TERMS] are reported
+- LoadMSXModel returns the cached model for the same file contents, and a new one
+  when the contents change
+"""
+
+#%% Import Packages
+import os
+import re
+import sys
+import tempfile
+
+main_folder = os.path.dirname(os.getcwd())
+
+sys.path.insert(0,main_folder+'\Function_Libraries')
+#Set working directory
+os.chdir(main_folder)
+
+import numpy as np
+import msx_compiler as mc
+import batch_toolkit as bt
+
+#%% Select initial variables
+
+msx_file=r'INP_and_MSX_Files/Beaker-NH2CL_JV_TOC.msx'
+
+#States the functions are checked at: the beaker at every report time of 3 days
+days=3
+
+#Relative step of the finite differences, and the largest allowed error of the
+#jacobian relative to the largest change of each output over all of the states
+fd_step=1e-6
+jac_tol=1e-5
+
+#%% States of the beaker
+
+reactor=bt.BatchReactor(msx_file,node='1')
+model=mc.LoadMSXModel(msx_file)
+reactions=reactor.reactions
+times=bt.BatchReportTimes(reactor,days)
+c=reactor.run(times)[0].T.copy()
+n=c.shape[1]
+k=np.tile(reactor.constants[:,np.newaxis],(1,n))
+p=np.tile(reactor.parameters[:,np.newaxis],(1,n))
+h=reactor.hydraulics
+n_r=len(reactions.rate_ind)
+n_e=len(reactions.equil_ind)
+
+def outputs(c):
+    #The rates and equilibrium residuals, and the states with the formula species
+    c=c.copy()
+    dy=np.empty((n_r,n))
+    res=np.empty((n_e,n))
+    reactions.evaluate(c,k,p,h,dy,res)
+    return np.vstack((dy,res)),c
+
+#%% evaluate against the expressions of the msx file
+
+_token=re.compile(r'\s*(?:(\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?)|([A-Za-z_]\w*)|(\S))')
+_functions={'ABS':np.abs,'SQRT':np.sqrt,'EXP':np.exp,'LOG':np.log,'LOG10':np.log10}
+
+def reference_value(text,values):
+    #Value of an msx expression, translated token by token into python
+    source=[]
+    for number,name,symbol in _token.findall(text):
+        if number:
+            source.append(number)
+        elif name:
+            source.append('F_'+name.upper() if name.upper() in _functions else 'V_'+name.upper())
+        else:
+            source.append('**' if symbol=='^' else symbol)
+    scope={'F_'+name:f for name,f in _functions.items()}
+    scope.update({'V_'+name:value for name,value in values.items()})
+    return eval(' '.join(source),scope)
+
+lines={}
+for section in ('PIPES','TANKS'):
+    for l in model.sections.get(section,[]):
+        lines[l[1].upper()]=' '.join(l[2:])
+terms={l[0].upper():' '.join(l[1:]) for l in model.sections.get('TERMS',[])}
+
+values={}
+values.update({name.upper():k[i] for i,name in enumerate(model.constant_names)})
+values.update({name.upper():p[i] for i,name in enumerate(model.parameter_names)})
+values.update(h)
+values.update({model.species_names[i].upper():c[i] for i in reactions.state_ind})
+#The terms and formula species can use each other, so each is computed once all of
+#the values it uses are known
+pending=dict(terms)
+pending.update({model.species_names[i].upper():lines[model.species_names[i].upper()] for i in reactions.formula_ind})
+while pending:
+    for name,text in list(pending.items()):
+        try:
+            values[name]=reference_value(text,values)
+        except NameError:
+            continue
+        del pending[name]
+
+#Expressions of constants alone are numbers, which are broadcast to every state
+expected=np.array([np.broadcast_to(reference_value(lines[model.species_names[i].upper()],values),(n,))
+                   for i in reactions.state_ind])
+expected_formulas=np.array([np.broadcast_to(values[model.species_names[i].upper()],(n,)) for i in reactions.formula_ind])
+f,c_out=outputs(c)
+scale=np.max(np.abs(expected),axis=1,keepdims=True)+1e-300
+eval_error=max(np.max(np.abs(f-expected)/scale),np.max(np.abs(c_out[reactions.formula_ind]-expected_formulas)/
+                                                     (np.max(np.abs(expected_formulas),axis=1,keepdims=True)+1e-300)))
+print('evaluate: largest relative difference from the msx expressions ' + '%.1e' % eval_error)
+if eval_error>1e-12:
+    raise Exception('evaluate differs from the expressions of the msx file')
+
+#%% jacobian against finite differences
+
+jac=np.zeros((n_r+n_e,n_r+n_e,n))
+reactions.jacobian(c,k,p,h,jac)
+fd=np.zeros_like(jac)
+steps=np.zeros((n_r+n_e,n))
+for j,i in enumerate(reactions.state_ind):
+    step=fd_step*np.maximum(np.abs(c[i]),reactor.atol[i])
+    c_hi=c.copy()
+    c_lo=c.copy()
+    c_hi[i]+=step
+    c_lo[i]-=step
+    fd[:,j]=(outputs(c_hi)[0]-outputs(c_lo)[0])/(2*step)
+    steps[j]=step
+
+#The errors are compared in units of the change of each output over a step of
+#every state, since the derivatives of the different species differ by many orders
+change=np.abs(fd)*steps[np.newaxis]
+output_scale=np.max(change,axis=(1,2),keepdims=True)+1e-300
+jac_error=np.max(np.abs(jac-fd)*steps[np.newaxis]/output_scale)
+outside=np.max(np.abs(fd[~reactions.jac_pattern])*steps[np.newaxis].repeat(n_r+n_e,0)[~reactions.jac_pattern]/
+               output_scale.repeat(n_r+n_e,1)[~reactions.jac_pattern])
+print('jacobian: largest scaled difference from finite differences ' + '%.1e' % jac_error +
+      ', outside of jac_pattern ' + '%.1e' % outside)
+if jac_error>jac_tol or outside>jac_tol:
+    raise Exception('jacobian differs from the finite differences of evaluate')
+
+#%% Circular terms
+
+with open(msx_file) as fin:
+    contents=fin.read()
+
+circular=contents.replace('[TERMS]','[TERMS]\n CIRC1 CIRC2+1\n CIRC2 2*CIRC1',1)
+folder=tempfile.mkdtemp()
+circular_file=os.path.join(folder,'circular.msx')
+with open(circular_file,'w') as fout:
+    fout.write(circular)
+try:
+    mc.LoadMSXModel(circular_file)
+except Exception as e:
+    print('circular terms: ' + str(e))
+    if 'Circular reference' not in str(e):
+        raise
+else:
+    raise Exception('The circular terms were not reported')
+
+#%% Cache of the models
+
+copy_file=os.path.join(folder,'copy.msx')
+with open(copy_file,'w') as fout:
+    fout.write(contents)
+if mc.LoadMSXModel(copy_file) is not model or model.compile('tank') is not reactions:
+    raise Exception('A file with the same contents did not return the cached model')
+
+#The same file with a different value of the first constant
+name,value=model.constant_names[0],model.constants[0]
+changed=re.sub(r'(CONSTANT\s+'+name+r'\s+)\S+',lambda m:m.group(1)+repr(float(2*value)),contents,count=1,flags=re.I)
+with open(copy_file,'w') as fout:
+    fout.write(changed)
+changed_model=mc.LoadMSXModel(copy_file)
+if changed_model is model or changed_model.constants[0]!=2*value:
+    raise Exception('A file with different contents returned the cached model')
+
+with open(copy_file,'w') as fout:
+    fout.write(contents)
+if mc.LoadMSXModel(copy_file) is not model:
+    raise Exception('The original contents did not return the cached model')
+print('cache: same contents reuse the model, changed contents parse a new one')
+
+print('Complete')
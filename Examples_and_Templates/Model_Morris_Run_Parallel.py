@@ -8,9 +8,6 @@ Created on Wed Jan 12 14:30:55 2022
 
 import sys
 import numpy as np
-import matplotlib.pyplot as plt
-import pandas as pd
-import wntr
 import os
 
 main_folder = os.path.dirname(os.getcwd())
@@ -22,12 +19,10 @@ import epanet_toolkit as epa
 import msx_toolkit as msx
 import MSXPY_toolkit as mpy
 import multiprocessing as mp
-import pickle
 
 
 #Import the processes that will be use in the main process only
 if __name__=='__main__':
-    from SALib.sample import morris as morris_s
     import time
 
 #Set working directory
@@ -37,8 +32,9 @@ os.chdir(main_folder)
 #Number of trajectories to run for the models
 traj=3
 
-#Set the name of the pickle file
-pickle_file=r'Examples_and_Templates\Pickle Files\example_morris.pkl'
+#Set the name of the directory the results are saved in. It can be read with 
+#mpy.RunResultStore or passed directly to mpy.MorrisWallEvaluate
+store_dir=r'Examples_and_Templates\Run Stores\example_morris'
 
 #Decde if running net1 or net3
 
@@ -62,27 +58,13 @@ species_vary=['CL2','S','Xb']
 #bounds_range=pd.read_csv('bounds.csv',header=None,index_col=0)
 
 #Do the morris test for another model of interest- here it is Net1
-    
-#Close any models that might be open
-epa.ENclose()
-msx.MSXclose()
-
 
-#open the inp file
 inp_file=r'INP_and_MSX_Files/Net1.inp'
-epa.ENopen(inp_file,'report.rpt')
-#open msx file
-msx.MSXopen(r'INP_and_MSX_Files/bacteria_net1.msx')  
+msx_file=r'INP_and_MSX_Files/bacteria_net1.msx'
 
 #Number of days to run model
 days=8
 
-#0 for duration
-epa.ENsettimeparam(0, int(days*24*3600))
-
-#Solve the hydraulics of the model
-msx.MSXsolveH()
-
 
 
 #Define node where we want the initial concentrations. In net1 that is
@@ -93,6 +75,18 @@ node='9'
 
     
 if __name__=='__main__':
+    #Open the model in the main process to get the base values of the parameters.
+    #Each of the subprocesses opens its own copy of the model once when it starts
+    
+    #Close any models that might be open
+    epa.ENclose()
+    msx.MSXclose()
+    
+    #open the inp file
+    epa.ENopen(inp_file,'report.rpt')
+    #open msx file
+    msx.MSXopen(msx_file)  
+    
     #Get the values of the constants
     cons=mpy.GetConstants(constants_vary)  
 
@@ -134,22 +128,13 @@ if __name__=='__main__':
     
     print('Generating Parameter Values')
     #Use the same parameter values as above- same seed and options
-    param_values=morris_s.sample(problem,N=500,optimal_trajectories=traj,seed=seed)
+    param_values=mpy.MorrisSample(problem,N=500,optimal_trajectories=traj,seed=seed)
     
     #Save the parameter values for later
     param_values_net1=param_values
 
-#Get the base demands
-base_demands=mpy.GetAllNodeDemands()  
-
-#Get list of nodes
-nodes=mpy.GetNodeNameList()
-
-#Get list of links
-links=mpy.GetLinkNameList()
-
    
-def run_model(param_row):
+def set_model(param_row):
     
     #Separate the values of the constants to the initial concentrations for ease of
     #manipulation later
@@ -162,74 +147,58 @@ def run_model(param_row):
     mpy.SetConstants(constants_vary,con_values)
     mpy.SetInitialConcentration(node,species_vary,species_values)
     
-    #Solve the hydraulics of the model- If hydraulicspart of sensitivity analysis
-    msx.MSXsolveH()   
-  
-    #Run the reaction model
-    #Seprate by the t_start value
-  
-    my_results=mpy.MSXRunQual(by_species='no',t_start=days-1)
-       
+    #The hydraulics are solved once in each subprocess by mpy.RunParallel, and
+    #solved again only if a hydraulic parameter is part of the sensitivity analysis
     
-    return my_results
+    #mpy.RunParallel then runs the reaction model with MSXRunQual
 
 
 
 if __name__=='__main__':      
     
+    #Get the base demands
+    base_demands=mpy.GetAllNodeDemands()  
+    
+    #Get list of nodes
+    nodes=mpy.GetNodeNameList()
+    
+    #Get list of links
+    links=mpy.GetLinkNameList()
+    
     
-    #Get a list of all files in directory before the model evaluations
-    files_before=os.listdir()
+    #Solve the hydraulics once and save them to a file which all of the subprocesses
+    #read, instead of each subprocess solving them. The file is kept in the 
+    #Hydraulics_Cache folder and reused the next time the script is run
+    hyd_file=mpy.GetHydraulicsFile(inp_file,days=days)
     
     #Get the number of available cores
     cores=int(np.round(mp.cpu_count()*.85,0))
 
-    #Set start method to 'spawn' to avoid memory overload
-    try:
-        mp.set_start_method('forkserver')
-    except:
-        a=1
-        
     t1=time.time()
-    #Run the results using a map for parallelization
-    pool=mp.Pool(processes=cores)
+    
+    #Variables saved with the results
+    meta={}
+    meta['constants_vary']=constants_vary
+    meta['species_vary']=species_vary
+    meta['base_demands']=base_demands
     
     print('Running Models')
-    results_model=pool.map(run_model,param_values)
-   
-    pool.close()
-    pool.join()
+    #Run the models in parallel. Each subprocess opens the model and solves the
+    #hydraulics once, and then evaluates its share of the rows of param_values
+    #The results of each model are written to store_dir as soon as they finish
+    #Seprate by the t_start value
+    mpy.RunParallelToStore(set_model,param_values,store_dir,inp_file,msx_file,days=days,
+                           run_kwargs={'t_start':days-1},problem=problem,hyd_file=hyd_file,
+                           processes=cores,meta=meta)
     t2=time.time()
     print(t2-t1)
+    mpy.HydraulicsCacheReport(n_workers=cores)
 
     #Close epanet and msx models
     epa.ENclose()
     msx.MSXclose()
-    #Get a list of all files in directory after model evaluations
-    files_after=os.listdir()
-    
-    #Get the files that were created during model runs
-    new_files=list(set(files_after).difference(files_before))
-    
-    #Remove binary files that were generated during model evaluations
-    for file in new_files:
-        os.remove(file)
-    
-    #assemble variables to be saved to pickle file into a dictionary
-    to_pickle={}
-    to_pickle['problem']=problem
-    to_pickle['results']=results_model
-    to_pickle['constants_vary']=constants_vary
-    to_pickle['species_vary']=species_vary
-    to_pickle['param_values']=param_values
-    to_pickle['nodes']=nodes
-    to_pickle['links']=links
-    to_pickle['base_demands']=base_demands
-    to_pickle['inp_file']=inp_file
-        
-    #Save Results as a pickle file
-    #Save the simulation results as a pickle
-    with open(pickle_file,'wb') as pfile:
-        pickle.dump(to_pickle,pfile)
+    #Remove the scratch files of this process; those of the subprocesses are
+    #removed when each of them exits
+    mpy.CleanScratch()
         
 
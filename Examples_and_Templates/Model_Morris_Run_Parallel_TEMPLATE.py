@@ -8,9 +8,6 @@ Created on Wed Jun 15 13:42:49 2022
 
 import sys
 import numpy as np
-import matplotlib.pyplot as plt
-import pandas as pd
-import wntr
 import os
 
 main_folder = os.path.dirname(os.getcwd())
@@ -28,7 +25,6 @@ import pickle
 
 #Import the processes that will be use in the main process only
 if __name__=='__main__':
-    from SALib.sample import morris as morris_s
     import time
 
 #Set working directory
@@ -128,7 +124,7 @@ if __name__=='__main__':
     
     print('Generating Parameter Values')
     #Use the same parameter values as above- same seed and options
-    param_values=morris_s.sample(problem,N=500,optimal_trajectories=traj,seed=seed)
+    param_values=mpy.MorrisSample(problem,N=500,optimal_trajectories=traj,seed=seed)
     
     #Save the parameter values for later
     param_values_net1=param_values
@@ -10,13 +10,19 @@ import epanet_toolkit as epa
 import msx_toolkit as msx
 import pandas as pd
 import os
-from sklearn.cluster import KMeans
-from sklearn.metrics import silhouette_score
-import wntr
-from scipy.linalg import cholesky
-from SALib.analyze import morris as morris_a
+import time
+import json
+import pickle
+import hashlib
+import shutil
+import tempfile
+import multiprocessing as mp
+import multiprocessing.util as mp_util
+#sklearn, wntr and scipy are imported by the functions which use them, so that
+#importing this module (e.g. in every parallel worker) stays cheap
 
-def MSXRunQual(species='all', nodes='all', links='all',by_species='yes',bin_read='no',t_start=-1):
+def MSXRunQual(species='all', nodes='all', links='all',by_species='yes',bin_read='no',t_start=-1,dtype=np.float64,
+               registry=None,schedule=None,stop=None,report_step=None,stats=None,series='yes'):
     #Function to run a MSX model and extract timeseries of specified species, links, and nodes
     #Inputs are a list of the desired species, nodes, links, and whether the results
     #should be organized by species, or by model element (links and nodes)
@@ -30,187 +36,57 @@ def MSXRunQual(species='all', nodes='all', links='all',by_species='yes',bin_read
     #then the binary file is read. The reporting timesteps are based on the 
     #reporting timestep from the inp file. If not, the results
     #are read at each timestep from the msx model run.
+    
+    #The dtype option sets the precision the results are stored with when
+    #bin_read is 'no'. np.float32 halves the memory of the results.
+    
+    #registry is the ModelRegistry used to find the names and indices of the model,
+    #GetRegistry() if None
+    
+    #schedule is a ConstantSchedule of constants which change during the simulation
+    #(e.g. from MonochloramineTempSchedule). It is only applied when bin_read is 'no'
+    
+    #stop is a StopCriterion which ends the simulation once a species crosses a
+    #critical value. The results then end at that step, and the time each monitored
+    #element crossed the value is returned in results['crossing_times']. It is only
+    #applied when bin_read is 'no'
+    
+    #report_step is the interval (s) at which the results are recorded when bin_read
+    #is 'no', instead of every quality timestep. The first timestep at or after each
+    #multiple of report_step is recorded
+    
+    #stats is a QualStatistics which accumulates the minimum, maximum, mean, time 
+    #above a threshold and final value of every element and species from every 
+    #timestep after t_start. They are returned in results['statistics']. With 
+    #series='no' no time series are recorded, so that the memory of the results only 
+    #depends on the number of elements. Only applied when bin_read is 'no'
+    
+    if registry is None:
+        registry=GetRegistry()
+    
+    if schedule is not None and bin_read!='no':
+        raise Exception('A schedule of constants can only be applied when bin_read is no')
+    
+    if stop is not None and bin_read!='no':
+        raise Exception('A stop criterion can only be applied when bin_read is no')
+    
+    if (report_step is not None or stats is not None or series!='yes') and bin_read!='no':
+        raise Exception('report_step, stats and series can only be applied when bin_read is no')
         
     if bin_read=='no':
     
-        #Extract the indicies and names for the species of interest
-        if (species=='all'):
-            species_names=[]
-            #Get the number of species 3 for species
-            species_num=msx.MSXgetcount(3)
-            #Get a list for the species id's
-            for i in range(species_num):
-                species_names.append(msx.MSXgetID(3,i+1))
-            #get an array for the species indicies
-            species_ind=np.linspace(1,species_num,species_num)
-            
-        #If there is a user supplied list of species to be extracted
-        else:
-            #Make the user-input list the variable species_names
-            species_names=species
-            #Extract the indicies for the species being specified
-            species_ind=[]
-            for i in range(len(species_names)):
-                species_ind.append(msx.MSXgetindex(3,species_names[i]))
-        
-        #Extract the node indicies for the specified nodes
-        if (nodes=='all'):
-            node_names=[]
-            #Get the number of nodes- 0 for nodes
-            node_num=epa.ENgetcount(0)
-            #Get a list for the node id's
-            for i in range(node_num):
-                node_names.append(epa.ENgetnodeid(i+1))
-            #Get an array for the node indicies
-            node_ind=np.linspace(1,node_num,node_num)
-            
-        #If there are actual nodes specified to be extracted
-        else:
-            #Make the user-input list the variable node_names
-            node_names=nodes
-            #Extract the indicies for the nodes being specified
-            node_ind=[]
-            for i in range(len(node_names)):
-                node_ind.append(epa.ENgetnodeindex(node_names[i]))
-                
-        #Do the same but for links
-        
-        #Extract the link indicies for the specified nodes
-        if (links=='all'):
-            link_names=[]
-            #Get the number of links- 2 for links
-            link_num=epa.ENgetcount(2)
-            #Get a list for the link id's
-            for i in range(link_num):
-                link_names.append(epa.ENgetlinkid(i+1))
-            #Get an array for the node indicies
-            link_ind=np.linspace(1,link_num,link_num)
-            
-        #If there are actual nodes specified to be extracted
-        else:
-            #Make the user-input list the variable node_names
-            link_names=links
-            #Extract the indicies for the nodes being specified
-            link_ind=[]
-            for i in range(len(link_names)):
-                link_ind.append(epa.ENgetlinkindex(link_names[i]))
-            
-        
-        
-        #Create array to extract the time of the simulation steps
-        T=[]
-        
-        #Initialize MSX for first timestep
-        msx.MSXinit(0)
-        
-        #Initialize time left
-        t_left=1
-        
-        #Create overall results dictionary
-        results={}
-        
-        #If organized by species
-        if (by_species=='yes'):
-            #Create a new dictionary for each species and then within each species
-            #make a node and link list
-            for i in range(len(species_names)):
-                results[species_names[i]]={}
-                results[species_names[i]]['node']=[]
-                results[species_names[i]]['link']=[]
-        
-        #If organized by element
-        if (by_species=='no'):
-            #Create node key and another dictionary
-            results['node']={}
-            #Create link key and another dictionary
-            results['link']={}
-            
-            #Within each dictionary make a list to be populated later during model run
-            #nodes
-            for i in range(len(node_names)):
-                results['node'][node_names[i]]=[] 
-            #links
-            for i in range(len(link_names)):
-                results['link'][link_names[i]]=[] 
+        #Run the model and store the results in one array
+        store=MSXRunQualStore(species,nodes,links,t_start,dtype,registry,schedule,stop,report_step,stats,series)
         
+        #Organize the results into dictionaries of dataframes which are views of the
+        #stored array
+        results=store.to_dict(by_species)
         
-        #Change the input of t_start from days to seconds
-        t_start=t_start*24*60*60
-        
-        
-        #Create loop to run model
-        while (t_left>0):
-            #Solve the quality for that timestep
-            [t,t_left]=msx.MSXstep()
-           
-            #If the results should be extracted based on t_start aka the simulation
-            #time has passed the time when we care about the results
-            if t>t_start: 
-                
-                #Append time for that step to the overall time list
-                T.append(t)
-                
-                #If the results are to be extracted by model element
-                if (by_species=='no'):
-                    #Extract the results from each node into a different list
-                    for j in range(len(node_names)):
-                        #Create a row for the overall results list
-                        Q_row=[]
-                        #Extract the results for each desired species at that node
-                        for i in range(len(species_names)):
-                            #0 for node    #node_ind and the species_ind
-                            Q_row.append(msx.MSXgetqual(0,int(node_ind[j]),int(species_ind[i])))
-                        results['node'][node_names[j]].append(Q_row)
-                        
-                    #Extract the results from each link into a different list
-                    for j in range(len(link_names)):
-                        #Create a row for the overall results list
-                        Q_row=[]
-                        #Extract the results for each desired species at that node
-                        for i in range(len(species_names)):
-                            #0 for link    #node_ind and the species_ind
-                            Q_row.append(msx.MSXgetqual(1,int(link_ind[j]),int(species_ind[i])))
-                        results['link'][link_names[j]].append(Q_row)
-                        
-                #If the results are to be extracted by species
-                if (by_species=='yes'):
-                    for i in range(len(species_names)):
-                        #First extract the nodes and then the links
-                        #Create empty lists for each row to be added
-                        Q_row_node=[]
-                        Q_row_link=[]
-                        
-                        #Extract results by node
-                        for j in range(len(node_names)):
-                            Q_row_node.append(msx.MSXgetqual(0,int(node_ind[j]),int(species_ind[i])))
-                        results[species_names[i]]['node'].append(Q_row_node)
-                        
-                        #Extract results by link
-                        for j in range(len(link_names)):
-                            Q_row_link.append(msx.MSXgetqual(1,int(link_ind[j]),int(species_ind[i])))
-                        results[species_names[i]]['link'].append(Q_row_link)
-                        
-                            
-        
-        #After the simulation is complete go through the results one more time and
-        #convert the lists into dataframes
-        if (by_species=='no'):
-            #Nodes
-            for i in range(len(node_names)):
-                results['node'][node_names[i]]=pd.DataFrame(results['node'][node_names[i]],index=T,columns=species_names)
-            
-            #Links     
-            for i in range(len(link_names)):
-                results['link'][link_names[i]]=pd.DataFrame(results['link'][link_names[i]],index=T,columns=species_names)
+        if stop is not None:
+            results['crossing_times']=stop.times
         
-        if (by_species=='yes'):
-            #Nodes
-            for i in range(len(species_names)):
-                results[species_names[i]]['node']=pd.DataFrame(results[species_names[i]]['node'],index=T,columns=node_names)
-            
-            #links
-            for i in range(len(species_names)):
-                results[species_names[i]]['link']=pd.DataFrame(results[species_names[i]]['link'],index=T,columns=link_names)
+        if stats is not None:
+            results['statistics']=stats.to_dict()
     
     if bin_read=='yes':
         
@@ -218,95 +94,35 @@ def MSXRunQual(species='all', nodes='all', links='all',by_species='yes',bin_read
         msx.MSXsolveQ()
         
         #Save quality results to binary file
-        #Add the process id to the binary file name so that multiple processes are
-        #not trying to read from the same file if it is run in parallel
-        filename='results_temp'+str(os.getpid())+'.bin'
+        #The file is in a scratch directory which belongs to this process, so that
+        #multiple processes are not trying to read from the same file if it is run
+        #in parallel. The same file is overwritten by every evaluation in the process
+        #and removed when the process exits. The location is set by SetScratchDir
+        filename=GetScratchFile()
         msx.MSXsaveoutfile(filename)
         
-        #def MSXBinReader(filename, epanetinpfile):
-        
-        #This code is from Jon Buckhardt that I lightly edited
-        duration=epa.ENgettimeparam(0)
-        with open(filename, 'rb') as fin:
-              ftype = '=f4'
-              idlen = 32
-              prolog = np.fromfile(fin, dtype = np.int32, count = 6)
-              magic1 = prolog[0]
-              version = prolog[1]
-              nnodes = prolog[2]
-              nlinks = prolog[3]
-              nspecies = prolog[4]
-              reportstep = prolog[5]
-              species_list = []
-              node_list = GetNodeNameList()
-              link_list = GetLinkNameList()
-        
-              for i in range(nspecies):
-                      species_len = int(np.fromfile(fin, dtype = np.int32, count = 1))
-                      species_name = ''.join(chr(f) for f in np.fromfile(fin, dtype = np.uint8, count = species_len) if f!=0)
-                      species_list.append(species_name)
-              
-                
-              species_mass = []
-              for i in range(nspecies):
-                      species_mass.append(''.join(chr(f) for f in np.fromfile(fin, dtype = np.uint8, count = 16) if f != 0))
-              timerange = range(0, duration+1, reportstep)
-              
-              tr = len(timerange)
-              
-              row1 = ['node']*nnodes*len(species_list)+['link']*nlinks*len(species_list)
-              row2 = []
-              for i in [nnodes,nlinks]:
-                      for j in species_list:
-                            row2.append([j]*i)
-              row2 = [y for x in row2 for y in x]
-              row3 = [node_list for i in species_list] + [link_list for i in species_list]
-              row3 = [y for x in row3 for y in x]    
-              
-              tuples = list(zip(row1, row2, row3))
-              index = pd.MultiIndex.from_tuples(tuples, names = ['type','species','name'])
-              
-              try:
-                      data = np.fromfile(fin, dtype = np.dtype(ftype), count = tr*(len(species_list*(nnodes + nlinks))))
-                      data = np.reshape(data, (tr, len(species_list*(nnodes + nlinks))))
-              except Exception as e:
-                  print(e)
-                  print ("oops")
-              postlog = np.fromfile(fin, dtype = np.int32, count = 4)
-              offset = postlog[0]
-              numreport = postlog[1]
-              errorcode = postlog[2]
-              magicnew = postlog[3] 
-              if magic1 == magicnew:
-                  #print("Magic# Match")
-                  df_fin = pd.DataFrame(data.transpose(), index = index, columns = timerange)
-                  df_fin = df_fin.transpose()
-              else:
-                  print("Magic#s do not match!")
-            #return df_fin
-            
-        #df is a multilevel index dataframe of all of the results
-        
-        #Now I am going to repackage the results so that it fits with my struct structure
-        #Of how I was doing the results before. This may take a bit of time but I want 
-        #things how I want them:)
-        
-        #Create the dictionary
-        results={}
-        
-        #Go through all the nodes and put data from the dataframe into the correct place
-        #in the results dictionary
-        
         if nodes=='all':
-            nodes=GetNodeNameList()
+            nodes=registry.names['node']
         
         if links=='all':
-            links=GetLinkNameList()
+            links=registry.names['link']
             
         if species=='all':
-            species=GetSpeciesNameList()
-            
+            species=registry.names['species']
+        
+        #Read only the requested species of the requested nodes and links, for the
+        #reporting periods after t_start, as arrays of shape (time, element, species)
+        with MSXBinaryOutput(filename,registry.names['node'],registry.names['link'],
+                             report_start=epa.ENgettimeparam(6)) as bin_out:
+            t_start=t_start*24*60*60
+            T=pd.Index(bin_out.get_times(t_start))
+            node_data=bin_out.get('node',species,nodes,t_start)
+            link_data=bin_out.get('link',species,links,t_start)
         
+        #Organize the arrays into the same dictionaries of dataframes as the results
+        #of the timesteps
+        results={}
+        species_index=pd.Index(species,name='species')
         
         if by_species=='no':
             
@@ -316,16 +132,10 @@ def MSXRunQual(species='all', nodes='all', links='all',by_species='yes',bin_read
             results['link']={}    
             
             for i in range(len(nodes)):
-                #Put the dataframe in the dictionary at the correct location
-                results['node'][nodes[i]]=df_fin.loc[:,('node',species,nodes[i])]
-                #Fix the index so it is no longer a multiindex
-                results['node'][nodes[i]].columns=results['node'][nodes[i]].columns.droplevel(['type','name'])
+                results['node'][nodes[i]]=pd.DataFrame(node_data[:,i,:],index=T,columns=species_index)
             
             for i in range(len(links)):
-                #Put the dataframe in the dictionary at the correct location
-                results['link'][links[i]]=df_fin.loc[:,('link',species,links[i])]
-                #Fix the index so it is no longer a multiindex
-                results['link'][links[i]].columns=results['link'][links[i]].columns.droplevel(['type','name'])
+                results['link'][links[i]]=pd.DataFrame(link_data[:,i,:],index=T,columns=species_index)
         
         if by_species=='yes':
             
@@ -333,23 +143,462 @@ def MSXRunQual(species='all', nodes='all', links='all',by_species='yes',bin_read
                 #Create a dictionary for that species
                 results[species[i]]={}
                 
-                #Put the concentrations of the nodes of that species in the right place
-                results[species[i]]['node']=df_fin.loc[:,('node',species[i],nodes)]
-                #Fix the index so it is no longer a multiindex
-                results[species[i]]['node'].columns=results[species[i]]['node'].columns.droplevel(['type','species'])
+                results[species[i]]['node']=pd.DataFrame(node_data[:,:,i],index=T,columns=pd.Index(nodes,name='name'))
+                results[species[i]]['link']=pd.DataFrame(link_data[:,:,i],index=T,columns=pd.Index(links,name='name'))
+        
+    return results 
+
+def MSXRunQualStore(species='all',nodes='all',links='all',t_start=-1,dtype=np.float64,registry=None,
+                    schedule=None,stop=None,report_step=None,stats=None,series='yes'):
+    #Run a MSX model step by step like MSXRunQual(bin_read='no') and return the 
+    #QualResultStore holding the results as one (time, element, species) array,
+    #instead of organizing them into dictionaries of dataframes
+    #The inputs are the same as those of MSXRunQual
+    #registry is the ModelRegistry used to find the names and indices, GetRegistry()
+    #if None
+    
+    if registry is None:
+        registry=GetRegistry()
+    
+    #Extract the names and indicies of the species, nodes and links of interest
+    #from the registry of the model
+    if (species=='all'):
+        species_names=list(registry.names['species'])
+    else:
+        species_names=species
+    species_ind=registry.index('species',species_names)
+    
+    if (nodes=='all'):
+        node_names=list(registry.names['node'])
+    else:
+        node_names=nodes
+    node_ind=registry.index('node',node_names)
+    
+    if (links=='all'):
+        link_names=list(registry.names['link'])
+    else:
+        link_names=links
+    link_ind=registry.index('link',link_names)
+
+    #Change the input of t_start from days to seconds
+    t_start=t_start*24*60*60
+
+    #Create readers which extract the quality of all of the requested species at
+    #all of the requested nodes (or links) in one call at each timestep
+    node_reader=msx.MSXqualreader(0,node_ind,species_ind)
+    link_reader=msx.MSXqualreader(1,link_ind,species_ind)
+
+    #Create the array the results are stored in, sized from the expected 
+    #number of timesteps that will be recorded
+    n_steps=EstimateQualSteps(t_start,report_step) if series=='yes' else 0
+    store=QualResultStore(n_steps,node_names,link_names,species_names,dtype=dtype)
+    
+    if stats is not None:
+        stats.start(node_names,link_names,species_names,t_start)
+    
+    #Time at or after which the next timestep is recorded. With a report_step it is
+    #the first multiple of report_step at or after t_start, so the recorded times are
+    #aligned to the report_step grid wherever t_start falls
+    if report_step is not None:
+        next_report=-(-max(t_start,0)//report_step)*report_step
+    else:
+        next_report=t_start
+
+    #The constants of the schedule are set back to their values before the 
+    #simulation when it ends
+    if schedule is not None:
+        con_ind=registry.index('constant',schedule.con_names)
+        con_before=np.array([msx.MSXgetconstant(i) for i in con_ind.tolist()])
+        row=-1
+
+    #Initialize MSX for first timestep
+    msx.MSXinit(0)
+    
+    #Read the monitored elements at time 0
+    if stop is not None:
+        stop.start(registry)
+
+    #Initialize time and time left
+    t=0
+    t_left=1
+
+    try:
+        #Create loop to run model
+        while (t_left>0):
+            #Set the constants of the schedule when the simulation reaches a new row
+            if schedule is not None:
+                new_row=schedule.row(t)
+                if new_row!=row:
+                    msx.MSXsetconstants(con_ind,schedule.values[new_row] if new_row>=0 else con_before)
+                    row=new_row
+            
+            #Solve the quality for that timestep
+            [t,t_left]=msx.MSXstep()
+
+            #If the results should be extracted based on t_start aka the simulation
+            #time has passed the time when we care about the results
+            if t>t_start: 
+
+                #Extract the results for every node/link and species at once
+                node_vals=node_reader.read()
+                link_vals=link_reader.read()
                 
-                #Put the concentrations of the links of that species in the right place
-                results[species[i]]['link']=df_fin.loc[:,('link',species[i],links)]
-                #Fix the index so it is no longer a multiindex
-                results[species[i]]['link'].columns=results[species[i]]['link'].columns.droplevel(['type','species'])       
+                if stats is not None:
+                    stats.update(t,node_vals,link_vals)
+                
+                if series=='yes' and t>=next_report:
+                    store.append(t,node_vals,link_vals)
+                    if report_step is not None:
+                        next_report=(t//report_step+1)*report_step
+            
+            #End the simulation once the stop criterion is met
+            if stop is not None and stop.check(t):
+                break
+    finally:
+        if schedule is not None:
+            msx.MSXsetconstants(con_ind,con_before)
+    
+    return store
+
+def EstimateQualSteps(t_start=-1,report_step=None):
+    #Estimate the number of water quality timesteps that MSXRunQual will record
+    #t_start is in seconds. The quality timestep of the inp file is used, which can
+    #differ from the TIMESTEP in the msx file, so this is only an estimate
+    #report_step is the interval (s) at which the results are recorded, if any
+    duration=epa.ENgettimeparam(0)
+    qual_step=epa.ENgettimeparam(2)
+    if qual_step<=0:
+        qual_step=300
+    if report_step is not None:
+        qual_step=max(qual_step,report_step)
+    return int(max(duration-max(t_start,0),0)//qual_step)+1
+
+class QualStatistics:
+    #Running statistics of every element and species of MSXRunQual, accumulated at
+    #each quality timestep after t_start instead of storing the time series
+    #thresholds: dictionary of a threshold for some of the species (e.g. 
+    #{'cNH2CL':1.46}), whose time above the threshold is computed
+    
+    #Each value is taken to hold for the timestep that ends at its time, so the mean
+    #is weighted by the length of the timesteps. After a run, min, max, mean, 
+    #time_above and final are arrays of shape (element, species), where the elements
+    #are the nodes followed by the links. time_above is NaN for the species without
+    #a threshold
+    
+    def __init__(self,thresholds=None):
+        self.thresholds=dict(thresholds or {})
+    
+    def start(self,node_names,link_names,species_names,t_start=-1):
+        #Called by MSXRunQualStore before the simulation. t_start is in seconds
+        self.node_names=list(node_names)
+        self.link_names=list(link_names)
+        self.species_names=list(species_names)
+        shape=(len(self.node_names)+len(self.link_names),len(self.species_names))
+        for name in self.thresholds:
+            if name not in self.species_names:
+                raise Exception('The species ' + str(name) + ' of the thresholds is not one of the species of the run')
+        self.threshold=np.array([self.thresholds.get(name,np.nan) for name in self.species_names])
+        self.min=np.full(shape,np.inf)
+        self.max=np.full(shape,-np.inf)
+        self.total=np.zeros(shape)
+        self.time_above=np.zeros(shape)
+        self.time_above[:,np.isnan(self.threshold)]=np.nan
+        self.final=np.full(shape,np.nan)
+        self.duration=0.
+        self._t=max(t_start,0)
+        self._above=np.zeros(shape,dtype=bool)
+    
+    def update(self,t,node_vals,link_vals):
+        #Adds the (element x species) arrays of the nodes and links at time t
+        n_nodes=len(self.node_names)
+        values=self.final
+        values[:n_nodes]=node_vals
+        values[n_nodes:]=link_vals
+        dt=t-self._t
+        self._t=t
+        np.minimum(self.min,values,out=self.min)
+        np.maximum(self.max,values,out=self.max)
+        self.total+=values*dt
+        np.greater(values,self.threshold,out=self._above)
+        self.time_above+=self._above*dt
+        self.duration+=dt
+    
+    @property
+    def mean(self):
+        if self.duration==0:
+            return np.full(self.total.shape,np.nan)
+        return self.total/self.duration
+    
+    def to_dict(self):
+        #Dictionary of the statistics, each a dictionary of dataframes of the nodes and
+        #of the links, with one column for each species
+        n_nodes=len(self.node_names)
+        results={}
+        for name in ('min','max','mean','time_above','final'):
+            values=getattr(self,name)
+            results[name]={'node':pd.DataFrame(values[:n_nodes],index=self.node_names,columns=self.species_names),
+                           'link':pd.DataFrame(values[n_nodes:],index=self.link_names,columns=self.species_names)}
+        return results
+
+class QualResultStore:
+    #Stores the results of a simulation in one preallocated array of shape 
+    #(time, element, species), where the elements are the nodes followed by the links
+    #If more timesteps are appended than were preallocated, the array doubles in size
+    
+    def __init__(self,n_steps,node_names,link_names,species_names,dtype=np.float64):
+        self.node_names=list(node_names)
+        self.link_names=list(link_names)
+        self.species_names=list(species_names)
+        n_elements=len(self.node_names)+len(self.link_names)
+        self.data=np.zeros((max(int(n_steps),1),n_elements,len(self.species_names)),dtype=dtype)
+        self.times=np.zeros(self.data.shape[0],dtype=np.int64)
+        #Number of timesteps that have been stored
+        self.n=0
+    
+    def append(self,t,node_vals,link_vals):
+        #Store the (element x species) arrays of the nodes and links for time t
+        if self.n==self.data.shape[0]:
+            self._grow()
+        n_nodes=len(self.node_names)
+        self.data[self.n,:n_nodes,:]=node_vals
+        self.data[self.n,n_nodes:,:]=link_vals
+        self.times[self.n]=t
+        self.n+=1
+    
+    def _grow(self):
+        #Double the number of timesteps that can be stored
+        data=np.zeros((2*self.data.shape[0],)+self.data.shape[1:],dtype=self.data.dtype)
+        data[:self.n]=self.data[:self.n]
+        times=np.zeros(data.shape[0],dtype=np.int64)
+        times[:self.n]=self.times[:self.n]
+        self.data=data
+        self.times=times
+    
+    def node_data(self):
+        #Array of shape (time, node, species) of the stored timesteps
+        return self.data[:self.n,:len(self.node_names),:]
+    
+    def link_data(self):
+        #Array of shape (time, link, species) of the stored timesteps
+        return self.data[:self.n,len(self.node_names):,:]
+    
+    def to_dict(self,by_species='yes'):
+        #Organize the results the same way as MSXRunQual. The dataframes are views 
+        #of the stored array, so the results are not copied
+        T=pd.Index(self.times[:self.n])
+        node_data=self.node_data()
+        link_data=self.link_data()
         
-        #Remove the 
-        try:
-            os.remove(filename)
-        except:
-            print('Error removing ' + filename)
+        results={}
+        
+        if (by_species=='no'):
+            results['node']={}
+            results['link']={}
+            for i in range(len(self.node_names)):
+                results['node'][self.node_names[i]]=pd.DataFrame(node_data[:,i,:],index=T,columns=self.species_names,copy=False)
+            for i in range(len(self.link_names)):
+                results['link'][self.link_names[i]]=pd.DataFrame(link_data[:,i,:],index=T,columns=self.species_names,copy=False)
+        
+        if (by_species=='yes'):
+            for i in range(len(self.species_names)):
+                results[self.species_names[i]]={}
+                results[self.species_names[i]]['node']=pd.DataFrame(node_data[:,:,i],index=T,columns=self.node_names,copy=False)
+                results[self.species_names[i]]['link']=pd.DataFrame(link_data[:,:,i],index=T,columns=self.link_names,copy=False)
+        
+        return results
+
+class MSXBinaryOutput:
+    #Reader for the binary output file written by msx.MSXsaveoutfile
+    #The prolog, species IDs and epilog are read once when the file is opened, and
+    #the block of results is memory-mapped, so only the parts of the file that 
+    #are sliced are ever read from disk
     
-    return results 
+    #node_names and link_names are the IDs of the nodes and links in the order of
+    #their index in the model. If they are not supplied they are taken from the
+    #epanet model that is currently open
+    #report_start is the time in seconds of the first reporting period
+    
+    #Can be used as a context manager so the file is closed afterwards:
+    #with MSXBinaryOutput('results.bin') as bin_out:
+    #    cl2=bin_out.get('node',species=['CL2'],t_start=3600)
+    
+    def __init__(self,filename,node_names=None,link_names=None,report_start=0):
+        self.filename=filename
+        
+        with open(filename,'rb') as fin:
+            #Prolog
+            prolog=np.frombuffer(fin.read(24),dtype=np.int32)
+            self.magic=int(prolog[0])
+            self.version=int(prolog[1])
+            self.n_nodes=int(prolog[2])
+            self.n_links=int(prolog[3])
+            self.n_species=int(prolog[4])
+            self.report_step=int(prolog[5])
+            
+            #Species IDs and mass units
+            #Versions before 2.0 write all of the IDs and then all of the units,
+            #later versions write the units after each ID
+            self.species_names=[]
+            self.species_units=[]
+            for i in range(self.n_species):
+                id_len=int(np.frombuffer(fin.read(4),dtype=np.int32)[0])
+                self.species_names.append(fin.read(id_len).split(b'\0')[0].decode())
+                if self.version>=200000:
+                    self.species_units.append(fin.read(16).split(b'\0')[0].decode())
+            if self.version<200000:
+                for i in range(self.n_species):
+                    self.species_units.append(fin.read(16).split(b'\0')[0].decode())
+            
+            #Epilog at the end of the file
+            fin.seek(-16,os.SEEK_END)
+            epilog=np.frombuffer(fin.read(16),dtype=np.int32)
+            self.offset=int(epilog[0])
+            self.n_periods=int(epilog[1])
+            self.error_code=int(epilog[2])
+            
+        if int(epilog[3])!=self.magic:
+            raise Exception('Magic numbers of ' + filename + ' do not match, the file is incomplete or corrupt')
+        
+        if node_names is None:
+            node_names=GetNodeNameList()
+        if link_names is None:
+            link_names=GetLinkNameList()
+        self.node_names=list(node_names)
+        self.link_names=list(link_names)
+        
+        self.times=report_start+self.report_step*np.arange(self.n_periods,dtype=np.int64)
+        
+        #Each reporting period is a row with the values of every node for each
+        #species followed by the values of every link for each species
+        row_len=self.n_species*(self.n_nodes+self.n_links)
+        self._data=np.memmap(filename,dtype=np.dtype('=f4'),mode='r',offset=self.offset,shape=(self.n_periods,row_len))
+        
+        #Views of the file of shape (time, species, element)
+        node_end=self.n_species*self.n_nodes
+        self._node=self._data[:,:node_end].reshape((self.n_periods,self.n_species,self.n_nodes))
+        self._link=self._data[:,node_end:].reshape((self.n_periods,self.n_species,self.n_links))
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self,*args):
+        self.close()
+    
+    def close(self):
+        #Release the memory map so the file can be removed. Arrays returned by get
+        #are copies, so they remain valid
+        self._data=None
+        self._node=None
+        self._link=None
+    
+    def time_slice(self,t_start=None,t_end=None):
+        #Slice of the reporting periods with t_start < time <= t_end, in seconds
+        first=0
+        last=self.n_periods
+        if t_start is not None:
+            first=int(np.searchsorted(self.times,t_start,side='right'))
+        if t_end is not None:
+            last=int(np.searchsorted(self.times,t_end,side='right'))
+        return slice(first,max(first,last))
+    
+    def get(self,element_type='node',species=None,elements=None,t_start=None,t_end=None):
+        #Returns an array of shape (time, element, species) with the results of the 
+        #specified species at the specified nodes or links, for the reporting periods
+        #with t_start < time <= t_end
+        #species and elements are lists of IDs, or None for all of them
+        #Only the columns of the requested species and elements are read from the file
+        if element_type=='node':
+            first=0
+            names=self.node_names
+        elif element_type=='link':
+            first=self.n_species*self.n_nodes
+            names=self.link_names
+        else:
+            raise Exception('element_type must be node or link')
+        
+        values=self._data[self.time_slice(t_start,t_end)]
+        if species is None and elements is None:
+            #The whole block of the nodes or links
+            values=np.array(values[:,first:first+self.n_species*len(names)])
+            return values.reshape((-1,self.n_species,len(names))).transpose((0,2,1))
+        
+        spe_inds=np.arange(self.n_species) if species is None else np.array([self.species_names.index(s) for s in species],dtype=np.int64)
+        el_inds=np.arange(len(names)) if elements is None else np.array([names.index(e) for e in elements],dtype=np.int64)
+        
+        #Column of each (element, species) in the rows of the file
+        columns=first+spe_inds[np.newaxis,:]*len(names)+el_inds[:,np.newaxis]
+        return values[:,columns.ravel()].reshape((values.shape[0],)+columns.shape)
+    
+    def get_times(self,t_start=None,t_end=None):
+        #The reporting times with t_start < time <= t_end
+        return self.times[self.time_slice(t_start,t_end)]
+    
+    def to_dataframe(self):
+        #Load all of the results into a dataframe indexed by time, with a 
+        #(type, species, name) multiindex for the columns
+        columns=pd.MultiIndex.from_arrays([
+            ['node']*self.n_nodes*self.n_species+['link']*self.n_links*self.n_species,
+            list(np.repeat(self.species_names,self.n_nodes))+list(np.repeat(self.species_names,self.n_links)),
+            self.node_names*self.n_species+self.link_names*self.n_species],
+            names=['type','species','name'])
+        return pd.DataFrame(np.array(self._data),index=self.times,columns=columns)
+
+#Scratch location of the binary files of MSXRunQual(bin_read='yes'). The base
+#directory is set with SetScratchDir, and each process creates its own directory
+#within it the first time it is needed
+_scratch={'base':None,'pid':None,'dir':None}
+
+def SetScratchDir(location='auto'):
+    #Set where MSXRunQual(bin_read='yes') writes its binary results file
+    #location options:
+    #'auto': the MSXPY_SCRATCH environment variable if it is set, otherwise /dev/shm
+    #if it exists (memory of the compute node), otherwise the system temp directory
+    #'shm': /dev/shm
+    #'tmp': the system temp directory (node-local on most clusters, or $TMPDIR)
+    #'cwd': the current working directory
+    #Otherwise location is the path to a directory
+    #The directory created by this process in the previous location is removed
+    if location=='auto':
+        if os.environ.get('MSXPY_SCRATCH'):
+            base=os.environ['MSXPY_SCRATCH']
+        elif os.path.isdir('/dev/shm'):
+            base='/dev/shm'
+        else:
+            base=tempfile.gettempdir()
+    elif location=='shm':
+        base='/dev/shm'
+    elif location=='tmp':
+        base=tempfile.gettempdir()
+    elif location=='cwd':
+        base=os.getcwd()
+    else:
+        base=location
+    
+    if not os.path.isdir(base):
+        raise Exception('The scratch directory ' + base + ' does not exist')
+    
+    CleanScratch()
+    _scratch['base']=base
+
+def GetScratchFile(name='results.bin'):
+    #Path of a scratch file in the scratch directory of this process. The directory
+    #is created the first time it is needed, and removed by CleanScratch when the 
+    #process exits (including multiprocessing pool workers)
+    if _scratch['base'] is None:
+        SetScratchDir()
+    #A forked child gets its own directory rather than sharing the parent's
+    if _scratch['pid']!=os.getpid():
+        _scratch['dir']=tempfile.mkdtemp(prefix='msxpy_'+str(os.getpid())+'_',dir=_scratch['base'])
+        _scratch['pid']=os.getpid()
+        mp_util.Finalize(None,CleanScratch,exitpriority=10)
+    return os.path.join(_scratch['dir'],name)
+
+def CleanScratch():
+    #Remove the scratch directory of this process and the files in it
+    if _scratch['pid']==os.getpid() and _scratch['dir'] is not None:
+        shutil.rmtree(_scratch['dir'],ignore_errors=True)
+    _scratch['pid']=None
+    _scratch['dir']=None
 
 #Get a list of all the node names
 def GetNodeNameList():
@@ -397,6 +646,187 @@ def GetConstantNameList():
         constant_names.append(msx.MSXgetID(6,i+1))
     return constant_names
 
+class ModelRegistry:
+    #Name to index maps of the objects of the open model, which are looked up once
+    #instead of with epa.ENgetnodeindex and msx.MSXgetindex in every call of the 
+    #setters and getters
+    
+    #The kinds of objects are node, link and demand_pattern (from the inp file), and
+    #species, constant, parameter and pattern (from the msx file)
+    #names[kind]: list of the names, in the order of their indices
+    #maps[kind]: dictionary from name to toolkit index (starting from 1)
+    #indices[kind]: numpy array of the toolkit indices
+    
+    #The registry is only valid until the model is closed or opened again, or a 
+    #pattern is added. GetRegistry returns a registry of the open model, which is
+    #only built again when the model changes
+    
+    def __init__(self):
+        self.en_session=epa.ENsession()
+        self.msx_session=msx.MSXsession()
+        
+        names={}
+        names['node']=GetNodeNameList()
+        names['link']=GetLinkNameList()
+        #3 for patterns, the pattern IDs are returned as bytes
+        names['demand_pattern']=[epa.ENgetpatternid(i+1).decode() for i in range(epa.ENgetcount(3))]
+        try:
+            names['species']=GetSpeciesNameList()
+            names['constant']=GetConstantNameList()
+            #5 for parameters, 7 for patterns
+            names['parameter']=[msx.MSXgetID(5,i+1) for i in range(msx.MSXgetcount(5))]
+            names['pattern']=[msx.MSXgetID(7,i+1) for i in range(msx.MSXgetcount(7))]
+        except msx.MSXtoolkitError:
+            #The msx file is not open
+            for kind in ('species','constant','parameter','pattern'):
+                names[kind]=[]
+        
+        self.names=names
+        self.maps={kind:{name:i+1 for i,name in enumerate(names[kind])} for kind in names}
+        self.indices={kind:np.arange(1,len(names[kind])+1) for kind in names}
+    
+    def valid(self):
+        #True if the model has not been closed or opened again since the registry was made
+        return self.en_session==epa.ENsession() and self.msx_session==msx.MSXsession()
+    
+    def check(self):
+        if not self.valid():
+            raise Exception('The model registry is out of date because the model was closed or opened again, ' +
+                            'create a new one with GetRegistry()')
+    
+    def index(self,kind,names):
+        #Returns a numpy array of the toolkit indices of a list of names (or one name)
+        self.check()
+        if isinstance(names,str):
+            names=[names]
+        lookup=self.maps[kind]
+        inds=np.zeros(len(names),dtype=np.int64)
+        for i in range(len(names)):
+            if names[i] not in lookup:
+                raise Exception('The ' + kind + ' ' + str(names[i]) + ' does not exist in the model')
+            inds[i]=lookup[names[i]]
+        return inds
+
+#The registry returned by GetRegistry
+_registry={'current':None}
+
+def GetRegistry():
+    #Returns the ModelRegistry of the open model. The registry is built the first 
+    #time it is needed after the model is opened, and reused until it is closed
+    registry=_registry['current']
+    if registry is None or not registry.valid():
+        registry=ModelRegistry()
+        _registry['current']=registry
+    return registry
+
+#The toolkits which the functions of this module call, set by SetBackend
+_backend={'name':'ctypes'}
+
+def SetBackend(name='ctypes'):
+    #Selects the simulation engine called by every function of this module
+    #'ctypes': the EPANET and EPANET MSX libraries, through epanet_toolkit and msx_toolkit
+    #'standin': standin_toolkit, a deterministic numpy model of the network which
+    #needs no libraries, for running and profiling the functions of this module on
+    #any machine. Its results are not those of EPANET MSX (see standin_toolkit)
+    #Any open model is left open in the previous backend, so close it first
+    #The backend is passed on to the workers of RunParallel and RunParallelToStore
+    global epa, msx
+    if name=='ctypes':
+        import epanet_toolkit as epa
+        import msx_toolkit as msx
+    elif name=='standin':
+        import standin_toolkit as epa
+        msx=epa
+    else:
+        raise Exception('Unknown backend ' + str(name) + ', use ctypes or standin')
+    _backend['name']=name
+    _registry['current']=None
+
+def GetBackend():
+    #Returns the name of the backend selected by SetBackend
+    return _backend['name']
+
+#The MSXPY_BACKEND environment variable selects the backend when this module is imported
+if os.environ.get('MSXPY_BACKEND','ctypes')!='ctypes':
+    SetBackend(os.environ['MSXPY_BACKEND'])
+
+class StopCriterion:
+    #Ends MSXRunQual once a species crosses a critical value, e.g. once the 
+    #monochloramine at every monitored node has decayed below 1.46 mg/L, instead of
+    #simulating the rest of the duration
+    #species: the ID of the monitored species
+    #crit_val: the critical value
+    #element_type: 'node' or 'link'
+    #elements: list of the IDs of the monitored nodes or links, or 'all'
+    #direction: 'below' if the species crosses the critical value on the way down,
+    #'above' if on the way up
+    #require: 'all' to stop at the first step when every monitored element is past
+    #the critical value, 'any' when one of them is
+    
+    #After a run, times is a Series of the time (s) each monitored element first
+    #crossed the critical value, interpolated linearly between timesteps (0 if it 
+    #started past it, NaN if it had not crossed when the run ended), and t_stop is
+    #the time the run was stopped (None if it ran for the whole duration)
+    
+    def __init__(self,species,crit_val,element_type='node',elements='all',direction='below',require='all'):
+        if direction not in ('below','above'):
+            raise Exception('The direction must be below or above')
+        if require not in ('all','any'):
+            raise Exception('require must be all or any')
+        self.species=species
+        self.crit_val=float(crit_val)
+        self.element_type=element_type
+        self.elements=elements
+        self.direction=direction
+        self.require=require
+        self._names=None
+        self.t_stop=None
+    
+    def start(self,registry=None):
+        #Called by MSXRunQualStore after MSXinit, to read the monitored elements at 
+        #time 0
+        if registry is None:
+            registry=GetRegistry()
+        names=registry.names[self.element_type] if self.elements=='all' else list(self.elements)
+        inds=registry.index(self.element_type,names)
+        location_type=0 if self.element_type=='node' else 1
+        self._reader=msx.MSXqualreader(location_type,inds,registry.index('species',[self.species]))
+        self._sign=-1. if self.direction=='below' else 1.
+        self._crossed=np.full(len(inds),np.nan)
+        self._previous=self._reader.read()[:,0].copy()
+        self._t_previous=0
+        self._crossed[self._past(self._previous)]=0
+        self._names=list(names)
+        self.t_stop=None
+    
+    @property
+    def times(self):
+        if self._names is None:
+            return None
+        return pd.Series(self._crossed.copy(),index=self._names,name='crossing_time')
+    
+    def _past(self,values):
+        return self._sign*(values-self.crit_val)>0
+    
+    def check(self,t):
+        #Reads the monitored elements at time t (s), records the new crossings and
+        #returns True if the run should stop
+        values=self._reader.read()[:,0]
+        past=self._past(values)
+        new=past&np.isnan(self._crossed)
+        if new.any():
+            #Fraction of the timestep at which the species reached the critical value
+            before=self._previous[new]
+            change=values[new]-before
+            frac=np.divide(self.crit_val-before,change,out=np.ones(len(change)),where=change!=0)
+            self._crossed[new]=self._t_previous+np.clip(frac,0,1)*(t-self._t_previous)
+        self._previous[:]=values
+        self._t_previous=t
+        stop=past.all() if self.require=='all' else past.any()
+        if stop:
+            self.t_stop=t
+        return bool(stop)
+
 def TimeToCriticalValue(results,element_type='node',element='1',species='cNH2CL',crit_val=1.46):
     #As currently written, assumes results are NOT by species and that the 
     #critical value is decreasing, finding the value on the way down
@@ -417,40 +847,101 @@ def TimeToCriticalValueSeries(chlor,crit_val=1.46):
     t_crit=np.max(chlor.index)
     return t_crit
 
-def GetConstants(con_get):
+def TimeToCriticalValueArray(values,times,crit_val=1.46,direction='below'):
+    #Times at which a species crosses critical values, for every run and element at
+    #once, e.g. for the results of RunResultStore.get of one species
+    #values: array of shape (runs, time, elements)
+    #times: array of the times of the values
+    #crit_val: a critical value, or a list of several
+    #direction: 'below' for crossings on the way down, 'above' for crossings on the
+    #way up, or a list with one direction for each critical value
+    
+    #Returns the arrays first and last of shape (runs, elements), or 
+    #(critical values, runs, elements) if crit_val is a list, with the times of the
+    #first and last crossing, interpolated linearly between the timesteps. An element
+    #which is already past the critical value at the first time crosses at that
+    #time, and one which never crosses is NaN
+    #Unlike TimeToCriticalValue, the species does not have to decrease steadily
+    
+    values=np.asarray(values)
+    times=np.asarray(times,dtype=np.float64)
+    crit_vals=np.atleast_1d(np.asarray(crit_val,dtype=np.float64))
+    if isinstance(direction,str):
+        direction=[direction]*len(crit_vals)
+    if len(direction)!=len(crit_vals):
+        raise Exception('The number of directions does not match the number of critical values')
+    if values.ndim!=3 or values.shape[1]!=len(times):
+        raise Exception('The values must have the shape (runs, time, elements)')
+    
+    n_runs,n_times,n_elements=values.shape
+    first=np.full((len(crit_vals),n_runs,n_elements),np.nan)
+    last=np.full((len(crit_vals),n_runs,n_elements),np.nan)
+    runs=np.arange(n_runs)[:,np.newaxis]
+    elements=np.arange(n_elements)[np.newaxis,:]
+    
+    for k,(crit,way) in enumerate(zip(crit_vals,direction)):
+        if way=='below':
+            past=values<crit
+        elif way=='above':
+            past=values>crit
+        else:
+            raise Exception('The direction must be below or above')
+        
+        #Crossings between timestep i and i+1, and the elements past it at the start
+        crossing=past[:,1:,:]&~past[:,:-1,:]
+        at_start=past[:,0,:]
+        crossed=crossing.any(axis=1)
+        
+        for out,i in ((first,np.argmax(crossing,axis=1)),
+                      (last,n_times-2-np.argmax(crossing[:,::-1,:],axis=1))):
+            i=np.maximum(i,0)
+            v0=values[runs,i,elements]
+            v1=values[runs,np.minimum(i+1,n_times-1),elements]
+            change=v1-v0
+            frac=np.divide(crit-v0,change,out=np.zeros(change.shape),where=change!=0)
+            t=times[i]+frac*(times[np.minimum(i+1,n_times-1)]-times[i])
+            out[k]=np.where(crossed,t,np.nan)
+        first[k]=np.where(at_start,times[0],first[k])
+        last[k]=np.where(at_start&~crossed,times[0],last[k])
+    
+    if np.ndim(crit_val)==0:
+        return first[0],last[0]
+    return first,last
+
+def GetConstants(con_get,registry=None):
     #Returns a numpy array with the constants of a model
+    #registry is the ModelRegistry used to find the indices, GetRegistry() if None
+    
+    if registry is None:
+        registry=GetRegistry()
          
     #Get the indicies of the constants of interest
-    inds=[]
-    for i in range(len(con_get)):
-        inds.append(msx.MSXgetindex(6,con_get[i]))
+    inds=registry.index('constant',con_get).tolist()
     
     #Make an array holding the initial value for each constant
     constants=np.zeros((len(inds),1))
     #Populate that array with the initial value of each constant
     #IMPORTANT: Requires that the input vector is the indicies starting from 1
-    #not starting from 0 which is done in the previous for loop
+    #not starting from 0 which is done by the registry
     for i in range(len(inds)):
         constants[i] = msx.MSXgetconstant(inds[i])
         
     return constants
 
-def GetInitialConcentration(node,species):
+def GetInitialConcentration(node,species,registry=None):
     #Inputs: Nodes of interest and species of interest
     #The node input is the ID of the node not the index number
     #Returns a numpy array with the initial concentration of the specified
     #Species at the specified node
     
+    if registry is None:
+        registry=GetRegistry()
     
     #Get the index of the specified node
-    node_ind=epa.ENgetnodeindex(node)
+    node_ind=int(registry.index('node',node)[0])
         
-        
-    #Get the indicies of the species of interest
-    inds=[]
     #Get the indicies of the species of interest
-    for i in range(len(species)):
-        inds.append(msx.MSXgetindex(3,species[i]))
+    inds=registry.index('species',species).tolist()
     
     #Make an array holding the initial value for each species
     initial_con=np.zeros((len(inds),1))
@@ -463,208 +954,432 @@ def GetInitialConcentration(node,species):
     return initial_con
 
         
-def SetConstants(con_get,given_constants):
+def SetConstants(con_get,given_constants,registry=None):
     #Set constants to specific values
     #con_get is a list with the IDs of the constants to be varied
     #given_constants is a numpy array of the values of the constants to be changed
     #the order of IDs in con_get must be the same as the order of the values in
     #given_constants
+    #registry is the ModelRegistry used to find the indices, GetRegistry() if None
+    
+    if registry is None:
+        registry=GetRegistry()
          
     #Get the indicies of the constants of interest
-    inds=[]
-    for i in range(len(con_get)):
-        inds.append(msx.MSXgetindex(6,con_get[i]))
+    inds=registry.index('constant',con_get)
     
-    #Populate that array with the initial value of each constant
-    for i in range(len(inds)):
-        msx.MSXsetconstant(inds[i],given_constants[i])
+    given_constants=np.asarray(given_constants,dtype=np.float64).ravel()
+    if (len(inds)!=len(given_constants)):
+        raise Exception('The length of constant IDs list and constant value array are not equal')
+    
+    #Set the value of each constant in one batch
+    _RecordChange('constant',inds)
+    msx.MSXsetconstants(inds,given_constants)
         
-def SetInitialConcentration(node,species,init_val):
+def SetInitialConcentration(node,species,init_val,registry=None):
     #Inputs: Nodes of interest and species of interest, and vector of species values
     #The node input is the ID of the node not the index number
     
     if (len(species)!=len(init_val)):
         raise Exception('The length of species IDs  list and species value array are not equal')
     
+    if registry is None:
+        registry=GetRegistry()
+    
     #Get the index of the specified node
-    node_ind=epa.ENgetnodeindex(node)
+    node_ind=registry.index('node',node)[0]
           
     #Get the indicies of the species of interest
-    inds=[]
-    for i in range(len(species)):
-        inds.append(msx.MSXgetindex(3,species[i]))
+    inds=registry.index('species',species)
        
     #Set the species of interest to the specified values
-    for i in range(len(inds)):
-        msx.MSXsetinitqual(0,node_ind,inds[i],init_val[i])
+    _RecordChange('initqual',0,node_ind,inds)
+    msx.MSXsetinitquals(0,node_ind,inds,np.asarray(init_val,dtype=np.float64).ravel())
         
-def SetGlobalInitialConcentration(species,init_val):
+def SetGlobalInitialConcentration(species,init_val,registry=None):
     
-    
-    #Get the number of nodes in the model
-    node_num=epa.ENgetcount(0)
-    
-    #Get the number of links- 2 for links
-    link_num=epa.ENgetcount(2)
+    if registry is None:
+        registry=GetRegistry()
     
     #Get the indicies of the species of interest
-    inds=[]
-    for i in range(len(species)):
-        inds.append(msx.MSXgetindex(3,species[i]))
-       
-    #Loop through each node
-    #Set the species of interest to the specified values
-    #For each species
-    for i in range(len(inds)):
-        #For each node
-        for j in range(node_num):
-            #j+1 because epanet indicies start from 1 not 0 like python
-            msx.MSXsetinitqual(0,j+1,inds[i],init_val[i])
+    inds=registry.index('species',species)
     
-    #Loop through each species
-    #Set the species of interest to the specified values
-    #For each species
-    for i in range(len(inds)):
-        #For each link
-        for j in range(link_num):
-            #j+1 because epanet indicies start from 1 not 0 like python
-            msx.MSXsetinitqual(1,j+1,inds[i],init_val[i])
+    init_val=np.asarray(init_val,dtype=np.float64).ravel()
+    if (len(inds)!=len(init_val)):
+        raise Exception('The length of species IDs  list and species value array are not equal')
+       
+    #Set the species of interest to the specified values at every node and every
+    #link, with one batch for the nodes and one for the links
+    _RecordChange('initqual',0,registry.indices['node'][:,np.newaxis],inds[np.newaxis,:])
+    _RecordChange('initqual',1,registry.indices['link'][:,np.newaxis],inds[np.newaxis,:])
+    msx.MSXsetinitquals(0,registry.indices['node'][:,np.newaxis],inds[np.newaxis,:],init_val[np.newaxis,:])
+    msx.MSXsetinitquals(1,registry.indices['link'][:,np.newaxis],inds[np.newaxis,:],init_val[np.newaxis,:])
         
     
         
-def GetAllNodeDemands():     
+def GetAllNodeDemands(registry=None):     
     #Get the base demands for each node
-    #Get the number of nodes
-    node_num=epa.ENgetcount(0)
-    #Create a list to put the values
-    node_demands=[]
-    #Extract the demands from the model
-    for i in range(node_num):
-        node_demands.append(epa.ENgetnodevalue(i+1, 1))
-    #Turn the list into an array
-    node_demands=np.array(node_demands)
+    if registry is None:
+        registry=GetRegistry()
+    #Extract the demands from the model, 1 for base demand
+    node_demands=epa.ENgetnodevalues(registry.indices['node'],1)
     return node_demands
 
-def SetAllNodeDemands(given_demands):
+def SetAllNodeDemands(given_demands,registry=None):
+    if registry is None:
+        registry=GetRegistry()
     #Get the number of nodes
-    node_num=epa.ENgetcount(0)
+    node_num=len(registry.names['node'])
     #Raise an error if the number of demands supplied does not match the
     #number of nodes in the model
     if (node_num!=len(given_demands)):
         raise Exception('The number of demands provided dose not match the total number of nodes in the model')
     #Set the demands in the model
-    for i in range(len(given_demands)):
-        epa.ENsetnodevalue(i+1, 1, given_demands[i])
+    _RecordChange('demand',registry.indices['node'])
+    epa.ENsetnodevalues(registry.indices['node'],1,given_demands)
         
-def SetNodeDemands(nodes,given_demands):
+def SetNodeDemands(nodes,given_demands,registry=None):
     #Set baseline demands in specific nodes
-    for i in range(len(nodes)):
-        epa.ENsetnodevalue(epa.ENgetnodeindex(nodes[i]), 1, given_demands[i])
+    #registry is the ModelRegistry used to find the indices, GetRegistry() if None
+    if registry is None:
+        registry=GetRegistry()
+    inds=registry.index('node',nodes)
+    _RecordChange('demand',inds)
+    epa.ENsetnodevalues(inds,1,np.asarray(given_demands,dtype=np.float64).ravel()[:len(inds)])
+
+def SetParameters(element_type,elements,parameters,values,registry=None):
+    #Set reaction parameters of specific pipes (element_type 'link') or tanks
+    #(element_type 'node')
+    #elements is a list of the IDs of the links or nodes, or 'all'
+    #parameters is a list of the IDs of the parameters
+    #values is an array of shape (elements x parameters), or any array which can be
+    #broadcast to that shape, e.g. one value for each parameter
+    if registry is None:
+        registry=GetRegistry()
+    if elements=='all':
+        inds=registry.indices[element_type]
+    else:
+        inds=registry.index(element_type,elements)
+    params=registry.index('parameter',parameters)
+    location_type=0 if element_type=='node' else 1
+    _RecordChange('parameter',location_type,inds[:,np.newaxis],params[np.newaxis,:])
+    msx.MSXsetparameters(location_type,inds[:,np.newaxis],params[np.newaxis,:],values)
         
-def MonochloramineSetTemp(Temp,unit,temp_cons):
-    #This function changes the temperature-dependant model constants in the 
-    #Monochloramine Decay model (found in Wahman 2018, developed by others)
+def SetSource(node,species,level,source_type=0,pattern=None,registry=None):
+    #Set the external source of a species at a node
+    #level is the baseline concentration (or mass flow rate) of the source
+    #source_type: -1 no source, 0 concentration, 1 mass booster, 2 setpoint, 3 flow
+    #paced (see msx.MSXsetsource)
+    #pattern is the ID of the msx pattern of the source, or None for no pattern
+    if registry is None:
+        registry=GetRegistry()
+    node_ind=int(registry.index('node',node)[0])
+    spe_ind=int(registry.index('species',species)[0])
+    pat_ind=0 if pattern is None else int(registry.index('pattern',pattern)[0])
+    _RecordChange('source',node_ind,spe_ind)
+    msx.MSXsetsource(node_ind,spe_ind,source_type,level,pat_ind)
+
+def SetSourcePattern(pattern,multipliers,registry=None):
+    #Replace the multipliers of an msx (source) pattern
+    if registry is None:
+        registry=GetRegistry()
+    pat_ind=int(registry.index('pattern',pattern)[0])
+    _RecordChange('pattern',pat_ind)
+    msx.MSXsetpattern(pat_ind,np.asarray(multipliers,dtype=np.float64).ravel())
+
+def SetDemandPattern(pattern,multipliers,registry=None):
+    #Replace the multipliers of an EPANET (demand) pattern. The hydraulics must be
+    #solved again for the new pattern to be used
+    if registry is None:
+        registry=GetRegistry()
+    pat_ind=int(registry.index('demand_pattern',pattern)[0])
+    _RecordChange('demand_pattern',pat_ind)
+    epa.ENsetpattern(pat_ind,np.asarray(multipliers,dtype=np.float64).ravel())
+
+#The ModelSnapshot which the setters report their changes to, set by its activate
+_snapshot={'current':None}
+
+def _RecordChange(kind,*inds):
+    #Called by the setters before they change values of the model. A snapshot of a
+    #model which has been closed is no longer used
+    snapshot=_snapshot['current']
+    if snapshot is not None:
+        if snapshot.registry.valid():
+            snapshot.record(kind,*inds)
+        else:
+            _snapshot['current']=None
+
+class ModelSnapshot:
+    #The baseline state of the open model, which is restored before each sample of a
+    #scenario batch so that the values set for one sample never leak into the next
+    #one, without opening the model again
+    
+    #The constants, the parameters and initial concentrations of every node and link
+    #and the base demands are read when the snapshot is made. The sources and the msx
+    #and demand patterns are read the first time SetSource, SetSourcePattern or 
+    #SetDemandPattern changes them, since they are rarely varied
+    
+    #While the snapshot is active, the setters of this module (SetConstants,
+    #SetInitialConcentration, SetParameters, SetNodeDemands, ...) record which values
+    #they change, and restore() writes back only those values. Values changed with
+    #the msx and epa toolkits directly are only restored by restore(full=True)
+    
+    #registry is the ModelRegistry of the model, GetRegistry() if None
+    #activate: make this the snapshot which the setters report to
     
+    def __init__(self,registry=None,activate=True):
+        if registry is None:
+            registry=GetRegistry()
+        self.registry=registry
+        n_species=len(registry.names['species'])
+        n_params=len(registry.names['parameter'])
+        
+        self.constants=np.array([msx.MSXgetconstant(i) for i in registry.indices['constant'].tolist()],dtype=np.float64)
+        #Initial concentrations and parameters of the nodes (0) and links (1), of
+        #shape (elements, species) and (elements, parameters)
+        self.initqual={}
+        self.parameters={}
+        for location_type,kind in ((0,'node'),(1,'link')):
+            inds=registry.indices[kind].tolist()
+            self.initqual[location_type]=np.array([[msx.MSXgetinitqual(location_type,i,j) for j in range(1,n_species+1)]
+                                                   for i in inds],dtype=np.float64).reshape((len(inds),n_species))
+            self.parameters[location_type]=np.array([[msx.MSXgetparameter(location_type,i,j) for j in range(1,n_params+1)]
+                                                     for i in inds],dtype=np.float64).reshape((len(inds),n_params))
+        self.demands=epa.ENgetnodevalues(registry.indices['node'],1)
+        #[type, level, pattern] of each (node, species), and the multipliers of each
+        #pattern, by toolkit index, once they have been changed
+        self.sources={}
+        self.patterns={}
+        self.demand_patterns={}
+        
+        #What has been changed since the last restore: masks of the arrays and sets of
+        #the keys of the sources and patterns
+        self._changed={'constant':np.zeros(self.constants.shape,dtype=bool),
+                       'demand':np.zeros(self.demands.shape,dtype=bool),
+                       'initqual':{t:np.zeros(a.shape,dtype=bool) for t,a in self.initqual.items()},
+                       'parameter':{t:np.zeros(a.shape,dtype=bool) for t,a in self.parameters.items()},
+                       'source':set(),'pattern':set(),'demand_pattern':set()}
+        
+        if activate:
+            self.activate()
+    
+    def activate(self):
+        _snapshot['current']=self
+    
+    def deactivate(self):
+        if _snapshot['current'] is self:
+            _snapshot['current']=None
+    
+    def record(self,kind,*inds):
+        #Marks values as changed. inds are toolkit indices (starting from 1):
+        #constant: inds; demand: node inds; initqual: location type, element inds and
+        #species inds; parameter: location type, element inds and parameter inds
+        #(broadcast against each other); source: node and species; pattern and
+        #demand_pattern: pattern
+        changed=self._changed
+        if kind in ('constant','demand'):
+            changed[kind][np.asarray(inds[0],dtype=np.int64)-1]=True
+        elif kind in ('initqual','parameter'):
+            rows,cols=np.broadcast_arrays(np.asarray(inds[1],dtype=np.int64),np.asarray(inds[2],dtype=np.int64))
+            changed[kind][inds[0]][rows-1,cols-1]=True
+        elif kind=='source':
+            key=(int(inds[0]),int(inds[1]))
+            if key not in self.sources:
+                self.sources[key]=msx.MSXgetsource(*key)
+            changed['source'].add(key)
+        elif kind=='pattern':
+            pat=int(inds[0])
+            if pat not in self.patterns:
+                self.patterns[pat]=[msx.MSXgetpatternvalue(pat,i) for i in range(1,msx.MSXgetpatternlen(pat)+1)]
+            changed['pattern'].add(pat)
+        elif kind=='demand_pattern':
+            pat=int(inds[0])
+            if pat not in self.demand_patterns:
+                self.demand_patterns[pat]=[epa.ENgetpatternvalue(pat,i) for i in range(1,epa.ENgetpatternlen(pat)+1)]
+            changed['demand_pattern'].add(pat)
+        else:
+            raise Exception('Unknown kind of model value ' + str(kind))
+    
+    def restore(self,full=False):
+        #Writes the baseline values back to the model, only the changed ones unless
+        #full is True (every value read by the snapshot). Restored demands and demand
+        #patterns are only used once the hydraulics are solved again
+        self.registry.check()
+        changed=self._changed
+        
+        mask=changed['constant']
+        if full or mask.any():
+            inds=np.arange(len(mask)) if full else np.flatnonzero(mask)
+            msx.MSXsetconstants(inds+1,self.constants[inds])
+        for location_type in (0,1):
+            for kind,base,setter in (('initqual',self.initqual,msx.MSXsetinitquals),
+                                     ('parameter',self.parameters,msx.MSXsetparameters)):
+                mask=changed[kind][location_type]
+                if full or mask.any():
+                    rows,cols=np.nonzero(np.ones(mask.shape,dtype=bool) if full else mask)
+                    setter(location_type,rows+1,cols+1,base[location_type][rows,cols])
+        
+        mask=changed['demand']
+        if full or mask.any():
+            inds=np.arange(len(mask)) if full else np.flatnonzero(mask)
+            epa.ENsetnodevalues(inds+1,1,self.demands[inds])
+        
+        for key in (self.sources if full else changed['source']):
+            msx.MSXsetsource(key[0],key[1],*self.sources[key])
+        for pat in (self.patterns if full else changed['pattern']):
+            msx.MSXsetpattern(pat,self.patterns[pat])
+        for pat in (self.demand_patterns if full else changed['demand_pattern']):
+            epa.ENsetpattern(pat,self.demand_patterns[pat])
+        
+        for kind in ('constant','demand'):
+            changed[kind][:]=False
+        for kind in ('initqual','parameter'):
+            for mask in changed[kind].values():
+                mask[:]=False
+        for kind in ('source','pattern','demand_pattern'):
+            changed[kind].clear()
+
+def RunScenarios(set_func,param_values,run_kwargs=None,snapshot=None,resolve_hydraulics=False):
+    #Evaluate the open model for each row of param_values, restoring the baseline
+    #state of the model (see ModelSnapshot) before each one, instead of opening the
+    #model again for each row. The hydraulics must already be solved
+    #set_func: function which takes one row of param_values and sets the values in the
+    #model with the setters of this module
+    #run_kwargs: dictionary of the inputs to MSXRunQual for each evaluation
+    #snapshot: the ModelSnapshot of the baseline, made from the current state of the
+    #model if None
+    #resolve_hydraulics: solve the hydraulics again after set_func in every evaluation
+    #Returns a list with the results of MSXRunQual for each row, and leaves the
+    #model in its baseline state
+    if run_kwargs is None:
+        run_kwargs={}
+    if snapshot is None:
+        snapshot=ModelSnapshot()
+    else:
+        snapshot.activate()
+    results=[]
+    try:
+        for param_row in param_values:
+            snapshot.restore()
+            set_func(param_row)
+            if resolve_hydraulics:
+                msx.MSXsolveH()
+            results.append(MSXRunQual(**run_kwargs))
+    finally:
+        snapshot.restore()
+        snapshot.deactivate()
+        #The hydraulics of the baseline
+        if resolve_hydraulics:
+            msx.MSXsolveH()
+    return results
+
+#Temperature-dependant constants of the Monochloramine Decay model (Wahman 2018)
+#Arrhenius constants A*exp(-E/T), as (A, E)
+_wahman_arrhenius={'k1':(6.6e8,1510),'k2':(1.38e8,8800),'k3':(3.0e5,2010),
+                   'AC1':(1.05e7,2169),'AC2':(8.19e6,4026),'AC3':(4.2e31,22144)}
+#Equilibrium constants 10**-(a*T**2+b*T+c), as (a, b, c)
+_wahman_pka={'KNH4':(1.03e-4,-9.21e-2,27.6),'KHOCL':(1.18e-4,-7.86e-2,20.5),
+             'KH2CO3':(1.48e-4,-9.39e-2,21.2),'KHCO3':(1.19e-4,-7.99e-2,23.6),
+             'KW':(1.5e-4,-1.23e-1,37.3)}
+
+#Every constant is written as exp(c0 + c1/T + c2*T + c3*T**2), with T in Kelvin, so 
+#that all of them are evaluated over all temperatures with one matrix product
+_wahman_names=list(_wahman_arrhenius)+list(_wahman_pka)
+_wahman_table=np.array([[np.log(A),-E,0.,0.] for A,E in _wahman_arrhenius.values()]+
+                       [[-c*np.log(10),0.,-b*np.log(10),-a*np.log(10)] for a,b,c in _wahman_pka.values()])
+
+def TempToKelvin(Temp,unit):
+    #Converts temperatures (a number or an array) in F, C or K to Kelvin
     if unit=='F':
-        #Convert to Kelvin
-        Temp_k=(Temp-32)*(5/9)+273.15
+        return (np.asarray(Temp,dtype=np.float64)-32)*(5/9)+273.15
     if unit=='C':
-        #Convert to Kelvin
-        Temp_k=Temp+273.15
+        return np.asarray(Temp,dtype=np.float64)+273.15
     if unit=='K':
-        #It already is in Kelvin but change the variable name
-        Temp_k=Temp
-        
-    #Set constants based on the temperature
+        return np.asarray(Temp,dtype=np.float64)
+    raise Exception('The unit of the temperature must be F, C or K')
+
+def MonochloramineTempConstants(Temp,unit,temp_cons=None):
+    #Returns the temperature-dependant constants of the Monochloramine Decay model 
+    #(Wahman 2018) as an array of shape (temperatures, constants)
+    #Temp is a number or an array of temperatures in unit (F, C or K) 
+    #temp_cons is a list of the constants, all of them (k1, k2, k3, AC1, AC2, AC3,
+    #KNH4, KHOCL, KH2CO3, KHCO3, KW) if None
+    #The rows can be set with SetConstants(temp_cons,row), and the columns passed to
+    #batch_toolkit.BatchReactor.run as constants=dict(zip(temp_cons,matrix.T))
+    if temp_cons is None:
+        temp_cons=_wahman_names
+    cols=[]
+    for con in temp_cons:
+        if con not in _wahman_names:
+            raise Exception('One of the supplied constant names does not exist in the model')
+        cols.append(_wahman_names.index(con))
+    coefs=_wahman_table[cols]
     
-    #Create a list of the acceptable constants to be varied
-    temp_cons_acceptable=['k1','k2','k3','AC1','AC2','AC3','KNH4','KHOCL','KH2CO3','KHCO3','KW']
+    Temp_k=TempToKelvin(Temp,unit).ravel()
+    powers=np.stack((np.ones_like(Temp_k),1/Temp_k,Temp_k,Temp_k**2),axis=1)
+    out=powers@coefs.T
+    return np.exp(out,out=out)
+
+def MonochloramineSetTemp(Temp,unit,temp_cons,registry=None):
+    #This function changes the temperature-dependant model constants in the 
+    #Monochloramine Decay model (found in Wahman 2018, developed by others)
+    #temp_cons is a list of the constants to set, from k1, k2, k3, AC1, AC2, AC3,
+    #KNH4, KHOCL, KH2CO3, KHCO3 and KW
+    #registry is the ModelRegistry used to find the indices, GetRegistry() if None
     
-    #Check to make sure the constants supplied are in that list
-    for k in range(len(temp_cons)):
-        if temp_cons[k] not in temp_cons_acceptable:
-            raise Exception('One of the supplied constant names does not exist in the model')
-        
-    #Create a list which is the same length as temp_cons
-    temp_con_val_list=[None]*len(temp_cons)
-    
-    #Loop through each value of temp_cons and populate temp_con_val_list
-    for i in range(len(temp_cons)):
-    
-    #Formule for each temperature-dependant constant are found in Wahman 2018
-        
-        if temp_cons[i]=='k1':
-            temp_con_val_list[i]=6.6*10**8*np.exp(-1510/Temp_k)
-        if temp_cons[i]=='k2':
-            temp_con_val_list[i]=1.38*10**8*np.exp(-8800/Temp_k)
-        if temp_cons[i]=='k3':
-            temp_con_val_list[i]=3.0*10**5*np.exp(-2010/Temp_k)
-        if temp_cons[i]=='AC1':
-            temp_con_val_list[i]=1.05*10**7*np.exp(-2169/Temp_k)
-        if temp_cons[i]=='AC2':
-            temp_con_val_list[i]=8.19*10**6*np.exp(-4026/Temp_k)
-        if temp_cons[i]=='AC3':
-            temp_con_val_list[i]=4.2*10**31*np.exp(-22144/Temp_k)
-        if temp_cons[i]=='KNH4':
-            temp_con_val_list[i]=10**-(1.03*10**-4*Temp_k**2-9.21*10**-2*Temp_k+27.6)
-        if temp_cons[i]=='KHOCL':
-            temp_con_val_list[i]=10**-(1.18*10**-4*Temp_k**2-7.86*10**-2*Temp_k+20.5)
-        if temp_cons[i]=='KH2CO3':
-            temp_con_val_list[i]=10**-(1.48*10**-4*Temp_k**2-9.39*10**-2*Temp_k+21.2)
-        if temp_cons[i]=='KHCO3':
-            temp_con_val_list[i]=10**-(1.19*10**-4*Temp_k**2-7.99*10**-2*Temp_k+23.6)
-        if temp_cons[i]=='KW':
-            temp_con_val_list[i]=10**-(1.5*10**-4*Temp_k**2-1.23*10**-1*Temp_k+37.3)
-        
-    #Take the individual values and put them in an array   
-    temp_con_vals=np.array(temp_con_val_list)
-    
-    #Set the constants in the model
-    SetConstants(temp_cons,temp_con_vals)
+    temp_con_vals=MonochloramineTempConstants(Temp,unit,temp_cons)[0]
+    
+    #Set the constants in the model in one batch
+    SetConstants(temp_cons,temp_con_vals,registry)
+
+class ConstantSchedule:
+    #Values of model constants which change during a simulation. MSXRunQual sets the
+    #values of each row at the start of the first timestep at or after its time, so 
+    #the times should be multiples of the msx timestep
+    #times: time (s) from which each row of values applies, increasing
+    #con_names: the IDs of the constants
+    #values: array of shape (times, constants)
+    #period: if given, the schedule repeats every period seconds (e.g. 86400 for a
+    #daily profile). Otherwise the constants keep their values in the model before
+    #the first time, and the values of the last row after the last time
+    
+    def __init__(self,times,con_names,values,period=None):
+        self.times=np.asarray(times,dtype=np.float64).ravel()
+        self.con_names=list(con_names)
+        self.values=np.asarray(values,dtype=np.float64).reshape((len(self.times),len(self.con_names)))
+        self.period=period
+        if np.any(np.diff(self.times)<=0):
+            raise Exception('The times of the schedule must be increasing')
+        if period is not None and (self.times[0]<0 or self.times[-1]>=period):
+            raise Exception('The times of a periodic schedule must be within one period')
+    
+    def row(self,t):
+        #Index of the row of values which applies at time t (s), -1 before the first
+        #time of a schedule which does not repeat
+        if self.period is not None:
+            return int(np.searchsorted(self.times,t%self.period,side='right')-1)%len(self.times)
+        return int(np.searchsorted(self.times,t,side='right')-1)
+
+def MonochloramineTempSchedule(times,Temp,unit,temp_cons=None,period=None):
+    #Returns the ConstantSchedule of the temperature-dependant constants of the
+    #Monochloramine Decay model for a profile of temperatures
+    #times: time (s) from which each temperature applies
+    #Temp: the temperature at each time, in unit (F, C or K)
+    #temp_cons: the constants to change, all of them if None (see 
+    #MonochloramineTempConstants)
+    #period: see ConstantSchedule, e.g. 86400 for a diurnal profile
+    #The values of every row are computed at once, before the simulation
+    if temp_cons is None:
+        temp_cons=_wahman_names
+    return ConstantSchedule(times,temp_cons,MonochloramineTempConstants(Temp,unit,temp_cons),period)
 
 def MonochloramineGetTempCon(Temp,unit,con):
-    #This function changes the temperature-dependant model constants in the 
+    #This function returns a temperature-dependant model constant of the 
     #Monochloramine Decay model (found in Wahman 2018, developed by others)
     
     #Input a vector of temperatures and get a vector of the desired constant
-    
-    if unit=='F':
-        #Convert to Kelvin
-        Temp_k=(Temp-32)*(5/9)+273.15
-    if unit=='C':
-        #Convert to Kelvin
-        Temp_k=Temp+273.15
-    if unit=='K':
-        #It already is in Kelvin but change the variable name
-        Temp_k=Temp
-        
-    #Set constants based on the temperature
-    
-    #Formule for each temperature-dependant constant are found in Wahman 2018
-    if con=='k1':
-        out=6.6*10**8*np.exp(-1510/Temp_k)
-    if con=='k2':
-        out=1.38*10**8*np.exp(-8800/Temp_k)
-    if con=='k3':
-        out=3.0*10**5*np.exp(-2010/Temp_k)
-    if con=='AC1':
-        out=1.05*10**7*np.exp(-2169/Temp_k)
-    if con=='AC2':
-        out=8.19*10**6*np.exp(-4026/Temp_k)
-    if con=='AC3':
-        out=4.2*10**31*np.exp(-22144/Temp_k)
-    if con=='KNH4':
-        out=10**-(1.03*10**-4*Temp_k**2-9.21*10**-2*Temp_k+27.6)
-    if con=='KHOCL':
-        out=10**-(1.18*10**-4*Temp_k**2-7.86*10**-2*Temp_k+20.5)
-    if con=='KH2CO3':
-        out=10**-(1.48*10**-4*Temp_k**2-9.39*10**-2*Temp_k+21.2)
-    if con=='KHCO3':
-        out=10**-(1.19*10**-4*Temp_k**2-7.99*10**-2*Temp_k+23.6)
-    if con=='KW':
-        out=10**-(1.5*10**-4*Temp_k**2-1.23*10**-1*Temp_k+37.3)
-    
-    return out
+    out=MonochloramineTempConstants(Temp,unit,[con])[:,0]
+    return out.reshape(np.shape(Temp))[()]
 
 def GenerateNormal(problem,n_sims):
     #Takes a problem (defined by the SALib package) and generates parameters for 
@@ -694,6 +1409,8 @@ def ScaleMatrixAll(X):
         return (X - X.min()) / (X.max() - X.min())
     
 def KMeansBestNum(scaled_2d,clust_num_test=10):
+        from sklearn.cluster import KMeans
+        from sklearn.metrics import silhouette_score
         #Find best number of kmeans clusters
         sil=[None]*(clust_num_test-1)
         random_state=170
@@ -711,6 +1428,7 @@ def KMeansBestNum(scaled_2d,clust_num_test=10):
         return y_pred
     
 def Network2DPlot(network,color_var,size_var,title,nodes,min_scale=30,max_scale=80,show_inds='all'):
+    import wntr
         
     #Scale Information
     mult=max_scale-min_scale
@@ -723,6 +1441,7 @@ def Network2DPlot(network,color_var,size_var,title,nodes,min_scale=30,max_scale=
     
 
 def GenerateCorrDemands(group,n,n_samples,mean_group,corr_m):
+    from scipy.linalg import cholesky
     
     #Assuming the same standard deviation for all nodes
     std_all=np.ones((n_samples,1))*.1
@@ -765,20 +1484,274 @@ def GenerateCorrDemands(group,n,n_samples,mean_group,corr_m):
     corr_data=corr_data.T
     return corr_data
 
-def MorrisWallEvaluate(model_pickle,species):
+def _MorrisGroups(problem):
+    #Names of the groups of a SALib problem (the parameters if it has no groups), and
+    #the index of the group of each parameter
+    groups=problem.get('groups')
+    if groups is None:
+        groups=problem['names']
+    group_names=list(dict.fromkeys(groups))
+    return group_names,np.array([group_names.index(g) for g in groups],dtype=np.int64)
+
+def MorrisTrajectories(problem,N,num_levels=4,seed=None):
+    #Generates N Morris trajectories in the unit hypercube, all at once, with the 
+    #same design as SALib.sample.morris.sample: each trajectory starts at a random 
+    #point of the grid and moves one group of parameters by delta at each step, in a
+    #random order and direction
+    #Returns an array of shape (N, groups+1, parameters)
+    rng=np.random.default_rng(seed)
+    num_vars=problem['num_vars']
+    group_names,group_ind=_MorrisGroups(problem)
+    num_groups=len(group_names)
+    
+    delta=num_levels/(2.0*(num_levels-1))
+    grid=np.linspace(0,1-delta,int(num_levels/2))
+    x_star=rng.choice(grid,(N,num_vars))
+    direction=rng.choice([-1.,1.],(N,num_vars))
+    
+    #Step at which each group, and so each of its parameters, changes
+    step=np.argsort(rng.random((N,num_groups)),axis=1).argsort(axis=1)[:,group_ind]
+    changed=np.arange(num_groups+1)[np.newaxis,:,np.newaxis]>step[:,np.newaxis,:]
+    
+    #A parameter moving up starts at x_star and one moving down at x_star + delta
+    return x_star[:,np.newaxis,:]+delta/2*(np.where(changed,1.,-1.)*direction[:,np.newaxis,:]+1)
+
+def MorrisDistances(trajectories,processes=None):
+    #Distance between each pair of trajectories, the sum of the distances between
+    #each point of one and each point of the other (Campolongo et al. 2007)
+    #trajectories: array of shape (N, points, parameters)
+    #processes: number of threads the blocks of the distance matrix are computed
+    #with, 85% of the available cores by default
+    #Returns an array of shape (N, N)
+    from concurrent.futures import ThreadPoolExecutor
+    
+    n_traj,n_points,num_vars=trajectories.shape
+    points=np.ascontiguousarray(trajectories.reshape((-1,num_vars)),dtype=np.float64)
+    sq=(points**2).sum(axis=1)
+    distances=np.zeros((n_traj,n_traj))
+    
+    #Blocks of trajectories whose point distances hold about 2 million values
+    block=max(1,int(2e6//(n_points*n_points*n_traj)))
+    
+    def compute(start):
+        end=min(start+block,n_traj)
+        rows=slice(start*n_points,end*n_points)
+        d=sq[rows,np.newaxis]+sq[np.newaxis,:]-2*points[rows]@points.T
+        np.maximum(d,0,out=d)
+        np.sqrt(d,out=d)
+        distances[start:end]=d.reshape((end-start,n_points,n_traj,n_points)).sum(axis=(1,3))
+    
+    if processes is None:
+        processes=int(np.round(mp.cpu_count()*.85,0))
+    with ThreadPoolExecutor(max_workers=max(1,processes)) as pool:
+        list(pool.map(compute,range(0,n_traj,block)))
+    return distances
+
+def MorrisOptimalTrajectories(distances,r,max_swaps=1000):
+    #Indices of r trajectories with a large spread, the sum of the squared distances
+    #between each pair of them, which the brute force search of SALib maximizes
+    #Trajectories are added greedily starting from the two furthest apart, and then
+    #single swaps of a selected and an unselected trajectory are made while they
+    #increase the spread
+    n_traj=distances.shape[0]
+    if not 2<=r<=n_traj:
+        raise Exception('The number of optimal trajectories must be between 2 and the number of trajectories')
+    d2=distances**2
+    
+    first,second=np.unravel_index(np.argmax(d2),d2.shape)
+    selected=[int(first),int(second)]
+    while len(selected)<r:
+        score=d2[:,selected].sum(axis=1)
+        score[selected]=-np.inf
+        selected.append(int(np.argmax(score)))
+    
+    selected=np.array(selected)
+    for i in range(max_swaps):
+        #Spread with each trajectory in place of each selected one, relative to the
+        #current spread
+        contribution=d2[:,selected]
+        without=contribution.sum(axis=1)[:,np.newaxis]-contribution
+        gain=without-without[selected,np.arange(r)][np.newaxis,:]
+        gain[selected]=-np.inf
+        c,a=np.unravel_index(np.argmax(gain),gain.shape)
+        if gain[c,a]<=1e-12*max(1,without[selected[a],a]):
+            break
+        selected[a]=c
+    return np.sort(selected)
+
+def MorrisSample(problem,N,num_levels=4,optimal_trajectories=None,seed=None,processes=None,
+                 cache_dir='Morris_Designs'):
+    #Morris samples in the same format as SALib.sample.morris.sample (and with the
+    #same inputs), which MorrisElementaryEffects and MorrisWallEvaluate evaluate
+    #The N trajectories are generated by MorrisTrajectories and, if 
+    #optimal_trajectories is given, that many of them are selected with
+    #MorrisDistances and MorrisOptimalTrajectories instead of a brute force search.
+    #The random numbers differ from those of SALib, so the samples are not the same
+    
+    #processes: number of threads the distances are computed with
+    #cache_dir: the designs with a seed are saved in this directory, named by a hash
+    #of the problem, N, num_levels, optimal_trajectories and seed, and read back the
+    #next time they are needed. None to not use the cache
+    
+    #Returns an array of shape (trajectories*(groups+1), parameters)
+    
+    cache_file=None
+    if cache_dir is not None and seed is not None:
+        key=hashlib.sha1(json.dumps([list(problem['names']),np.asarray(problem['bounds'],dtype=np.float64).tolist(),
+                                     problem.get('groups'),N,num_levels,optimal_trajectories,seed]).encode())
+        cache_file=os.path.join(cache_dir,'morris_'+key.hexdigest()[:20]+'.npy')
+        if os.path.isfile(cache_file):
+            return np.load(cache_file)
+    
+    trajectories=MorrisTrajectories(problem,N,num_levels,seed)
+    if optimal_trajectories is not None:
+        selected=MorrisOptimalTrajectories(MorrisDistances(trajectories,processes),optimal_trajectories)
+        trajectories=trajectories[selected]
+    
+    bounds=np.asarray(problem['bounds'],dtype=np.float64)
+    sample=trajectories.reshape((-1,problem['num_vars']))*(bounds[:,1]-bounds[:,0])+bounds[:,0]
+    
+    if cache_file is not None:
+        #Written under a temporary name and then renamed so other processes never
+        #read a partial file
+        os.makedirs(cache_dir,exist_ok=True)
+        tmp_file=cache_file+'.'+str(os.getpid())+'.tmp.npy'
+        np.save(tmp_file,sample)
+        os.replace(tmp_file,cache_file)
+    return sample
+
+def MorrisElementaryEffects(problem,param_values,outputs,num_levels=4):
+    #Compute the Morris mu, mu_star and sigma of every parameter for many model 
+    #outputs at once, with the same results as SALib.analyze.morris.analyze 
+    #(without the bootstrapped mu_star_conf, and without the scaled option)
+    
+    #problem: SALib problem dictionary (groups are supported)
+    #param_values: the (runs x parameters) matrix from SALib.sample.morris.sample
+    #outputs: array of the model results of shape (runs,) or (runs x outputs)
+    #num_levels: the number of grid levels used by SALib.sample.morris.sample
+    
+    #Returns a dictionary with the names of the parameters (or groups), and mu, 
+    #mu_star and sigma arrays of shape (outputs x parameters), or (parameters,) if
+    #outputs is 1 dimensional
+    
+    X=np.asarray(param_values,dtype=np.float64)
+    Y=np.asarray(outputs,dtype=np.float64)
+    one_output=Y.ndim==1
+    Y=Y.reshape((Y.shape[0],-1))
+    
+    num_vars=problem['num_vars']
+    groups=problem.get('groups')
+    if groups is None:
+        groups=problem['names']
+    group_names=list(dict.fromkeys(groups))
+    
+    #The runs are organized as trajectories of num_groups+1 points, where one 
+    #group of parameters changes between each pair of points
+    traj_size=len(group_names)+1
+    n_traj=X.shape[0]//traj_size
+    if n_traj*traj_size!=X.shape[0] or Y.shape[0]!=X.shape[0]:
+        raise Exception('The number of runs must be the same in param_values and outputs, ' +
+                        'and a multiple of the number of groups + 1')
+    
+    delta=num_levels/(2.0*(num_levels-1))
+    
+    #Direction that each parameter changed at each step of each trajectory
+    X=X.reshape((n_traj,traj_size,num_vars))
+    direction=np.sign(X[:,1:,:]-X[:,:-1,:])
+    
+    #Change of each output at each step of each trajectory
+    Y=Y.reshape((n_traj,traj_size,-1))
+    dY=Y[:,1:,:]-Y[:,:-1,:]
+    
+    #Elementary effects of shape (outputs, parameters, trajectories)
+    ee=np.einsum('tkv,tko->ovt',direction,dY)/delta
+    
+    mu=ee.mean(axis=2)
+    mu_star=np.abs(ee).mean(axis=2)
+    sigma=ee.std(axis=2,ddof=1)
+    
+    if problem.get('groups') is not None:
+        #Average the metrics of the parameters in each group, sigma is only defined
+        #for groups of one parameter
+        member=np.array([[g==name for name in group_names] for g in groups],dtype=np.float64)
+        size=member.sum(axis=0)
+        mu=mu@member/size
+        mu_star=mu_star@member/size
+        sigma=np.where(size==1,sigma@member/size,np.nan)
+    
+    if one_output:
+        mu,mu_star,sigma=mu[0],mu_star[0],sigma[0]
+    
+    return {'names':group_names,'mu':mu,'mu_star':mu_star,'sigma':sigma}
 
-    results_model=model_pickle['results']
-    nodes=model_pickle['nodes']
-    links=model_pickle['links']
-    problem=model_pickle['problem']
-    param_values_model=model_pickle['param_values']
-    inp_file=model_pickle['inp_file']
+def _MorrisEvaluateChunk(problem,param_values,con_runs,age_runs=None):
+    #Compute the Morris values of a chunk of elements from their results of shape
+    #(runs, timesteps, elements)
+    #Returns the parameter names, mu_star and sigma of shape (timesteps, elements,
+    #parameters), and the mean of age_runs over the runs (None without age_runs)
+    n_runs,timesteps,n_elements=con_runs.shape
+    a=MorrisElementaryEffects(problem,param_values,con_runs.reshape((n_runs,-1)))
+    mu_star=a['mu_star'].reshape((timesteps,n_elements,-1))
+    sigma=a['sigma'].reshape((timesteps,n_elements,-1))
+    
+    age=None
+    if age_runs is not None:
+        age=age_runs.mean(axis=0)
+    return a['names'],mu_star,sigma,age
 
+def MorrisWallEvaluate(model_pickle,species,chunk_size=None):
+    #Compute the Morris mu_star and sigma of each parameter at each timestep of 
+    #each node and link, and the mean water age (AGE species) of each node and link
+    
+    #model_pickle is either the dictionary saved by the Morris run scripts (with the
+    #keys results, nodes, links, problem and param_values), a RunResultStore, or 
+    #the directory of the results written by RunParallelToStore. With a store only 
+    #the results of the elements that are being evaluated are read from disk. A store
+    #with samples that have not been run is not evaluated (see RunResultStore.check_done)
+    
+    #The Morris values of all of the timesteps of chunk_size elements are computed
+    #together by MorrisElementaryEffects. By default the chunks hold about 
+    #20 million results
     
+    if isinstance(model_pickle,str):
+        model_pickle=RunResultStore(model_pickle)
+    
+    if isinstance(model_pickle,RunResultStore):
+        store=model_pickle
+        store.check_done()
+        nodes=store.node_names
+        links=store.link_names
+        problem=store.problem
+        param_values_model=store.param_values
+        timesteps_index=pd.Index(store.times)
+        has_age='AGE' in store.species_names
+        n_runs=store.n_samples
+    else:
+        store=None
+        results_model=model_pickle['results']
+        nodes=model_pickle['nodes']
+        links=model_pickle['links']
+        problem=model_pickle['problem']
+        param_values_model=model_pickle['param_values']
+        timesteps_index=results_model[0]['node'][nodes[0]].index
+        has_age='AGE' in results_model[0]['node'][nodes[0]].columns
+        n_runs=len(results_model)
+    
+    def element_outputs(element_type,names,spe):
+        #Array of shape (runs, timesteps, elements) with the results of one species
+        if store is not None:
+            return store.get(element_type,[spe],names)[:,:,:,0]
+        out=np.zeros((n_runs,len(timesteps_index),len(names)))
+        for i in range(n_runs):
+            for l in range(len(names)):
+                out[i,:,l]=results_model[i][element_type][names[l]][spe].values
+        return out
     
     #Extract the number of timesteps for which the model was computed
-    timesteps=len(results_model[0]['node'][nodes[0]].index)
-    timesteps_index=results_model[0]['node'][nodes[0]].index
+    timesteps=len(timesteps_index)
+    
+    if chunk_size is None:
+        chunk_size=max(1,int(2e7//max(1,n_runs*timesteps)))
     
     #Create a dictionary to store the mu_star and sigma results for the model
     morris_results={}
@@ -791,86 +1764,787 @@ def MorrisWallEvaluate(model_pickle,species):
     morris_results['sigma']['node']={}
     morris_results['sigma']['link']={}
     
-    
-    
-    age_results={}
     age_mean={}
-    age_mean['node']=pd.DataFrame()
-    age_mean['link']=pd.DataFrame()
-    
-    for l in range(len(nodes)):
-        print('Evaluating Node ' + str(l+1) + ' of ' +str(len(nodes)))
-        #Compute the morris values for each parameter for each timestep of the model
-        #Create an array to store the mu_star values at each timestep
-        mu_star_timestep=np.zeros((timesteps,problem['num_vars']))
-        sigma_timestep=np.zeros((timesteps,problem['num_vars']))
-        
-        #Extract the model output results for that specific timestep
-        con_out=np.zeros((len(results_model),1))
-        for j in range(timesteps):
-            for i in range(len(results_model)):
-                con_out[i]=results_model[i]['node'][nodes[l]].loc[timesteps_index[j],species]
-            
-            #Compute morris results
-            a=morris_a.analyze(problem,param_values_model,con_out)
-            
-            mu_star_timestep[j,:]=a['mu_star']
-            sigma_timestep[j,:]=a['sigma']
-        
-        #Convert mu_star_timestep into a dataframe
-        mu_star_df=pd.DataFrame(mu_star_timestep,index=timesteps_index,columns=problem['names'])
-        sigma_df=pd.DataFrame(sigma_timestep,index=timesteps_index,columns=problem['names'])
-        
-        morris_results['mu_star']['node'][nodes[l]]=mu_star_df
-        morris_results['sigma']['node'][nodes[l]]=sigma_df
-        
-        #Loop through all of the simulation results and get the average
-        #water age for each timestep and each node
-        
-        #Create a dataframe to put the results into
-        age_results[nodes[l]]=pd.DataFrame()
-        for i in range(len(results_model)):
-            age_results[nodes[l]]['S'+str(i+1)]=results_model[i]['node'][nodes[l]]['AGE']
-        
-        age_mean['node'][nodes[l]]=age_results[nodes[l]].mean(axis=1)
-        
-    for l in range(len(links)):
-        print('Evaluating Link ' + str(l+1) + ' of ' + str(len(links)))
-        #Compute the morris values for each parameter for each timestep of the model
-        #Create an array to store the mu_star values at each timestep
-        mu_star_timestep=np.zeros((timesteps,problem['num_vars']))
-        sigma_timestep=np.zeros((timesteps,problem['num_vars']))
-        
-        #Extract the model output results for that specific timestep
-        con_out=np.zeros((len(results_model),1))
-        for j in range(timesteps):
-            for i in range(len(results_model)):
-                con_out[i]=results_model[i]['link'][links[l]].loc[timesteps_index[j],species]
+    
+    for element_type,names in (('node',nodes),('link',links)):
+        age_columns={}
+        for c in range(0,len(names),chunk_size):
+            chunk=list(names[c:c+chunk_size])
+            print('Evaluating ' + element_type.capitalize() + 's ' + str(c+1) + ' to ' + 
+                  str(c+len(chunk)) + ' of ' + str(len(names)))
             
-            #Compute morris results
-            a=morris_a.analyze(problem,param_values_model,con_out)
+            #Compute the morris values for each parameter for each timestep and 
+            #element of the chunk in one pass
+            con_runs=element_outputs(element_type,chunk,species)
+            age_runs=element_outputs(element_type,chunk,'AGE') if has_age else None
+            param_names,mu_star,sigma,age=_MorrisEvaluateChunk(problem,param_values_model,con_runs,age_runs)
             
-            mu_star_timestep[j,:]=a['mu_star']
-            sigma_timestep[j,:]=a['sigma']
+            for l in range(len(chunk)):
+                #Convert the values of each element into a dataframe
+                morris_results['mu_star'][element_type][chunk[l]]=pd.DataFrame(mu_star[:,l,:],index=timesteps_index,columns=param_names)
+                morris_results['sigma'][element_type][chunk[l]]=pd.DataFrame(sigma[:,l,:],index=timesteps_index,columns=param_names)
+                if has_age:
+                    age_columns[chunk[l]]=age[:,l]
+        
+        age_mean[element_type]=pd.DataFrame(age_columns,index=timesteps_index)
+        
+    return morris_results,age_mean
+
+
+#Number of times GetHydraulicsFile found the hydraulics in the cache, or had to 
+#solve them, the hydraulic solve time saved by the cache, and the total solve 
+#time of the hydraulics files that were returned
+_hyd_cache_stats={'hits':0,'misses':0,'time_saved':0.0,'solve_time':0.0}
+
+def GetHydraulicsFile(inp_file,days=None,cache_dir='Hydraulics_Cache'):
+    #Returns the path of a binary hydraulics file with the hydraulic results of the 
+    #model that is currently open, which can be used by any number of processes
+    #with msx.MSXusehydfile (e.g. with the hyd_file input of RunParallel)
+    
+    #inp_file is the .inp file the open model was read from
+    #days is the duration of the simulation in days, None to use the current duration
+    #cache_dir is the directory the hydraulics files are saved in. 
+    
+    #The files are named by a hash of the contents of the inp file, the hydraulic
+    #time parameters, the hydraulic options and flow units, the base demand of 
+    #every node and the values of every pattern, so the hydraulics are only 
+    #solved the first time they are needed, and reused by later scripts that use
+    #the same model and settings
+    
+    if days is not None:
+        #0 for duration
+        epa.ENsettimeparam(0,int(days*24*3600))
+    
+    #Create the key of the cache from the inp file and the hydraulic settings
+    key=hashlib.sha1()
+    with open(inp_file,'rb') as fin:
+        key.update(fin.read())
+    #0 for duration, 1 for hydraulic timestep, 3 for pattern timestep and 4 for
+    #pattern start
+    key.update(np.array([epa.ENgettimeparam(i) for i in (0,1,3,4)],dtype=np.int64).tobytes())
+    #0 to 4 for trials, accuracy, tolerance, emitter exponent and demand multiplier
+    key.update(np.array([epa.ENgetoption(i) for i in range(5)]+[epa.ENgetflowunits()],dtype=np.float64).tobytes())
+    key.update(np.asarray(GetAllNodeDemands(),dtype=np.float64).tobytes())
+    #3 for the number of patterns
+    for i in range(1,epa.ENgetcount(3)+1):
+        pattern=[epa.ENgetpatternvalue(i,j) for j in range(1,epa.ENgetpatternlen(i)+1)]
+        key.update(np.array(pattern,dtype=np.float64).tobytes())
+    key=key.hexdigest()[:20]
+    
+    os.makedirs(cache_dir,exist_ok=True)
+    hyd_file=os.path.join(cache_dir,key+'.hyd')
+    info_file=os.path.join(cache_dir,key+'.json')
+    
+    if os.path.isfile(hyd_file) and os.path.isfile(info_file):
+        with open(info_file) as fin:
+            info=json.load(fin)
+        _hyd_cache_stats['hits']+=1
+        _hyd_cache_stats['time_saved']+=info['solve_time']
+        _hyd_cache_stats['solve_time']+=info['solve_time']
+        print('Hydraulics cache hit: ' + hyd_file + ' (saved ' + str(round(info['solve_time'],3)) + ' s of hydraulic solve time)')
+        return hyd_file
+    
+    #Solve the hydraulics and save them to the cache. The files are written under
+    #temporary names and then renamed so other processes never read a partial file
+    t1=time.time()
+    epa.ENsolveH()
+    solve_time=time.time()-t1
+    
+    tmp_file=hyd_file+'.'+str(os.getpid())+'.tmp'
+    epa.ENsavehydfile(tmp_file)
+    os.replace(tmp_file,hyd_file)
+    
+    info={'inp_file':os.path.abspath(inp_file),'duration':epa.ENgettimeparam(0),
+          'hydraulic_step':epa.ENgettimeparam(1),'solve_time':solve_time}
+    with open(info_file+'.'+str(os.getpid())+'.tmp','w') as fout:
+        json.dump(info,fout)
+    os.replace(info_file+'.'+str(os.getpid())+'.tmp',info_file)
+    
+    _hyd_cache_stats['misses']+=1
+    _hyd_cache_stats['solve_time']+=solve_time
+    print('Hydraulics cache miss: solved and saved ' + hyd_file + ' in ' + str(round(solve_time,3)) + ' s')
+    return hyd_file
+
+def HydraulicsCacheReport(n_workers=0):
+    #Print and return the number of hits and misses of GetHydraulicsFile, and the
+    #hydraulic solve time that the cache saved
+    #If the hydraulics files were shared by n_workers processes (e.g. RunParallel), 
+    #the time each of the workers saved by not solving the hydraulics is included
+    report=dict(_hyd_cache_stats)
+    report['time_saved_workers']=n_workers*report['solve_time']
+    print('Hydraulics cache: ' + str(report['hits']) + ' hits, ' + str(report['misses']) + ' misses, ' +
+          str(round(report['time_saved'],3)) + ' s of hydraulic solve time saved by the cache and ' +
+          str(round(report['time_saved_workers'],3)) + ' s saved by ' + str(n_workers) + ' workers sharing the files')
+    return report
+
+#The model opened in each worker process of RunParallel, and the functions and
+#options used to evaluate it
+_worker={}
+
+def _InitWorker(inp_file,msx_file,days,set_func,run_kwargs,resolve_hydraulics,hyd_file,backend='ctypes'):
+    #Initializer of each worker process of RunParallel. The model is opened and the
+    #hydraulics are solved (or read from hyd_file) once, and then reused for every
+    #model evaluation done by the worker
+    
+    if backend!=GetBackend():
+        SetBackend(backend)
+    
+    #The epanet report of each worker is written to its own scratch directory
+    epa.ENopen(inp_file,GetScratchFile('report.rpt'))
+    msx.MSXopen(msx_file)
+    
+    if days is not None:
+        #0 for duration
+        epa.ENsettimeparam(0,int(days*24*3600))
+    
+    if hyd_file is not None:
+        msx.MSXusehydfile(hyd_file)
+    else:
+        msx.MSXsolveH()
+    
+    _worker['set_func']=set_func
+    _worker['run_kwargs']=run_kwargs
+    _worker['resolve_hydraulics']=resolve_hydraulics
+    #The names are sent with the first result of each worker. A forked worker
+    #inherits the state of the previous run of its parent, so it is reset here
+    _worker['names_sent']=False
+    #The baseline which is restored before every model evaluation, so that each one
+    #starts from the state of the model files
+    _worker['snapshot']=ModelSnapshot()
+
+def _EvaluateWorker(param_row):
+    #Evaluate the model for one row of parameter values in a worker process
+    _worker['snapshot'].restore()
+    _worker['set_func'](param_row)
+    
+    #Only solve the hydraulics again if hydraulic parameters are varied
+    if _worker['resolve_hydraulics']:
+        msx.MSXsolveH()
+    
+    return MSXRunQual(**_worker['run_kwargs'])
+
+def RunParallel(set_func,param_values,inp_file,msx_file,days=None,run_kwargs=None,
+                problem=None,hydraulic_vars=None,hyd_file=None,processes=None,start_method='forkserver'):
+    #Evaluate a model for each row of param_values using a pool of processes
+    #Each worker opens the inp and msx files and solves the hydraulics once, when it
+    #starts, instead of once for every model evaluation
+    
+    #set_func: function which takes one row of param_values and sets the values in the
+    #model (e.g. with SetConstants and SetInitialConcentration). It must be defined at
+    #the top level of a module so it can be sent to the workers
+    #param_values: array with one row for each model evaluation
+    #inp_file, msx_file: the .inp and .msx files of the model
+    #days: duration of the simulation in days, None to use the duration in the inp file
+    #run_kwargs: dictionary of the inputs to MSXRunQual for each evaluation
+    #problem: SALib problem dictionary. If any of its 'names' are in hydraulic_vars,
+    #the hydraulics are solved again in every evaluation after set_func is called
+    #hydraulic_vars: names of the parameters which change the hydraulics (e.g. demands)
+    #hyd_file: binary hydraulics file which all of the workers read with
+    #msx.MSXusehydfile instead of solving the hydraulics themselves (see 
+    #GetHydraulicsFile). Not used if the hydraulics are solved in every evaluation
+    #processes: number of processes, 85% of the available cores by default. If 1 
+    #the models are evaluated in serial in the current process
+    #start_method: multiprocessing start method of the pool
+    
+    #Returns a list with the results of MSXRunQual for each row of param_values
+    
+    if run_kwargs is None:
+        run_kwargs={}
+    
+    resolve_hydraulics=False
+    if problem is not None and hydraulic_vars is not None:
+        resolve_hydraulics=any(name in hydraulic_vars for name in problem['names'])
+    
+    if processes is None:
+        processes=int(np.round(mp.cpu_count()*.85,0))
+    
+    if resolve_hydraulics:
+        hyd_file=None
+    
+    initargs=(inp_file,msx_file,days,set_func,run_kwargs,resolve_hydraulics,hyd_file,GetBackend())
+    
+    if processes==1:
+        #Evaluate in serial in this process, closing any model that is already open
+        msx.MSXclose()
+        epa.ENclose()
+        try:
+            _InitWorker(*initargs)
+            results=[_EvaluateWorker(param_row) for param_row in param_values]
+        finally:
+            if 'snapshot' in _worker:
+                _worker['snapshot'].deactivate()
+            msx.MSXclose()
+            epa.ENclose()
+        return results
+    
+    pool=mp.get_context(start_method).Pool(processes=processes,initializer=_InitWorker,initargs=initargs)
+    try:
+        results=pool.map(_EvaluateWorker,param_values)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    
+    return results
+
+def _EvaluateWorkerBlock(task):
+    #Evaluate the model for one (sample index, row of parameter values) in a worker
+    #process, and return the results as a compact array instead of dataframes
+    #The names of the nodes, links and species are only returned with the first
+    #result of each worker
+    i,param_row=task
+    _worker['snapshot'].restore()
+    _worker['set_func'](param_row)
+    
+    if _worker['resolve_hydraulics']:
+        msx.MSXsolveH()
+    
+    store=MSXRunQualStore(**_worker['run_kwargs'])
+    
+    names=None
+    if not _worker.get('names_sent',False):
+        names=(store.node_names,store.link_names,store.species_names)
+        _worker['names_sent']=True
+    
+    return i,store.times[:store.n].copy(),np.ascontiguousarray(store.data[:store.n]),names
+
+class RunResultWriter:
+    #Writes the results of each model evaluation of RunParallelToStore to disk as
+    #they arrive, so that the results of all of the evaluations are never held in 
+    #memory at the same time
+    #The results are written to out_dir as:
+    #data.npy: array of shape (sample, time, element, species), where the elements
+    #are the nodes followed by the links
+    #times.npy: the simulation time of each timestep in seconds
+    #names.json: the node, link and species names
+    #done.npy: boolean array of which samples have been written
+    #meta.pkl: dictionary of information about the runs (e.g. the SALib problem and 
+    #the parameter values), if meta is given
+    #The results can be read with RunResultStore
+    
+    def __init__(self,out_dir,n_samples,dtype=np.float64,flush_every=50,meta=None):
+        self.out_dir=out_dir
+        self.n_samples=n_samples
+        self.dtype=dtype
+        self.flush_every=flush_every
+        self.data=None
+        self.names=None
+        self.done=np.zeros(n_samples,dtype=bool)
+        self._unflushed=0
+        os.makedirs(out_dir,exist_ok=True)
+        if meta is not None:
+            with open(os.path.join(out_dir,'meta.pkl'),'wb') as fout:
+                pickle.dump(meta,fout)
+    
+    def write(self,i,times,data,names=None):
+        #Write the (time, element, species) array of sample i
+        if self.data is None:
+            #The size of the file is known once the first result arrives
+            self.data=np.lib.format.open_memmap(os.path.join(self.out_dir,'data.npy'),mode='w+',
+                                                dtype=self.dtype,shape=(self.n_samples,)+data.shape)
+            np.save(os.path.join(self.out_dir,'times.npy'),times)
+        if data.shape!=self.data.shape[1:]:
+            raise Exception('The results of sample ' + str(i) + ' have shape ' + str(data.shape) +
+                            ' but the results of the other samples have shape ' + str(self.data.shape[1:]))
+        if names is not None and self.names is None:
+            self.names={'node':list(names[0]),'link':list(names[1]),'species':list(names[2])}
+            with open(os.path.join(self.out_dir,'names.json'),'w') as fout:
+                json.dump(self.names,fout)
+        
+        self.data[i]=data
+        self.done[i]=True
+        
+        self._unflushed+=1
+        if self._unflushed>=self.flush_every:
+            self.flush()
+    
+    def flush(self):
+        if self.data is not None:
+            self.data.flush()
+        np.save(os.path.join(self.out_dir,'done.npy'),self.done)
+        self._unflushed=0
+    
+    def close(self):
+        self.flush()
+        self.data=None
+
+def RunParallelToStore(set_func,param_values,out_dir,inp_file,msx_file,days=None,run_kwargs=None,
+                       problem=None,hydraulic_vars=None,hyd_file=None,processes=None,chunksize=None,
+                       start_method='forkserver',meta=None):
+    #Evaluate a model for each row of param_values using a pool of processes, like 
+    #RunParallel, but write the results to out_dir as each evaluation finishes
+    #(see RunResultWriter) instead of returning all of them at the end
+    
+    #Each worker returns its results as one (time, element, species) array instead 
+    #of a dictionary of dataframes, and the results are written in the order they 
+    #finish, so the memory of the main process does not grow with the number of 
+    #samples
+    
+    #run_kwargs: dictionary of the inputs to MSXRunQualStore (species, nodes, links, 
+    #t_start and dtype) for each evaluation
+    #chunksize: number of samples sent to a worker at a time. By default the samples
+    #are split into about 8 chunks per worker
+    #meta: dictionary saved with the results, which is read by RunResultStore. The 
+    #problem, param_values and inp_file are added to it, so the results can be 
+    #evaluated with MorrisWallEvaluate
+    #The other inputs are the same as RunParallel
+    
+    #Returns out_dir
+    
+    if run_kwargs is None:
+        run_kwargs={}
+    
+    resolve_hydraulics=False
+    if problem is not None and hydraulic_vars is not None:
+        resolve_hydraulics=any(name in hydraulic_vars for name in problem['names'])
+    
+    if resolve_hydraulics:
+        hyd_file=None
+    
+    if processes is None:
+        processes=int(np.round(mp.cpu_count()*.85,0))
+    
+    if chunksize is None:
+        chunksize=max(1,len(param_values)//(processes*8))
+    
+    meta=dict(meta) if meta is not None else {}
+    meta.setdefault('problem',problem)
+    meta.setdefault('param_values',np.asarray(param_values))
+    meta.setdefault('inp_file',inp_file)
+    meta.setdefault('msx_file',msx_file)
+    
+    writer=RunResultWriter(out_dir,len(param_values),dtype=run_kwargs.get('dtype',np.float64),meta=meta)
+    
+    initargs=(inp_file,msx_file,days,set_func,run_kwargs,resolve_hydraulics,hyd_file,GetBackend())
+    tasks=enumerate(param_values)
+    
+    if processes==1:
+        #Evaluate in serial in this process, closing any model that is already open
+        msx.MSXclose()
+        epa.ENclose()
+        try:
+            _InitWorker(*initargs)
+            for task in tasks:
+                writer.write(*_EvaluateWorkerBlock(task))
+        finally:
+            if 'snapshot' in _worker:
+                _worker['snapshot'].deactivate()
+            msx.MSXclose()
+            epa.ENclose()
+            writer.close()
+        return out_dir
+    
+    pool=mp.get_context(start_method).Pool(processes=processes,initializer=_InitWorker,initargs=initargs)
+    try:
+        for block in pool.imap_unordered(_EvaluateWorkerBlock,tasks,chunksize=chunksize):
+            writer.write(*block)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        writer.close()
+    
+    return out_dir
+
+class RunResultStore:
+    #Reader of the results written by RunParallelToStore (see RunResultWriter)
+    #The results are memory-mapped, so only the parts of the file that are selected
+    #with get are read from disk
+    
+    def __init__(self,path):
+        self.path=path
+        self.data=np.load(os.path.join(path,'data.npy'),mmap_mode='r')
+        self.times=np.load(os.path.join(path,'times.npy'))
+        with open(os.path.join(path,'names.json')) as fin:
+            names=json.load(fin)
+        self.node_names=names['node']
+        self.link_names=names['link']
+        self.species_names=names['species']
+        
+        done_file=os.path.join(path,'done.npy')
+        if os.path.isfile(done_file):
+            self.done=np.load(done_file)
+        else:
+            self.done=np.ones(self.data.shape[0],dtype=bool)
         
-        #Convert mu_star_timestep into a dataframe
-        mu_star_df=pd.DataFrame(mu_star_timestep,index=timesteps_index,columns=problem['names'])
-        sigma_df=pd.DataFrame(sigma_timestep,index=timesteps_index,columns=problem['names'])
+        self.meta={}
+        meta_file=os.path.join(path,'meta.pkl')
+        if os.path.isfile(meta_file):
+            with open(meta_file,'rb') as fin:
+                self.meta=pickle.load(fin)
+        self.problem=self.meta.get('problem')
+        self.param_values=self.meta.get('param_values')
         
-        morris_results['mu_star']['link'][links[l]]=mu_star_df
-        morris_results['sigma']['link'][links[l]]=sigma_df
+        self.n_samples=self.data.shape[0]
+        self._node_ind={name:j for j,name in enumerate(self.node_names)}
+        self._link_ind={name:j+len(self.node_names) for j,name in enumerate(self.link_names)}
+        self._species_ind={name:j for j,name in enumerate(self.species_names)}
+    
+    def __len__(self):
+        return self.n_samples
+    
+    def fingerprint(self):
+        #Hash which identifies the results in the store. It changes when the store is
+        #written again, without reading the whole results file
+        key=hashlib.sha1()
+        for name in ('names.json','times.npy','done.npy','meta.pkl'):
+            file=os.path.join(self.path,name)
+            if os.path.isfile(file):
+                with open(file,'rb') as fin:
+                    key.update(fin.read())
+        stat=os.stat(os.path.join(self.path,'data.npy'))
+        key.update(np.array([stat.st_size,stat.st_mtime_ns],dtype=np.int64).tobytes())
+        return key.hexdigest()[:20]
+    
+    def check_done(self,samples=None):
+        #Raises an exception if any of the samples (a list or slice of sample 
+        #indices, all of them if None) has not been written, e.g. because the run
+        #was interrupted or the sample failed. Their rows of the results are zeros
+        if samples is None:
+            samples=slice(None)
+        ind=np.arange(self.n_samples)[samples]
+        missing=np.atleast_1d(ind)[~np.atleast_1d(self.done[ind])]
+        if len(missing)>0:
+            raise Exception(str(len(missing)) + ' of the samples of ' + self.path + ' have not been run (' +
+                            ', '.join(str(i) for i in missing[:10].tolist()) + (', ...' if len(missing)>10 else '') + 
+                            '). Run RunParallelToStore again to complete them, or select the completed '
+                            'samples with samples=np.flatnonzero(store.done)')
+    
+    def _element_indices(self,element_type,elements):
+        if element_type=='node':
+            ind=self._node_ind
+            names=self.node_names
+        elif element_type=='link':
+            ind=self._link_ind
+            names=self.link_names
+        else:
+            raise Exception('element_type must be node or link')
+        if elements is None:
+            elements=names
+        elif isinstance(elements,str):
+            elements=[elements]
+        return [ind[name] for name in elements],list(elements)
+    
+    def get(self,element_type='node',species=None,elements=None,t_start=None,t_end=None,samples=None):
+        #Returns an array of shape (sample, time, element, species) with the results 
+        #of the selected species and elements between the times t_start and t_end
+        #(in seconds, inclusive), and only reads those results from the file
+        #species and elements are lists of names, all of them if None
+        #samples is a list or slice of the sample indices, all of them if None. An
+        #exception is raised if any of them has not been run (see check_done)
+        el_ind,elements=self._element_indices(element_type,elements)
+        if species is None:
+            species=self.species_names
+        elif isinstance(species,str):
+            species=[species]
+        sp_ind=[self._species_ind[name] for name in species]
+        
+        t_lo=0 if t_start is None else int(np.searchsorted(self.times,t_start,side='left'))
+        t_hi=len(self.times) if t_end is None else int(np.searchsorted(self.times,t_end,side='right'))
         
-        #Loop through all of the simulation results and get the average
-        #water age for each timestep and each node
+        if samples is None:
+            samples=slice(None)
+        self.check_done(samples)
         
-        #Create a dataframe to put the results into
-        age_results[links[l]]=pd.DataFrame()
-        for i in range(len(results_model)):
-            age_results[links[l]]['S'+str(i+1)]=results_model[i]['link'][links[l]]['AGE']
+        view=self.data[samples,t_lo:t_hi]
+        if view.ndim==3:
+            view=view[np.newaxis]
+        return np.asarray(view[:,:,el_ind][:,:,:,sp_ind])
+    
+    def get_times(self,t_start=None,t_end=None):
+        t_lo=0 if t_start is None else int(np.searchsorted(self.times,t_start,side='left'))
+        t_hi=len(self.times) if t_end is None else int(np.searchsorted(self.times,t_end,side='right'))
+        return self.times[t_lo:t_hi]
+    
+    def sample_results(self,i,by_species='no'):
+        #Returns the results of sample i as a dictionary in the same format as MSXRunQual
+        #An exception is raised if the sample has not been run
+        self.check_done([i])
+        index=pd.Index(self.times)
+        results={}
+        if by_species=='yes':
+            nodes=np.asarray(self.data[i,:,:len(self.node_names)])
+            links=np.asarray(self.data[i,:,len(self.node_names):])
+            for k,name in enumerate(self.species_names):
+                results[name]={'node':pd.DataFrame(nodes[:,:,k],index=index,columns=self.node_names),
+                               'link':pd.DataFrame(links[:,:,k],index=index,columns=self.link_names)}
+        else:
+            sample=np.asarray(self.data[i])
+            results['node']={}
+            results['link']={}
+            for name,j in self._node_ind.items():
+                results['node'][name]=pd.DataFrame(sample[:,j,:],index=index,columns=self.species_names)
+            for name,j in self._link_ind.items():
+                results['link'][name]=pd.DataFrame(sample[:,j,:],index=index,columns=self.species_names)
+        return results
+    
+    @property
+    def results(self):
+        #Sequence of the results of each sample in the format of MSXRunQual, which are
+        #only read when they are accessed
+        return _RunResultList(self)
+    
+    def to_dict(self):
+        #Dictionary in the same format as the pickle files of the Morris run scripts
+        out=dict(self.meta)
+        out['results']=self.results
+        out['nodes']=self.node_names
+        out['links']=self.link_names
+        return out
+
+class _RunResultList:
+    #Read only list of the results of each sample of a RunResultStore
+    def __init__(self,store):
+        self.store=store
+    
+    def __len__(self):
+        return self.store.n_samples
+    
+    def __getitem__(self,i):
+        if isinstance(i,slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i<0:
+            i+=len(self)
+        if i<0 or i>=len(self):
+            raise IndexError('sample index out of range')
+        return self.store.sample_results(i)
+
+#The run store opened in each worker process of MorrisWallEvaluateParallel, and
+#the species that is evaluated
+_morris_worker={}
+
+def _InitMorrisWorker(store_path,species):
+    #Initializer of each worker process of MorrisWallEvaluateParallel
+    _morris_worker['store']=RunResultStore(store_path)
+    _morris_worker['species']=species
+
+def _MorrisWorkerChunk(task):
+    #Compute the Morris values of one chunk of elements in a worker process. Only 
+    #the results of the elements in the chunk are read from the run store
+    element_type,names,indices=task
+    store=_morris_worker['store']
+    con_runs=store.get(element_type,[_morris_worker['species']],names)[:,:,:,0]
+    age_runs=None
+    if 'AGE' in store.species_names:
+        age_runs=store.get(element_type,['AGE'],names)[:,:,:,0]
+    param_names,mu_star,sigma,age=_MorrisEvaluateChunk(store.problem,store.param_values,con_runs,age_runs)
+    return indices,mu_star,sigma,age
+
+class MorrisResultWriter:
+    #Writes the Morris values of each element computed by MorrisWallEvaluateParallel
+    #to disk as they are computed. The results are written to path as:
+    #mu_star.npy, sigma.npy: arrays of shape (element, time, parameter), where the
+    #elements are the nodes followed by the links
+    #age.npy: the mean water age of shape (element, time), NaN without an AGE species
+    #times.npy: the simulation time of each timestep in seconds
+    #done.npy: boolean array of which elements have been computed
+    #info.json: the species, the node, link and parameter names, and the fingerprint
+    #of the run store the values were computed from
+    
+    #If resume is True and path holds the results of the same info, the results
+    #are opened and the elements which are already done are kept. Otherwise the
+    #results are started again
+    
+    def __init__(self,path,info,times,resume=True):
+        self.path=path
+        self.info=info
+        os.makedirs(path,exist_ok=True)
         
-        age_mean['link'][links[l]]=age_results[links[l]].mean(axis=1)
+        files={name:os.path.join(path,name+'.npy') for name in ('mu_star','sigma','age','done')}
+        info_file=os.path.join(path,'info.json')
         
-    return morris_results,age_mean
+        old_info=None
+        if resume and os.path.isfile(info_file) and all(os.path.isfile(file) for file in files.values()):
+            with open(info_file) as fin:
+                old_info=json.load(fin)
+        
+        n_elements=len(info['node'])+len(info['link'])
+        shape=(n_elements,len(times),len(info['names']))
+        
+        if old_info==info:
+            self.mu_star=np.load(files['mu_star'],mmap_mode='r+')
+            self.sigma=np.load(files['sigma'],mmap_mode='r+')
+            self.age=np.load(files['age'],mmap_mode='r+')
+            self.done=np.load(files['done'])
+        else:
+            #Remove the info first, so the old done flags are never read with new 
+            #results if the results are interrupted while they are created
+            if os.path.isfile(info_file):
+                os.remove(info_file)
+            self.mu_star=np.lib.format.open_memmap(files['mu_star'],mode='w+',dtype=np.float64,shape=shape)
+            self.sigma=np.lib.format.open_memmap(files['sigma'],mode='w+',dtype=np.float64,shape=shape)
+            self.age=np.lib.format.open_memmap(files['age'],mode='w+',dtype=np.float64,shape=shape[:2])
+            self.age[:]=np.nan
+            np.save(os.path.join(path,'times.npy'),times)
+            self.done=np.zeros(n_elements,dtype=bool)
+            self.flush()
+            with open(info_file,'w') as fout:
+                json.dump(info,fout)
+    
+    def write(self,indices,mu_star,sigma,age=None):
+        #Write the (time, element, parameter) values of the elements with the given
+        #indices
+        self.mu_star[indices]=mu_star.transpose(1,0,2)
+        self.sigma[indices]=sigma.transpose(1,0,2)
+        if age is not None:
+            self.age[indices]=age.T
+        self.done[indices]=True
+        self.flush()
+    
+    def flush(self):
+        #The values are flushed before the done flags, so an element is only marked as
+        #done once its values are on disk
+        self.mu_star.flush()
+        self.sigma.flush()
+        self.age.flush()
+        done_file=os.path.join(self.path,'done.npy')
+        with open(done_file+'.tmp','wb') as fout:
+            np.save(fout,self.done)
+        os.replace(done_file+'.tmp',done_file)
+    
+    def close(self):
+        self.flush()
+        self.mu_star=None
+        self.sigma=None
+        self.age=None
 
+class MorrisResultStore:
+    #Reader of the Morris values written by MorrisWallEvaluateParallel (see 
+    #MorrisResultWriter)
+    
+    def __init__(self,path):
+        self.path=path
+        with open(os.path.join(path,'info.json')) as fin:
+            self.info=json.load(fin)
+        self.species=self.info['species']
+        self.node_names=self.info['node']
+        self.link_names=self.info['link']
+        self.names=self.info['names']
+        self.times=np.load(os.path.join(path,'times.npy'))
+        self.done=np.load(os.path.join(path,'done.npy'))
+        self.mu_star=np.load(os.path.join(path,'mu_star.npy'),mmap_mode='r')
+        self.sigma=np.load(os.path.join(path,'sigma.npy'),mmap_mode='r')
+        self.age=np.load(os.path.join(path,'age.npy'),mmap_mode='r')
+        self._index={('node',name):j for j,name in enumerate(self.node_names)}
+        self._index.update({('link',name):j+len(self.node_names) for j,name in enumerate(self.link_names)})
+    
+    def get(self,element_type,name):
+        #Returns the mu_star and sigma dataframes of one element
+        j=self._index[(element_type,name)]
+        if not self.done[j]:
+            raise Exception('The Morris values of ' + element_type + ' ' + name + ' have not been computed')
+        index=pd.Index(self.times)
+        return (pd.DataFrame(np.array(self.mu_star[j]),index=index,columns=self.names),
+                pd.DataFrame(np.array(self.sigma[j]),index=index,columns=self.names))
+    
+    def to_results(self):
+        #Returns the morris_results and age_mean dictionaries of MorrisWallEvaluate, 
+        #with the elements that have been computed
+        index=pd.Index(self.times)
+        morris_results={'mu_star':{'node':{},'link':{}},'sigma':{'node':{},'link':{}}}
+        age_mean={}
+        has_age=self.info['has_age']
+        for element_type,names in (('node',self.node_names),('link',self.link_names)):
+            age_columns={}
+            for name in names:
+                j=self._index[(element_type,name)]
+                if not self.done[j]:
+                    continue
+                mu_star_df,sigma_df=self.get(element_type,name)
+                morris_results['mu_star'][element_type][name]=mu_star_df
+                morris_results['sigma'][element_type][name]=sigma_df
+                if has_age:
+                    age_columns[name]=np.array(self.age[j])
+            age_mean[element_type]=pd.DataFrame(age_columns,index=index)
+        return morris_results,age_mean
 
-    
\ No newline at end of file
+def MorrisWallEvaluateParallel(store,species,out_dir,processes=None,chunk_size=None,resume=True,
+                               start_method='forkserver'):
+    #Compute the same Morris values as MorrisWallEvaluate, with the elements split 
+    #across a pool of processes. The values of each element are written to 
+    #out_dir/species (see MorrisResultWriter) as soon as they are computed
+    
+    #If the evaluation is interrupted, running it again with the same run store 
+    #resumes from the elements that were already computed. Elements are only 
+    #skipped if they were computed from a run store with the same fingerprint, so
+    #the values are computed again if the run store changes. If resume is False, 
+    #all of the elements are computed again
+    
+    #store: RunResultStore, or the directory of the results of RunParallelToStore. A
+    #store with samples that have not been run is not evaluated (see 
+    #RunResultStore.check_done)
+    #processes: number of processes, 85% of the available cores by default. If 1 
+    #the elements are evaluated in serial in the current process
+    #chunk_size: number of elements sent to a worker at a time
+    
+    #Returns the morris_results and age_mean dictionaries of MorrisWallEvaluate. The
+    #values can also be read later with MorrisResultStore(os.path.join(out_dir,species))
+    
+    if isinstance(store,str):
+        store=RunResultStore(store)
+    #Checked before any element is evaluated, as the values of the elements would
+    #be computed from the zeros of the missing samples, and kept when resuming
+    store.check_done()
+    
+    if processes is None:
+        processes=int(np.round(mp.cpu_count()*.85,0))
+    
+    groups=store.problem.get('groups')
+    if groups is None:
+        groups=store.problem['names']
+    
+    info={'species':species,'input_hash':store.fingerprint(),'node':list(store.node_names),
+          'link':list(store.link_names),'names':list(dict.fromkeys(groups)),
+          'has_age':'AGE' in store.species_names}
+    path=os.path.join(out_dir,species)
+    writer=MorrisResultWriter(path,info,store.times,resume=resume)
+    
+    n_nodes=len(store.node_names)
+    n_elements=n_nodes+len(store.link_names)
+    
+    if chunk_size is None:
+        #Enough chunks to balance the work of the processes, which are small enough
+        #to hold about 20 million results
+        chunk_size=max(1,int(2e7//max(1,store.n_samples*len(store.times))))
+        chunk_size=max(1,min(chunk_size,int(np.ceil(n_elements/(processes*4)))))
+    
+    #Split the elements which have not been computed yet into chunks of one type
+    tasks=[]
+    for element_type,names,offset in (('node',store.node_names,0),('link',store.link_names,n_nodes)):
+        todo=[j for j in range(len(names)) if not writer.done[offset+j]]
+        for c in range(0,len(todo),chunk_size):
+            chunk=todo[c:c+chunk_size]
+            tasks.append((element_type,[names[j] for j in chunk],[offset+j for j in chunk]))
+    
+    n_done=int(writer.done.sum())
+    if n_done>0:
+        print('Resuming with ' + str(n_done) + ' of ' + str(n_elements) + ' elements already evaluated')
+    
+    def write(block):
+        writer.write(*block)
+        print('Evaluated ' + str(int(writer.done.sum())) + ' of ' + str(n_elements) + ' elements')
+    
+    if processes==1 or len(tasks)<=1:
+        _InitMorrisWorker(store.path,species)
+        for task in tasks:
+            write(_MorrisWorkerChunk(task))
+        writer.close()
+    else:
+        pool=mp.get_context(start_method).Pool(processes=min(processes,len(tasks)),initializer=_InitMorrisWorker,
+                                                initargs=(store.path,species))
+        try:
+            for block in pool.imap_unordered(_MorrisWorkerChunk,tasks):
+                write(block)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            writer.close()
+    
+    return MorrisResultStore(path).to_results()
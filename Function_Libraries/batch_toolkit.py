@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+Batch reactor solver for MSX models whose species are all in the bulk phase
+
+Integrates the reactions of an msx file in one well mixed volume of water with no
+flow (e.g. the tank of beaker.inp) without EPANET or EPANET MSX. The species of
+many sets of constants and initial concentrations (e.g. every sample of a Method of
+Morris analysis) are stacked into one stiff system of ODEs, which is integrated at
+once with the BDF method of scipy. The expressions are compiled by msx_compiler
+"""
+
+import numpy as np
+from msx_compiler import LoadMSXModel
+
+#Seconds of each RATE_UNITS of an msx file
+_rate_units={'SEC':1,'MIN':60,'HR':3600,'DAY':86400}
+
+class BatchReactor:
+    #The reactions of an msx file in a batch reactor (a volume of water with no flow)
+    #msx_file: the .msx file. Every species must be BULK
+    #node: ID of the node whose [QUALITY] NODE values and [PARAMETERS] TANK values
+    #are used, in addition to the GLOBAL values. The first node in [QUALITY] if None
+    #reactor: 'tank' to use the [TANKS] expression of a species when it has one, as
+    #MSX does in a tank, or 'pipe' to use only the [PIPES] expressions
+    #hydraulics: dictionary of the values of the hydraulic variables the expressions
+    #use (e.g. {'Av':0.5}). The ones which are not given are 0, as with no flow
+    #The species are reported in the order of the msx file, like MSXRunQual
+
+    def __init__(self,msx_file,node=None,reactor='tank',hydraulics=None):
+        model=LoadMSXModel(msx_file)
+        for name,kind in zip(model.species_names,model.species_types):
+            if kind!='BULK':
+                raise Exception('The species ' + name + ' is not in the bulk phase, so the model cannot be solved as a batch reactor')
+        self.reactions=model.compile(reactor)
+
+        self.species_names=list(model.species_names)
+        self.species_units=list(model.species_units)
+        self.constant_names=list(model.constant_names)
+        self.constants=model.constants.copy()
+        self.parameter_names=list(model.parameter_names)
+        self.parameters=model.parameters.copy()
+        self.rate_ind=self.reactions.rate_ind
+        self.equil_ind=self.reactions.equil_ind
+        self.formula_ind=self.reactions.formula_ind
+        self.atol=model.species_atol.copy()
+        self.rtol=float(np.min(model.species_rtol)) if len(model.species_rtol) else 0.001
+
+        #Rates are per RATE_UNITS, and are converted to per second
+        units=model.options.get('RATE_UNITS','HR').upper()[:3].replace('HOU','HR')
+        self.rate_scale=1/_rate_units.get(units,3600)
+        self.timestep=int(float(model.options.get('TIMESTEP',300)))
+
+        #The initial concentrations of the node
+        species={name.upper():i for i,name in enumerate(self.species_names)}
+        quality=model.sections.get('QUALITY',[])
+        if node is None:
+            nodes=[l[1] for l in quality if l[0].upper().startswith('NODE')]
+            node=nodes[0] if nodes else None
+        self.node=node
+        self.initial=np.zeros(len(self.species_names))
+        for l in quality:
+            if l[0].upper().startswith('GLOB'):
+                self.initial[species[l[1].upper()]]=float(l[2])
+        for l in quality:
+            if l[0].upper().startswith('NODE') and l[1]==node:
+                self.initial[species[l[2].upper()]]=float(l[3])
+        parameters={name.upper():i for i,name in enumerate(self.parameter_names)}
+        element='TANK' if reactor=='tank' else 'PIPE'
+        for l in model.sections.get('PARAMETERS',[]):
+            if l[0].upper().startswith(element) and l[1]==node:
+                self.parameters[parameters[l[2].upper()]]=float(l[3])
+
+        given={name.upper():value for name,value in (hydraulics or {}).items()}
+        self.hydraulics={name:given.get(name,0.) for name in self.reactions.hydraulic_names}
+
+    def _SolveEquilibrium(self,c,k,p,max_iter=20):
+        #Solves the equilibrium species of every column of c in place with Newton's
+        #method, starting from their values in c
+        n_r=len(self.rate_ind)
+        n_e=len(self.equil_ind)
+        if n_e==0:
+            return
+        dy=np.empty((n_r,)+c.shape[1:])
+        res=np.empty((n_e,)+c.shape[1:])
+        atol=self.atol[self.equil_ind][:,np.newaxis]
+        for it in range(max_iter):
+            self.reactions.evaluate(c,k,p,self.hydraulics,dy,res)
+            jac=np.zeros((n_r+n_e,n_r+n_e)+c.shape[1:])
+            self.reactions.jacobian(c,k,p,self.hydraulics,jac)
+            dx=np.linalg.solve(jac[n_r:,n_r:].transpose((2,0,1)),-res.T[:,:,np.newaxis])[:,:,0].T
+            c[self.equil_ind]+=dx
+            if np.all(np.abs(dx)<=self.rtol*np.abs(c[self.equil_ind])+atol*self.rtol):
+                return
+        if not np.all(np.isfinite(c[self.equil_ind])):
+            raise Exception('The equilibrium equations could not be solved')
+        raise Exception('The equilibrium equations did not converge in ' + str(max_iter) + ' Newton iterations')
+
+    def _Coefficients(self,names,base,values,n_samples,kind):
+        #Array (coefficient, sample) of the base values, replaced by the given values
+        lookup={name.upper():i for i,name in enumerate(names)}
+        array=np.tile(base[:,np.newaxis],(1,n_samples))
+        for name,value in (values or {}).items():
+            if name.upper() not in lookup:
+                raise Exception('The ' + kind + ' ' + name + ' does not exist in the model')
+            array[lookup[name.upper()]]=value
+        return array
+
+    def run(self,times,constants=None,parameters=None,initial=None,chunk_size=None):
+        #Integrates the reactions of many samples at once and returns an array of the
+        #concentrations of shape (sample, time, species)
+        #times: the times to report in seconds (after 0, the start of the reaction)
+        #constants, parameters, initial: dictionaries of the values of constants,
+        #parameters and initial concentrations that differ from the msx file, by name.
+        #Each value is a number, or an array with one value for each sample
+        #chunk_size: number of samples integrated in one system, all if None. Since
+        #the steps of a system are as short as its fastest sample needs, a very wide
+        #range of samples can be faster in several chunks. The tolerances of a system
+        #are tightened with its number of samples (see _RunChunk), so each sample is
+        #at least as accurate as when it is integrated alone
+        from scipy.integrate import solve_ivp
+        from scipy.sparse import bsr_matrix
+
+        times=np.asarray(times,dtype=np.float64)
+        values=list((constants or {}).values())+list((parameters or {}).values())+list((initial or {}).values())
+        n_samples=max([np.size(v) for v in values]+[1])
+        k=self._Coefficients(self.constant_names,self.constants,constants,n_samples,'constant')
+        p=self._Coefficients(self.parameter_names,self.parameters,parameters,n_samples,'parameter')
+        c0=self._Coefficients(self.species_names,self.initial,initial,n_samples,'species')
+
+        if chunk_size is None:
+            chunk_size=n_samples
+        results=np.zeros((n_samples,len(times),len(self.species_names)))
+        for start in range(0,n_samples,chunk_size):
+            chunk=slice(start,min(start+chunk_size,n_samples))
+            results[chunk]=self._RunChunk(times,k[:,chunk],p[:,chunk],c0[:,chunk],solve_ivp,bsr_matrix)
+        return results
+
+    def _RunChunk(self,times,k,p,c0,solve_ivp,bsr_matrix):
+        n_samples=k.shape[1]
+        n_r=len(self.rate_ind)
+        n_e=len(self.equil_ind)
+
+        #The state is ordered by sample and then by species, so that the jacobian is
+        #block diagonal with one block for each sample
+        y0=c0[self.rate_ind].T.ravel()
+        #The concentrations of every species, where the equilibrium species keep the
+        #last solution as the start of the next Newton iterations
+        c=c0.copy()
+        dy=np.empty((n_r,n_samples))
+        res=np.empty((n_e,n_samples))
+
+        def rhs(t,y):
+            c[self.rate_ind]=y.reshape((n_samples,n_r)).T
+            self._SolveEquilibrium(c,k,p)
+            self.reactions.evaluate(c,k,p,self.hydraulics,dy,res)
+            return (dy*self.rate_scale).T.ravel()
+
+        def jac(t,y):
+            #Jacobian of the rates with respect to the rate species, including their
+            #effect through the equilibrium species
+            c[self.rate_ind]=y.reshape((n_samples,n_r)).T
+            self._SolveEquilibrium(c,k,p)
+            full=np.zeros((n_r+n_e,n_r+n_e,n_samples))
+            self.reactions.jacobian(c,k,p,self.hydraulics,full)
+            full=full.transpose((2,0,1))
+            blocks=full[:,:n_r,:n_r]
+            if n_e>0:
+                dxdy=-np.linalg.solve(full[:,n_r:,n_r:],full[:,n_r:,:n_r])
+                blocks=blocks+full[:,:n_r,n_r:]@dxdy
+            return bsr_matrix((blocks*self.rate_scale,np.arange(n_samples),np.arange(n_samples+1)),
+                              shape=(n_samples*n_r,n_samples*n_r))
+
+        #The error of each step is controlled with the RMS norm of the whole state, in
+        #which the error of one sample can be sqrt(n_samples) times its tolerance. The 
+        #tolerances are divided by sqrt(n_samples) so that every sample meets its own
+        #tolerances, as when it is integrated alone
+        tol_scale=1/np.sqrt(n_samples)
+        solution=solve_ivp(rhs,(0,times[-1]),y0,method='BDF',t_eval=times,jac=jac,rtol=self.rtol*tol_scale,
+                           atol=np.tile(self.atol[self.rate_ind],n_samples)*tol_scale)
+        if not solution.success:
+            raise Exception('The reactions could not be integrated: ' + solution.message)
+
+        #Compute the equilibrium and formula species at every reported time at once,
+        #with the times and samples stacked along the columns
+        n_t=len(times)
+        results=np.tile(c,(1,n_t))
+        results[self.rate_ind]=solution.y.reshape((n_samples,n_r,n_t)).transpose((1,2,0)).reshape((n_r,n_t*n_samples))
+        k_t=np.tile(k,(1,n_t))
+        p_t=np.tile(p,(1,n_t))
+        self._SolveEquilibrium(results,k_t,p_t)
+        self.reactions.evaluate(results,k_t,p_t,self.hydraulics,np.empty((n_r,n_t*n_samples)),np.empty((n_e,n_t*n_samples)))
+        return results.reshape((-1,n_t,n_samples)).transpose((2,1,0))
+
+def BatchReportTimes(reactor,days,step=None):
+    #The times (s) MSXRunQual reports for a simulation of the given number of days:
+    #every step seconds (the TIMESTEP of the msx file if None) after 0
+    if step is None:
+        step=reactor.timestep
+    return np.arange(step,int(days*24*3600)+1,step,dtype=np.float64)
+
+def BatchRunToStore(reactor,times,out_dir,constants=None,parameters=None,initial=None,
+                    chunk_size=200,dtype=np.float64,meta=None):
+    #Integrates the samples of a batch reactor chunk_size at a time and writes the
+    #results to out_dir in the format of RunParallelToStore, with the reactor as the
+    #only node, so that they can be read with MSXPY_toolkit.RunResultStore and used
+    #with MorrisWallEvaluate like the results of the full model
+    #constants, parameters, initial: see BatchReactor.run
+    import MSXPY_toolkit as mpy
+
+    values=list((constants or {}).values())+list((parameters or {}).values())+list((initial or {}).values())
+    n_samples=max([np.size(v) for v in values]+[1])
+
+    def select(given,chunk):
+        #The values of the samples of one chunk
+        return {name:(np.asarray(value)[chunk] if np.size(value)>1 else value) for name,value in (given or {}).items()}
+
+    writer=mpy.RunResultWriter(out_dir,n_samples,dtype=dtype,meta=meta)
+    names=([reactor.node],[],reactor.species_names)
+    for start in range(0,n_samples,chunk_size):
+        chunk=slice(start,min(start+chunk_size,n_samples))
+        results=reactor.run(times,select(constants,chunk),select(parameters,chunk),select(initial,chunk))
+        for i in range(results.shape[0]):
+            writer.write(start+i,times,results[i][:,np.newaxis,:].astype(dtype),names)
+    writer.close()
+    return out_dir
@@ -10,40 +10,188 @@ import ctypes
 import platform
 import datetime
 import os
+import numpy as np
 
 
 #CHANGE THIS VARIABLE BASED ON YOUR COMPUTER
 main_folder=r'C:\Users\frank\Documents\Box Sync\working files\Leap-hi\Epanet-MSX\MSXpy\MSXPY'
 
+#The EPANET library is loaded the first time a toolkit function is called, from the
+#path given to load_library(), else the path in the MSXPY_EPANET_LIB environment
+#variable, else the first file of _search_path which exists, else the system search
+#path of the platform. Importing this module does not need the library.
 _plat= platform.system()
-if _plat=='Linux':
-    _lib = ctypes.CDLL("/work/05881/mfrankel/stampede2/libepanet2.so")
-elif _plat=='Windows':
-  try:
-    # if epanet2.dll compiled with __cdecl (as in OpenWaterAnalytics)
-    
-    _lib = ctypes.CDLL(main_folder+'\EPANET_DLLs\epanet2.dll')
-    #_lib = ctypes.CDLL("epanet2.dll")
-    _lib.ENgetversion(ctypes.byref(ctypes.c_int()))
-  except ValueError:
-     # if epanet2.dll compiled with __stdcall (as in EPA original DLL)
-     try:
-       _lib = ctypes.windll.epanet2
-       _lib.ENgetversion(ctypes.byref(ctypes.c_int()))
-     except ValueError:
-       raise Exception("epanet2.dll not suitable")
-
+_env_var= 'MSXPY_EPANET_LIB'
+if _plat=='Windows':
+    _lib_name= 'epanet2.dll'
+    _search_path= [os.path.join(main_folder, 'EPANET_DLLs', _lib_name),
+                   os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'EPANET_DLLs', _lib_name)]
 else:
-  Exception('Platform '+ _plat +' unsupported (not yet)')
+    _lib_name= 'libepanet2.so'
+    _search_path= ['/work/05881/mfrankel/stampede2/'+_lib_name,
+                   os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'EPANET_DLLs', _lib_name)]
+
+def library_path():
+    """Returns the path of the EPANET library which load_library() loads when
+    it is not given one"""
+    if os.environ.get(_env_var):
+        return os.environ[_env_var]
+    for path in _search_path:
+        if os.path.isfile(path):
+            return path
+    return _lib_name
+
+#argument and return types of every toolkit function, set on the library's function
+#pointers when it is loaded, so that ctypes converts python ints and floats directly and
+#the wrappers do not build a ctypes object per argument. Out arguments are void pointers,
+#which accept the shared byref() buffers below and byref(array, offset) alike. No errcheck
+#is set: its python callback would cost more per call than the ierr checks it replaces
+_c_int= ctypes.c_int
+_c_long= ctypes.c_long
+_c_float= ctypes.c_float
+_c_char_p= ctypes.c_char_p
+_c_void_p= ctypes.c_void_p
+_prototypes= {
+    'ENepanet': [_c_char_p, _c_char_p, _c_char_p, _c_void_p],
+    'ENopen': [_c_char_p, _c_char_p, _c_char_p],
+    'ENclose': [],
+    'ENgetnodeindex': [_c_char_p, _c_void_p],
+    'ENgetnodeid': [_c_int, _c_void_p],
+    'ENsettitle': [_c_char_p, _c_char_p, _c_char_p],
+    'ENsetflowunits': [_c_int],
+    'ENgetnodetype': [_c_int, _c_void_p],
+    'ENgetnodevalue': [_c_int, _c_int, _c_void_p],
+    'ENgetlinkindex': [_c_char_p, _c_void_p],
+    'ENgetlinkid': [_c_int, _c_void_p],
+    'ENgetlinktype': [_c_int, _c_void_p],
+    'ENgetlinknodes': [_c_int, _c_void_p, _c_void_p],
+    'ENgetlinkvalue': [_c_int, _c_int, _c_void_p],
+    'ENgetpatternid': [_c_int, _c_void_p],
+    'ENgetpatternindex': [_c_char_p, _c_void_p],
+    'ENgetpatternlen': [_c_int, _c_void_p],
+    'ENgetpatternvalue': [_c_int, _c_int, _c_void_p],
+    'ENgetcount': [_c_int, _c_void_p],
+    'ENgetflowunits': [_c_void_p],
+    'ENgettimeparam': [_c_int, _c_void_p],
+    'ENgetqualtype': [_c_void_p, _c_void_p],
+    'ENgetcontrol': [_c_int, _c_void_p, _c_void_p, _c_void_p, _c_void_p, _c_void_p],
+    'ENgetoption': [_c_int, _c_void_p],
+    'ENgetversion': [_c_void_p],
+    'ENgetcurve': [_c_int, _c_void_p, _c_void_p, _c_void_p, _c_void_p],
+    'ENsetcontrol': [_c_int, _c_int, _c_int, _c_float, _c_int, _c_float],
+    'ENsetnodevalue': [_c_int, _c_int, _c_float],
+    'ENsetlinkvalue': [_c_int, _c_int, _c_float],
+    'ENaddpattern': [_c_char_p],
+    'ENsetpattern': [_c_int, ctypes.POINTER(_c_float), _c_int],
+    'ENsetpatternvalue': [_c_int, _c_int, _c_float],
+    'ENsetqualtype': [_c_int, _c_char_p, _c_char_p, _c_char_p],
+    'ENsettimeparam': [_c_int, _c_long],
+    'ENsetoption': [_c_int, _c_float],
+    'ENsavehydfile': [_c_char_p],
+    'ENusehydfile': [_c_char_p],
+    'ENsolveH': [],
+    'ENopenH': [],
+    'ENinitH': [_c_int],
+    'ENrunH': [_c_void_p],
+    'ENnextH': [_c_void_p],
+    'ENcloseH': [],
+    'ENsolveQ': [],
+    'ENopenQ': [],
+    'ENinitQ': [_c_int],
+    'ENrunQ': [_c_void_p],
+    'ENnextQ': [_c_void_p],
+    'ENstepQ': [_c_void_p],
+    'ENcloseQ': [],
+    'ENsaveH': [],
+    'ENsaveinpfile': [_c_char_p],
+    'ENreport': [],
+    'ENresetreport': [],
+    'ENsetreport': [_c_char_p],
+    'ENsetstatusreport': [_c_int],
+    'ENgeterror': [_c_int, _c_void_p, _c_int],
+    'ENwriteline': [_c_char_p],
+}
+
+def _prototype(lib):
+    """Sets the argument and return types of _prototypes on the functions of lib
+    (ctypes keeps the function pointers, so later lookups return the prototyped ones)"""
+    for name, argtypes in _prototypes.items():
+        func= getattr(lib, name, None)
+        if func is None:
+            continue
+        func.restype= _c_int
+        func.argtypes= argtypes
+
+def load_library(path=None):
+    """Loads the EPANET library, which the toolkit functions then use, and returns it.
+    Only needed to use a library which library_path() does not find, or to load it
+    before the first call.
+    Arguments:
+    path: path of epanet2.dll / libepanet2.so (default library_path())"""
+    global _lib, _lib_path
+    if path is None:
+        path= library_path()
+    if _plat=='Windows':
+      try:
+        # if epanet2.dll compiled with __cdecl (as in OpenWaterAnalytics)
+        lib = ctypes.CDLL(path)
+        lib.ENgetversion(ctypes.byref(ctypes.c_int()))
+      except ValueError:
+         # if epanet2.dll compiled with __stdcall (as in EPA original DLL)
+         try:
+           lib = ctypes.WinDLL(path)
+           lib.ENgetversion(ctypes.byref(ctypes.c_int()))
+         except ValueError:
+           raise Exception("epanet2.dll not suitable")
+    else:
+        #global so that the MSX library, which calls into it, finds its symbols
+        try:
+          lib = ctypes.CDLL(path, mode=ctypes.RTLD_GLOBAL)
+        except OSError as e:
+          raise Exception('The EPANET library could not be loaded ('+str(e)+'), set the '+_env_var+
+                          ' environment variable to its path or call epanet_toolkit.load_library(path)')
+    _prototype(lib)
+    _lib= lib
+    _lib_path= path
+    return lib
+
+class _UnloadedLibrary:
+    """Stands in for _lib until the library is loaded, which happens on the first
+    attribute lookup; load_library() then replaces it, so later calls go directly
+    to the library"""
+    def __getattr__(self, name):
+        return getattr(load_library(_lib_path), name)
+
+_lib_path= None
+_lib= _UnloadedLibrary()
 
 
 
 
 _current_simulation_time=  ctypes.c_long()
+_current_simulation_ref= ctypes.byref(_current_simulation_time)
 
 _max_label_len= 32
 _err_max_char= 80
-  
+
+#changes every time the Toolkit is opened or closed, or a pattern is added
+_session_id= 0
+
+def _new_session():
+    global _session_id
+    _session_id+= 1
+
+#out arguments shared by the getters, with their references built once: creating a
+#ctypes object and a byref() on every call costs more than the call itself
+#(the toolkit is not thread safe in any case)
+_int_out= ctypes.c_int()
+_int_ref= ctypes.byref(_int_out)
+_long_out= ctypes.c_long()
+_long_ref= ctypes.byref(_long_out)
+_float_out= ctypes.c_float()
+_float_ref= ctypes.byref(_float_out)
+_label_out= ctypes.create_string_buffer(_max_label_len)
+_label_ref= ctypes.byref(_label_out)
 
 
 
@@ -60,9 +208,10 @@ def ENepanet(nomeinp, nomerpt='', nomebin='', vfunc=None):
         callback= CFUNC(vfunc)
     else:
         callback= None
-    ierr= _lib.ENepanet(ctypes.c_char_p(nomeinp.encode()), 
-                        ctypes.c_char_p(nomerpt.encode()), 
-                        ctypes.c_char_p(nomebin.encode()), 
+    _new_session()
+    ierr= _lib.ENepanet(nomeinp.encode(), 
+                        nomerpt.encode(), 
+                        nomebin.encode(), 
                         callback)
     if ierr!=0: raise ENtoolkitError(ierr)
 
@@ -74,15 +223,24 @@ def ENopen(nomeinp, nomerpt='', nomebin=''):
     nomerpt: name of an output report file
     nomebin: name of an optional binary output file
     """
-    ierr= _lib.ENopen(ctypes.c_char_p(nomeinp.encode()), 
-                      ctypes.c_char_p(nomerpt.encode()), 
-                      ctypes.c_char_p(nomebin.encode()))
+    _new_session()
+    ierr= _lib.ENopen(nomeinp.encode(), 
+                      nomerpt.encode(), 
+                      nomebin.encode())
     if ierr!=0: 
       raise ENtoolkitError(ierr)
 
 
+def ENsession():
+    """Returns a number which changes each time the Toolkit is opened or closed, or a 
+    pattern is added, so saved ID and index lookups (e.g. MSXPY_toolkit.ModelRegistry)
+    can check that they still describe the open network"""
+    return _session_id
+
+
 def ENclose():
   """Closes down the Toolkit system (including all files being processed)"""
+  _new_session()
   ierr= _lib.ENclose()
   if ierr!=0: raise ENtoolkitError(ierr)
 
@@ -91,21 +249,19 @@ def ENgetnodeindex(nodeid):
     """Retrieves the index of a node with a specified ID.
     Arguments:
     nodeid: node ID label"""
-    j= ctypes.c_int()
-    ierr= _lib.ENgetnodeindex(ctypes.c_char_p(nodeid.encode()), ctypes.byref(j))
+    ierr= _lib.ENgetnodeindex(nodeid.encode(), _int_ref)
     if ierr!=0: raise ENtoolkitError(ierr)
-    return j.value
+    return _int_out.value
 
 
 def ENgetnodeid(index):
     """Retrieves the ID label of a node with a specified index.
     Arguments:
     index: node index"""    
-    label = ctypes.create_string_buffer(_max_label_len)
-    ierr= _lib.ENgetnodeid(index, ctypes.byref(label))
+    ierr= _lib.ENgetnodeid(index, _label_ref)
     if ierr!=0: raise ENtoolkitError(ierr)
     #the .decode() added my MF 6/3/21
-    return label.value.decode()
+    return _label_out.value.decode()
 
 def ENsettitle(line1,line2,line3):
 	"""Set inp file title
@@ -114,9 +270,9 @@ def ENsettitle(line1,line2,line3):
 	line1: line 1 of 3 inp title lines
 	line2: line 2 of 3 inp title lines
 	line3: line 3 of 3 inp title lines"""
-	ierr = _lib.ENsettitle(ctypes.c_char_p(line1.encode()),
-			       ctypes.c_char_p(line2.encode()),
-			       ctypes.c_char_p(line3.encode()))
+	ierr = _lib.ENsettitle(line1.encode(),
+			       line2.encode(),
+			       line3.encode())
 	if ierr!=0: raise ENtoolkitError(ierr)
 
 
@@ -135,7 +291,7 @@ def ENsetflowunits(units_code):
         EN_CMH	8	cubic meters per hour
         EN_CMD	9	cubic meters per day
     """
-    ierr = _lib.ENsetflowunits(ctypes.c_int(units_code))
+    ierr = _lib.ENsetflowunits(units_code)
     if ierr != 0: raise ENtoolkitError(ierr)
 
 
@@ -181,10 +337,9 @@ def ENgetnodevalue(index, paramcode):
                   EN_MAXLEVEL    Maximum water level
                   EN_MIXFRACTION Fraction of total volume occupied by the inlet/outlet zone in a 2-compartment tank
                   EN_TANK_KBULK  Bulk reaction rate coefficient"""
-    j= ctypes.c_float()
-    ierr= _lib.ENgetnodevalue(index, paramcode, ctypes.byref(j))
+    ierr= _lib.ENgetnodevalue(index, paramcode, _float_ref)
     if ierr!=0: raise ENtoolkitError(ierr)
-    return j.value
+    return _float_out.value
 
 
 ##------
@@ -192,21 +347,19 @@ def ENgetlinkindex(linkid):
     """Retrieves the index of a link with a specified ID.
     Arguments:
     linkid: link ID label"""
-    j= ctypes.c_int()
-    ierr= _lib.ENgetlinkindex(ctypes.c_char_p(linkid.encode()), ctypes.byref(j))
+    ierr= _lib.ENgetlinkindex(linkid.encode(), _int_ref)
     if ierr!=0: raise ENtoolkitError(ierr)
-    return j.value
+    return _int_out.value
 
 
 def ENgetlinkid(index):
     """Retrieves the ID label of a link with a specified index.
     Arguments:
     index: link index"""
-    label = ctypes.create_string_buffer(_max_label_len)
-    ierr= _lib.ENgetlinkid(index, ctypes.byref(label))
+    ierr= _lib.ENgetlinkid(index, _label_ref)
     if ierr!=0: raise ENtoolkitError(ierr)
     #the .decode() added my MF 6/10/21
-    return label.value.decode()
+    return _label_out.value.decode()
 
 
 def ENgetlinktype(index):
@@ -249,10 +402,9 @@ def ENgetlinkvalue(index, paramcode):
                  EN_SETTING      * Roughness for pipes, actual speed for pumps, actual setting for valves
                  EN_ENERGY       * Energy expended in kwatts
                    * computed values"""
-    j= ctypes.c_float()
-    ierr= _lib.ENgetlinkvalue(index, paramcode, ctypes.byref(j))
+    ierr= _lib.ENgetlinkvalue(index, paramcode, _float_ref)
     if ierr!=0: raise ENtoolkitError(ierr)
-    return j.value
+    return _float_out.value
 #------
 
 def ENgetpatternid(index):
@@ -269,7 +421,7 @@ def ENgetpatternindex(patternid):
     Arguments:
     id: pattern ID label"""
     j= ctypes.c_int()
-    ierr= _lib.ENgetpatternindex(ctypes.c_char_p(patternid.encode()), ctypes.byref(j))
+    ierr= _lib.ENgetpatternindex(patternid.encode(), ctypes.byref(j))
     if ierr!=0: raise ENtoolkitError(ierr)
     return j.value
 
@@ -289,10 +441,9 @@ def ENgetpatternvalue( index, period):
     Arguments:
     index:  time pattern index
     period: period within time pattern"""
-    j= ctypes.c_float()
-    ierr= _lib.ENgetpatternvalue(index, period, ctypes.byref(j))
+    ierr= _lib.ENgetpatternvalue(index, period, _float_ref)
     if ierr!=0: raise ENtoolkitError(ierr)
-    return j.value
+    return _float_out.value
 
 
 
@@ -305,10 +456,9 @@ def ENgetcount(countcode):
                               EN_PATCOUNT
                               EN_CURVECOUNT
                               EN_CONTROLCOUNT"""
-    j= ctypes.c_int()
-    ierr= _lib.ENgetcount(countcode, ctypes.byref(j))
+    ierr= _lib.ENgetcount(countcode, _int_ref)
     if ierr!=0: raise ENtoolkitError(ierr)
-    return j.value
+    return _int_out.value
 
 
 def ENgetflowunits():
@@ -332,10 +482,9 @@ def ENgettimeparam(paramcode):
                EN_RULESTEP
                EN_STATISTIC
                EN_PERIODS"""
-    j= ctypes.c_int()
-    ierr= _lib.ENgettimeparam(paramcode, ctypes.byref(j))
+    ierr= _lib.ENgettimeparam(paramcode, _long_ref)
     if ierr!=0: raise ENtoolkitError(ierr)
-    return j.value
+    return _long_out.value
     
 def  ENgetqualtype():
     """Retrieves the type of water quality analysis called for
@@ -377,7 +526,7 @@ def ENgetcontrol(cindex):
     nindex = ctypes.c_int()
     level = ctypes.c_float()
 
-    ierr= _lib.ENgetcontrol(ctypes.c_int(cindex), ctypes.byref(ctype),
+    ierr= _lib.ENgetcontrol(cindex, ctypes.byref(ctype),
                             ctypes.byref(lindex), ctypes.byref(setting),
                             ctypes.byref(nindex), ctypes.byref(level) )
     if ierr!=0: raise ENtoolkitError(ierr)
@@ -421,9 +570,7 @@ def ENsetcontrol(cindex, ctype, lindex, setting, nindex, level ):
        level:   value of controlling water level or pressure for level controls
                 or of time of control action (in seconds) for time-based controls"""
     #int ENsetcontrol(int cindex, int* ctype, int* lindex, float* setting, int* nindex, float* level )
-    ierr= _lib.ENsetcontrol(ctypes.c_int(cindex), ctypes.c_int(ctype),
-                            ctypes.c_int(lindex), ctypes.c_float(setting), 
-                            ctypes.c_int(nindex), ctypes.c_float(level) )
+    ierr= _lib.ENsetcontrol(cindex, ctype, lindex, setting, nindex, level)
     if ierr!=0: raise ENtoolkitError(ierr)
 
 
@@ -451,7 +598,7 @@ def ENsetnodevalue(index, paramcode, value):
                   EN_MIXFRACTION   Fraction of total volume occupied by the inlet/outlet
                   EN_TANK_KBULK    Bulk reaction rate coefficient
     value:parameter value"""
-    ierr= _lib.ENsetnodevalue(ctypes.c_int(index), ctypes.c_int(paramcode), ctypes.c_float(value))
+    ierr= _lib.ENsetnodevalue(int(index), int(paramcode), value)
     if ierr!=0: raise ENtoolkitError(ierr)
 
 
@@ -474,17 +621,78 @@ def ENsetlinkvalue(index, paramcode, value):
                    exists prior to the start of a simulation. Use EN_STATUS and EN_SETTING to change these values while 
                    a simulation is being run (within the ENrunH - ENnextH loop).
     value:parameter value"""
-    ierr= _lib.ENsetlinkvalue(ctypes.c_int(index), 
-                              ctypes.c_int(paramcode), 
-			      ctypes.c_float(value))
+    ierr= _lib.ENsetlinkvalue(int(index), int(paramcode), value)
     if ierr!=0: raise ENtoolkitError(ierr)
 
 
+def _broadcast_lists(*arrays):
+    """Broadcasts (array, dtype) pairs against each other and returns each one as a flat
+    list of python numbers"""
+    arrays= [np.asarray(a, dtype=dtype) for a, dtype in arrays]
+    shape= np.broadcast(*arrays).shape
+    out= []
+    for a in arrays:
+        if a.shape!=shape:
+            full= np.empty(shape, dtype=a.dtype)
+            full[...]= a
+            a= full
+        out.append(a.ravel().tolist())
+    return out
+
+def _setvalues(func, indices, paramcode, values):
+    indices, values= _broadcast_lists((indices, np.int64), (values, np.float64))
+    paramcode= int(paramcode)
+    for index, value in zip(indices, values):
+        ierr= func(index, paramcode, value)
+        if ierr!=0: raise ENtoolkitError(ierr)
+
+def _getvalues(func, indices, paramcode):
+    indices= np.asarray(indices, dtype=np.int64).ravel()
+    values= (ctypes.c_float* max(len(indices), 1))()
+    paramcode= int(paramcode)
+    byref= ctypes.byref
+    for i, index in enumerate(indices.tolist()):
+        ierr= func(index, paramcode, byref(values, 4*i))
+        if ierr!=0: raise ENtoolkitError(ierr)
+    return np.frombuffer(values, dtype=np.float32)[:len(indices)].astype(np.float64)
+
+def ENsetnodevalues(indices, paramcode, values):
+    """Sets the value of a parameter for many nodes, like ENsetnodevalue.
+    Arguments:
+    indices: array of node indices
+    paramcode: node parameter code (see ENsetnodevalue)
+    values: array of the parameter values, or one value for all of the nodes"""
+    _setvalues(_lib.ENsetnodevalue, indices, paramcode, values)
+
+def ENsetlinkvalues(indices, paramcode, values):
+    """Sets the value of a parameter for many links, like ENsetlinkvalue.
+    Arguments:
+    indices: array of link indices
+    paramcode: link parameter code (see ENsetlinkvalue)
+    values: array of the parameter values, or one value for all of the links"""
+    _setvalues(_lib.ENsetlinkvalue, indices, paramcode, values)
+
+def ENgetnodevalues(indices, paramcode):
+    """Retrieves the value of a parameter for many nodes as a numpy array, like ENgetnodevalue.
+    Arguments:
+    indices: array of node indices
+    paramcode: node parameter code (see ENgetnodevalue)"""
+    return _getvalues(_lib.ENgetnodevalue, indices, paramcode)
+
+def ENgetlinkvalues(indices, paramcode):
+    """Retrieves the value of a parameter for many links as a numpy array, like ENgetlinkvalue.
+    Arguments:
+    indices: array of link indices
+    paramcode: link parameter code (see ENgetlinkvalue)"""
+    return _getvalues(_lib.ENgetlinkvalue, indices, paramcode)
+
+
 def ENaddpattern(patternid):
     """Adds a new time pattern to the network.
     Arguments:
       id: ID label of pattern"""
-    ierr= _lib.ENaddpattern(ctypes.c_char_p(patternid.encode()))
+    _new_session()
+    ierr= _lib.ENaddpattern(patternid.encode())
     if ierr!=0: raise ENtoolkitError(ierr)
 
 
@@ -499,7 +707,7 @@ def ENsetpattern(index, factors):
     cfactors= cfactors_type()
     for i in range(nfactors):
        cfactors[i]= float(factors[i] )
-    ierr= _lib.ENsetpattern(ctypes.c_int(index), cfactors, ctypes.c_int(nfactors) )
+    ierr= _lib.ENsetpattern(index, cfactors, nfactors)
     if ierr!=0: raise ENtoolkitError(ierr)
 
 
@@ -510,9 +718,7 @@ def ENsetpatternvalue( index, period, value):
        period: period within time pattern
        value:  multiplier factor for the period"""
     #int ENsetpatternvalue( int index, int period, float value )
-    ierr= _lib.ENsetpatternvalue( ctypes.c_int(index), 
-                                  ctypes.c_int(period), 
-				  ctypes.c_float(value) )
+    ierr= _lib.ENsetpatternvalue(int(index), int(period), value)
     if ierr!=0: raise ENtoolkitError(ierr)
  
  
@@ -524,10 +730,10 @@ def ENsetqualtype(qualcode, chemname, chemunits, tracenode):
          chemname:	name of the chemical being analyzed
          chemunits:	units that the chemical is measured in
          tracenode:	ID of node traced in a source tracing analysis """
-    ierr= _lib.ENsetqualtype( ctypes.c_int(qualcode),
-                              ctypes.c_char_p(chemname.encode()),
-			      ctypes.c_char_p(chemunits.encode()),
-                              ctypes.c_char_p(tracenode.encode()))
+    ierr= _lib.ENsetqualtype( qualcode,
+                              chemname.encode(),
+			      chemunits.encode(),
+                              tracenode.encode())
     if ierr!=0: raise ENtoolkitError(ierr)
 
 
@@ -551,7 +757,7 @@ def  ENsettimeparam(paramcode, timevalue):
                       EN_MINIMUM  minimums
                       EN_MAXIMUM  maximums
                       EN_RANGE    ranges"""
-    ierr= _lib.ENsettimeparam(ctypes.c_int(paramcode), ctypes.c_int(timevalue))
+    ierr= _lib.ENsettimeparam(int(paramcode), int(timevalue))
     if ierr!=0: raise ENtoolkitError(ierr)
 
 
@@ -564,19 +770,19 @@ def ENsetoption( optioncode, value):
                               EN_EMITEXPON 
                               EN_DEMANDMULT
       value:  option value"""
-    ierr= _lib.ENsetoption(ctypes.c_int(optioncode), ctypes.c_float(value))
+    ierr= _lib.ENsetoption(optioncode, value)
     if ierr!=0: raise ENtoolkitError(ierr)
 
 
 #----- Saving and using hydraulic analysis results files -------
 def ENsavehydfile(fname):
     """Saves the current contents of the binary hydraulics file to a file."""
-    ierr= _lib.ENsavehydfile(ctypes.c_char_p(fname.encode()))
+    ierr= _lib.ENsavehydfile(fname.encode())
     if ierr!=0: raise ENtoolkitError(ierr)
 
 def  ENusehydfile(fname):
     """Uses the contents of the specified file as the current binary hydraulics file"""
-    ierr= _lib.ENusehydfile(ctypes.c_char_p(fname.encode()))
+    ierr= _lib.ENusehydfile(fname.encode())
     if ierr!=0: raise ENtoolkitError(ierr)
 
 
@@ -600,14 +806,14 @@ def ENinitH(flag=None):
     and the simulation clock time prior
 to running a hydraulic analysis.
     flag  EN_NOSAVE [+EN_SAVE] [+EN_INITFLOW] """
-    ierr= _lib.ENinitH(flag)
+    ierr= _lib.ENinitH(0 if flag is None else flag)
     if ierr!=0: raise ENtoolkitError(ierr)
 
 
 def ENrunH():
     """Runs a single period hydraulic analysis, 
     retrieving the current simulation clock time t"""
-    ierr= _lib.ENrunH(ctypes.byref(_current_simulation_time))
+    ierr= _lib.ENrunH(_current_simulation_ref)
     if ierr>=100: 
       raise ENtoolkitError(ierr)
     elif ierr>0:
@@ -621,10 +827,9 @@ def ENsimtime():
 def ENnextH():
     """Determines the length of time until the next hydraulic event occurs in an extended period
        simulation."""
-    _deltat= ctypes.c_long()
-    ierr= _lib.ENnextH(ctypes.byref(_deltat))
+    ierr= _lib.ENnextH(_long_ref)
     if ierr!=0: raise ENtoolkitError(ierr)
-    return _deltat.value
+    return _long_out.value
 
 
 def ENcloseH():
@@ -651,14 +856,14 @@ def ENinitQ(flag=None):
     """Initializes water quality and the simulation clock 
     time prior to running a water quality analysis.
     flag  EN_NOSAVE | EN_SAVE """
-    ierr= _lib.ENinitQ(flag)
+    ierr= _lib.ENinitQ(0 if flag is None else flag)
     if ierr!=0: raise ENtoolkitError(ierr)
 
 def ENrunQ():
     """Makes available the hydraulic and water quality results
     that occur at the start of the next time period of a water quality analysis, 
     where the start of the period is returned in t."""
-    ierr= _lib.ENrunQ(ctypes.byref(_current_simulation_time))
+    ierr= _lib.ENrunQ(_current_simulation_ref)
     if ierr>=100: 
       raise ENtoolkitError(ierr)
     elif ierr>0:
@@ -667,19 +872,17 @@ def ENrunQ():
 def ENnextQ():
     """Advances the water quality simulation 
     to the start of the next hydraulic time period."""
-    _deltat= ctypes.c_long()
-    ierr= _lib.ENnextQ(ctypes.byref(_deltat))
+    ierr= _lib.ENnextQ(_long_ref)
     if ierr!=0: raise ENtoolkitError(ierr)
-    return _deltat.value
+    return _long_out.value
     
     
 def ENstepQ():
     """Advances the water quality simulation one water quality time step. 
     The time remaining in the overall simulation is returned in tleft."""
-    tleft= ctypes.c_long()
-    ierr= _lib.ENnextQ(ctypes.byref(tleft))
+    ierr= _lib.ENstepQ(_long_ref)
     if ierr!=0: raise ENtoolkitError(ierr)
-    return tleft.value
+    return _long_out.value
 
 def ENcloseQ():
     """Closes the water quality analysis system, 
@@ -704,7 +907,7 @@ def ENsaveH():
 def ENsaveinpfile(fname):
     """Writes all current network input data to a file 
     using the format of an EPANET input file."""
-    ierr= _lib.ENsaveinpfile( ctypes.c_char_p(fname.encode()))
+    ierr= _lib.ENsaveinpfile( fname.encode())
     if ierr!=0: raise ENtoolkitError(ierr)
 
 
@@ -728,7 +931,7 @@ def ENsetreport(command):
     
     Formatting commands are the same as used in the 
     [REPORT] section of the EPANET Input file."""
-    ierr= _lib.ENsetreport(ctypes.c_char_p(command.encode()))
+    ierr= _lib.ENsetreport(command.encode())
     if ierr!=0: raise ENtoolkitError(ierr)
 
 def ENsetstatusreport(statuslevel):
@@ -738,7 +941,7 @@ def ENsetstatusreport(statuslevel):
                   0 - no status reporting
                   1 - normal reporting
                   2 - full status reporting"""
-    ierr= _lib.ENsetstatusreport(ctypes.c_int(statuslevel))
+    ierr= _lib.ENsetstatusreport(statuslevel)
     if ierr!=0: raise ENtoolkitError(ierr)
 
 def ENgeterror(errcode):
@@ -749,7 +952,7 @@ def ENgeterror(errcode):
 
 def ENwriteline(line ):
     """Writes a line of text to the EPANET report file."""
-    ierr= _lib.ENwriteline(ctypes.c_char_p(line.encode() ))
+    ierr= _lib.ENwriteline(line.encode())
     if ierr!=0: raise ENtoolkitError(ierr)
 
 
@@ -768,41 +971,41 @@ class ENtoolkitError(Exception):
 # functions not present in original Epanet2 toolkit from US EPA
 # it may change in future versions
 #----------------------------------------------------------------------------------
-if hasattr(_lib,"ENgetcurve"):
-   def ENgetcurve(curveIndex):
-       curveid = ctypes.create_string_buffer(_max_label_len)
-       nValues = ctypes.c_int()
-       xValues= ctypes.POINTER(ctypes.c_float)()
-       yValues= ctypes.POINTER(ctypes.c_float)()
-       ierr= _lib.ENgetcurve(curveIndex,
-                             ctypes.byref(curveid),
+#they raise AttributeError if the loaded library does not have ENgetcurve
+def ENgetcurve(curveIndex):
+    curveid = ctypes.create_string_buffer(_max_label_len)
+    nValues = ctypes.c_int()
+    xValues= ctypes.POINTER(ctypes.c_float)()
+    yValues= ctypes.POINTER(ctypes.c_float)()
+    ierr= _lib.ENgetcurve(curveIndex,
+                          ctypes.byref(curveid),
 	     	             ctypes.byref(nValues),
 	     	             ctypes.byref(xValues),
 	     	             ctypes.byref(yValues)
 		             )
-       # strange behavior of ENgetcurve: it returns also curveID
-       # better split in two distinct functions ....
-       if ierr!=0: raise ENtoolkitError(ierr)
-       curve= []
-       for i in range(nValues.value):
-          curve.append( (xValues[i],yValues[i]) )
-       return curve
-
-   def ENgetcurveid(curveIndex):
-       curveid = ctypes.create_string_buffer(_max_label_len)
-       nValues = ctypes.c_int()
-       xValues= ctypes.POINTER(ctypes.c_float)()
-       yValues= ctypes.POINTER(ctypes.c_float)()
-       ierr= _lib.ENgetcurve(curveIndex,
-                             ctypes.byref(curveid),
+    # strange behavior of ENgetcurve: it returns also curveID
+    # better split in two distinct functions ....
+    if ierr!=0: raise ENtoolkitError(ierr)
+    curve= []
+    for i in range(nValues.value):
+       curve.append( (xValues[i],yValues[i]) )
+    return curve
+
+def ENgetcurveid(curveIndex):
+    curveid = ctypes.create_string_buffer(_max_label_len)
+    nValues = ctypes.c_int()
+    xValues= ctypes.POINTER(ctypes.c_float)()
+    yValues= ctypes.POINTER(ctypes.c_float)()
+    ierr= _lib.ENgetcurve(curveIndex,
+                          ctypes.byref(curveid),
 	     	             ctypes.byref(nValues),
 	     	             ctypes.byref(xValues),
 	     	             ctypes.byref(yValues)
 		             )
-       # strange behavior of ENgetcurve: it returns also curveID
-       # better split in two distinct functions ....
-       if ierr!=0: raise ENtoolkitError(ierr)
-       return curveid.value
+    # strange behavior of ENgetcurve: it returns also curveID
+    # better split in two distinct functions ....
+    if ierr!=0: raise ENtoolkitError(ierr)
+    return curveid.value
 
 #-----end of functions added from OpenWaterAnalytics ----------------------------------
 
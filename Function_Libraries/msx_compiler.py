@@ -0,0 +1,512 @@
+# -*- coding: utf-8 -*-
+"""
+Compiler of the reaction expressions of MSX input files into numpy functions
+
+Parses the [TERMS], [PIPES] and [TANKS] expressions of an msx file, with the MSX
+functions and hydraulic variables, orders the terms by their dependencies and
+generates python functions which evaluate the rates, equilibrium residuals and
+formulas of arrays of states, and their analytic jacobians. Models are cached by the
+hash of the contents of the msx file, so a file is only parsed and compiled once
+per process
+"""
+
+import re
+import math
+import hashlib
+import numpy as np
+
+#Canonical names of the sections of an msx file, from their first 4 letters, since
+#msx files use both e.g. [PIPE] and [PIPES]
+_sections={'TITL':'TITLE','OPTI':'OPTIONS','SPEC':'SPECIES','COEF':'COEFFICIENTS',
+           'TERM':'TERMS','PIPE':'PIPES','TANK':'TANKS','SOUR':'SOURCES',
+           'QUAL':'QUALITY','PARA':'PARAMETERS','PATT':'PATTERNS','REPO':'REPORT'}
+
+#Hydraulic variables which the expressions can use:
+#D diameter, Q flow, U velocity, Re Reynolds number, Us shear velocity, Ff Darcy
+#friction factor, Av surface area per unit volume, Kc roughness coefficient, Len length
+HYDRAULIC_VARIABLES=['D','Q','U','RE','US','FF','AV','KC','LEN']
+
+#Numpy source of each MSX function
+_function_source={'ABS':'np.abs({})','SGN':'np.sign({})','STEP':'np.heaviside({},0.)',
+                  'SQRT':'np.sqrt({})','EXP':'np.exp({})','LOG':'np.log({})','LOG10':'np.log10({})',
+                  'SIN':'np.sin({})','COS':'np.cos({})','TAN':'np.tan({})','COT':'(1/np.tan({}))',
+                  'ASIN':'np.arcsin({})','ACOS':'np.arccos({})','ATAN':'np.arctan({})',
+                  'ACOT':'(1.5707963267948966-np.arctan({}))','SINH':'np.sinh({})',
+                  'COSH':'np.cosh({})','TANH':'np.tanh({})','COTH':'(1/np.tanh({}))'}
+
+def _ReadSections(lines):
+    sections={}
+    current=None
+    for line in lines:
+        line=line.split(';')[0].strip()
+        if not line:
+            continue
+        if line.startswith('['):
+            current=_sections.get(line.strip('[]').strip().upper()[:4])
+            if current is not None:
+                sections.setdefault(current,[])
+        elif current is not None:
+            sections[current].append(line.split())
+    return sections
+
+def ReadMSXFile(msx_file):
+    #Returns a dictionary of the sections of an msx file (e.g. 'SPECIES'), with the
+    #lines of each section split into tokens, without comments
+    with open(msx_file) as fin:
+        return _ReadSections(fin)
+
+#---------Expressions------------------------------------------------------------
+#An expression is a tree of tuples: ('num',value), ('var',NAME), ('neg',a),
+#('call',FUNCTION,a), or (operator,a,b) with an operator of + - * / ^
+#Names are upper case, since MSX names are not case sensitive
+
+_token=re.compile(r'\s*(?:(\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?)|([A-Za-z_]\w*)|(\S))')
+
+def ParseExpression(text):
+    #Returns the tree of an MSX expression
+    tokens=[]
+    for number,name,symbol in _token.findall(text):
+        if number:
+            tokens.append(('num',float(number)))
+        elif name:
+            tokens.append(('name',name.upper()))
+        else:
+            tokens.append(('op',symbol))
+    tokens.append(('end',None))
+    pos=[0]
+
+    def peek():
+        return tokens[pos[0]]
+    def take():
+        pos[0]+=1
+        return tokens[pos[0]-1]
+    def error():
+        raise Exception('Cannot read the expression ' + text)
+
+    def expression():
+        node=product()
+        while peek() in (('op','+'),('op','-')):
+            op=take()[1]
+            node=(op,node,product())
+        return node
+    def product():
+        node=unary()
+        while peek() in (('op','*'),('op','/')):
+            op=take()[1]
+            node=(op,node,unary())
+        return node
+    def unary():
+        if peek()==('op','-'):
+            take()
+            return ('neg',unary())
+        if peek()==('op','+'):
+            take()
+            return unary()
+        return power()
+    def power():
+        node=primary()
+        if peek()==('op','^'):
+            take()
+            node=('^',node,unary())
+        return node
+    def primary():
+        kind,value=take()
+        if kind=='num':
+            return ('num',value)
+        if kind=='name':
+            if peek()==('op','('):
+                if value not in _function_source:
+                    raise Exception('Unknown function ' + value + ' in the expression ' + text)
+                take()
+                node=('call',value,expression())
+                if take()!=('op',')'):
+                    error()
+                return node
+            return ('var',value)
+        if (kind,value)==('op','('):
+            node=expression()
+            if take()!=('op',')'):
+                error()
+            return node
+        error()
+
+    node=expression()
+    if peek()[0]!='end':
+        error()
+    return node
+
+def ExpressionNames(node,names=None):
+    #Returns the set of variable names in an expression
+    if names is None:
+        names=set()
+    kind=node[0]
+    if kind=='var':
+        names.add(node[1])
+    elif kind=='neg':
+        ExpressionNames(node[1],names)
+    elif kind=='call':
+        ExpressionNames(node[2],names)
+    elif kind!='num':
+        ExpressionNames(node[1],names)
+        ExpressionNames(node[2],names)
+    return names
+
+def ExpressionSource(node,variables):
+    #Returns the numpy source of an expression. variables maps each name to the
+    #python source of its value
+    kind=node[0]
+    if kind=='num':
+        return repr(node[1])
+    if kind=='var':
+        return variables[node[1]]
+    if kind=='neg':
+        return '(-'+ExpressionSource(node[1],variables)+')'
+    if kind=='call':
+        return _function_source[node[1]].format(ExpressionSource(node[2],variables))
+    op='**' if kind=='^' else kind
+    return '('+ExpressionSource(node[1],variables)+op+ExpressionSource(node[2],variables)+')'
+
+#Constructors of expressions which drop the terms that are 0 and the factors that
+#are 1, so that the derivatives stay short. None is the expression 0
+def _IsNum(a,value):
+    return a is not None and a[0]=='num' and a[1]==value
+
+def _Num(value):
+    return None if value==0 else ('num',float(value))
+
+def _Neg(a):
+    if a is None:
+        return None
+    if a[0]=='num':
+        return _Num(-a[1])
+    if a[0]=='neg':
+        return a[1]
+    return ('neg',a)
+
+def _Add(a,b):
+    if a is None or _IsNum(a,0):
+        return b
+    if b is None or _IsNum(b,0):
+        return a
+    if a[0]=='num' and b[0]=='num':
+        return _Num(a[1]+b[1])
+    return ('+',a,b)
+
+def _Sub(a,b):
+    return _Add(a,_Neg(b))
+
+def _Mul(a,b):
+    if a is None or b is None or _IsNum(a,0) or _IsNum(b,0):
+        return None
+    if _IsNum(a,1):
+        return b
+    if _IsNum(b,1):
+        return a
+    if a[0]=='num' and b[0]=='num':
+        return _Num(a[1]*b[1])
+    return ('*',a,b)
+
+def _Div(a,b):
+    if a is None or _IsNum(a,0):
+        return None
+    if _IsNum(b,1):
+        return a
+    return ('/',a,b)
+
+def _Pow(a,b):
+    if _IsNum(b,1):
+        return a
+    return ('^',a,b)
+
+def _FunctionDerivative(function,a):
+    #Derivative of an MSX function at a, None if it is 0 (or 0 almost everywhere)
+    one=('num',1.0)
+    if function=='ABS':
+        return ('call','SGN',a)
+    if function in ('SGN','STEP'):
+        return None
+    if function=='SQRT':
+        return _Div(('num',0.5),('call','SQRT',a))
+    if function=='EXP':
+        return ('call','EXP',a)
+    if function=='LOG':
+        return _Div(one,a)
+    if function=='LOG10':
+        return _Div(('num',1/math.log(10)),a)
+    if function=='SIN':
+        return ('call','COS',a)
+    if function=='COS':
+        return _Neg(('call','SIN',a))
+    if function=='TAN':
+        return _Div(one,_Pow(('call','COS',a),('num',2.0)))
+    if function=='COT':
+        return _Neg(_Div(one,_Pow(('call','SIN',a),('num',2.0))))
+    if function in ('ASIN','ACOS'):
+        d=_Div(one,('call','SQRT',_Sub(one,_Pow(a,('num',2.0)))))
+        return d if function=='ASIN' else _Neg(d)
+    if function in ('ATAN','ACOT'):
+        d=_Div(one,_Add(one,_Pow(a,('num',2.0))))
+        return d if function=='ATAN' else _Neg(d)
+    if function=='SINH':
+        return ('call','COSH',a)
+    if function=='COSH':
+        return ('call','SINH',a)
+    if function in ('TANH','COTH'):
+        return _Sub(one,_Pow(('call',function,a),('num',2.0)))
+    raise Exception('Unknown function ' + function)
+
+def Derivative(node,name):
+    #Returns the expression of the partial derivative of an expression with respect
+    #to the variable name, or None if it is 0
+    kind=node[0]
+    if kind=='num':
+        return None
+    if kind=='var':
+        return ('num',1.0) if node[1]==name else None
+    if kind=='neg':
+        return _Neg(Derivative(node[1],name))
+    if kind=='call':
+        da=Derivative(node[2],name)
+        if da is None:
+            return None
+        return _Mul(_FunctionDerivative(node[1],node[2]),da)
+    a,b=node[1],node[2]
+    da=Derivative(a,name)
+    db=Derivative(b,name)
+    if kind=='+':
+        return _Add(da,db)
+    if kind=='-':
+        return _Sub(da,db)
+    if kind=='*':
+        return _Add(_Mul(da,b),_Mul(a,db))
+    if kind=='/':
+        return _Sub(_Div(da,b),_Div(_Mul(a,db),_Mul(b,b)))
+    #Power: the exponent is usually a number
+    if db is None:
+        exponent=_Sub(b,('num',1.0))
+        return _Mul(_Mul(b,('num',1.0) if exponent is None else _Pow(a,exponent)),da)
+    return _Mul(node,_Add(_Mul(db,('call','LOG',a)),_Div(_Mul(b,da),a)))
+
+def OrderExpressions(depends):
+    #Returns the names of depends in an order in which every name comes after the
+    #names (of depends) it uses. depends maps each name to the set of names it uses
+    order=[]
+    state={}
+    def visit(name,path):
+        if state.get(name)=='done':
+            return
+        if state.get(name)=='visiting':
+            raise Exception('Circular reference between ' + ' -> '.join(path+[name]))
+        state[name]='visiting'
+        for dep in sorted(depends[name]):
+            if dep in depends:
+                visit(dep,path+[name])
+        state[name]='done'
+        order.append(name)
+    for name in depends:
+        visit(name,[])
+    return order
+
+#---------Models-----------------------------------------------------------------
+class MSXModel:
+    #The contents of an msx file: species, coefficients, terms, expressions and the
+    #initial quality, parameter and source lines. Use LoadMSXModel to share one
+    #model per file
+
+    def __init__(self,sections):
+        self.sections=sections
+        self.options={l[0].upper():l[1] for l in sections.get('OPTIONS',[]) if len(l)>1}
+
+        atol=float(self.options.get('ATOL',0.01))
+        rtol=float(self.options.get('RTOL',0.001))
+        species=sections.get('SPECIES',[])
+        self.species_names=[l[1] for l in species]
+        self.species_types=[l[0].upper() for l in species]
+        self.species_units=[l[2] if len(l)>2 else '' for l in species]
+        self.species_atol=np.array([float(l[3]) if len(l)>4 else atol for l in species])
+        self.species_rtol=np.array([float(l[4]) if len(l)>4 else rtol for l in species])
+
+        coefficients=sections.get('COEFFICIENTS',[])
+        constants=[l for l in coefficients if l[0].upper().startswith('CONS')]
+        parameters=[l for l in coefficients if l[0].upper().startswith('PARA')]
+        self.constant_names=[l[1] for l in constants]
+        self.constants=np.array([float(l[2]) if len(l)>2 else 0. for l in constants])
+        self.parameter_names=[l[1] for l in parameters]
+        self.parameters=np.array([float(l[2]) if len(l)>2 else 0. for l in parameters])
+
+        self.terms={l[0].upper():ParseExpression(' '.join(l[1:])) for l in sections.get('TERMS',[])}
+        self.expressions={}
+        for section in ('PIPES','TANKS'):
+            self.expressions[section]={l[1].upper():(l[0].upper(),ParseExpression(' '.join(l[2:])))
+                                       for l in sections.get(section,[])}
+
+        #The terms in the order they can be computed in
+        self.term_order=OrderExpressions({name:ExpressionNames(node) for name,node in self.terms.items()})
+        self._compiled={}
+
+    def compile(self,reactor='pipe'):
+        #Returns the CompiledReactions of the pipes ('pipe') or of the tanks ('tank').
+        #Tanks use the [TANKS] expression of a species when it has one, and the
+        #[PIPES] expression otherwise, and only have the bulk species
+        if reactor not in self._compiled:
+            self._compiled[reactor]=CompiledReactions(self,reactor)
+        return self._compiled[reactor]
+
+class CompiledReactions:
+    #The numpy functions of the reactions of an MSXModel in pipes or in tanks
+    #The state species are the RATE species followed by the EQUIL species, and the
+    #outputs are their rates followed by the residuals of the equilibrium equations
+    #evaluate(c,k,p,h,dy,res): c is an array with one row for each species of the
+    #model (in the order of the msx file, of any shape after the first axis). The
+    #rows of the state species are read, and the FORMULA species are written to c.
+    #The rates are written to dy and the residuals to res (one row for each)
+    #jacobian(c,k,p,h,jac): writes the partial derivatives of the outputs with respect
+    #to the states to jac, of shape (outputs, states, ...). Only the entries of
+    #jac_pattern are written, so jac should start with zeros
+    #k and p are the values of the constants and parameters (one row for each), and h
+    #a dictionary of the values of the hydraulic variables used (hydraulic_names)
+
+    def __init__(self,model,reactor):
+        if reactor=='pipe':
+            expressions=dict(model.expressions['PIPES'])
+            species=list(range(len(model.species_names)))
+        elif reactor=='tank':
+            expressions=dict(model.expressions['PIPES'])
+            expressions.update(model.expressions['TANKS'])
+            species=[i for i,kind in enumerate(model.species_types) if kind=='BULK']
+        else:
+            raise Exception('reactor must be pipe or tank')
+        self.reactor=reactor
+        self.species_names=model.species_names
+
+        kinds={'RATE':[],'EQUIL':[],'FORMULA':[]}
+        for i in species:
+            name=model.species_names[i].upper()
+            if name not in expressions:
+                raise Exception('The species ' + model.species_names[i] + ' has no expression for the ' + reactor + 's')
+            if expressions[name][0] not in kinds:
+                raise Exception('Unknown type of expression ' + expressions[name][0] + ' of the species ' + model.species_names[i])
+            kinds[expressions[name][0]].append(i)
+        self.rate_ind=np.array(kinds['RATE'],dtype=np.int64)
+        self.equil_ind=np.array(kinds['EQUIL'],dtype=np.int64)
+        self.formula_ind=np.array(kinds['FORMULA'],dtype=np.int64)
+        self.state_ind=np.concatenate((self.rate_ind,self.equil_ind))
+
+        #The python variable of each name, in the order MSX resolves names: species,
+        #terms, parameters, constants and then hydraulic variables
+        variables={}
+        for name in HYDRAULIC_VARIABLES:
+            variables[name]='h_'+name
+        for i,name in enumerate(model.constant_names):
+            variables[name.upper()]='k['+str(i)+']'
+        for i,name in enumerate(model.parameter_names):
+            variables[name.upper()]='p['+str(i)+']'
+        for i,name in enumerate(model.term_order):
+            variables[name]='t_'+str(i)
+        for i in species:
+            variables[model.species_names[i].upper()]='s_'+str(i)
+
+        states=[model.species_names[i].upper() for i in self.state_ind]
+        outputs=[expressions[name][1] for name in states]
+
+        #The intermediate values are the terms and formula species that are used
+        intermediates={name:model.terms[name] for name in model.term_order}
+        for i in self.formula_ind:
+            intermediates[model.species_names[i].upper()]=expressions[model.species_names[i].upper()][1]
+        depends={name:ExpressionNames(node)&set(intermediates) for name,node in intermediates.items()}
+        needed=set()
+        pending=[model.species_names[i].upper() for i in self.formula_ind]
+        for node in outputs:
+            pending.extend(ExpressionNames(node)&set(intermediates))
+        while pending:
+            name=pending.pop()
+            if name not in needed:
+                needed.add(name)
+                pending.extend(depends[name])
+        order=[name for name in OrderExpressions(depends) if name in needed]
+
+        used=set()
+        for name in order:
+            used|=ExpressionNames(intermediates[name])
+        for node in outputs:
+            used|=ExpressionNames(node)
+        for name in used:
+            if name not in variables:
+                raise Exception('Unknown name ' + name + ' in the ' + reactor + ' expressions')
+        self.hydraulic_names=[name for name in HYDRAULIC_VARIABLES if name in used and variables[name]=='h_'+name]
+
+        head=[]
+        for name in self.hydraulic_names:
+            head.append('    h_'+name+'=h[\''+name+'\']')
+        for i in self.state_ind:
+            head.append('    s_'+str(i)+'=c['+str(i)+']')
+        for name in order:
+            head.append('    '+variables[name]+'='+ExpressionSource(intermediates[name],variables))
+
+        lines=['def evaluate(c,k,p,h,dy,res):']+head
+        for i in self.formula_ind:
+            lines.append('    c['+str(i)+']=s_'+str(i))
+        for j in range(len(self.rate_ind)):
+            lines.append('    dy['+str(j)+']='+ExpressionSource(outputs[j],variables))
+        for j in range(len(self.equil_ind)):
+            lines.append('    res['+str(j)+']='+ExpressionSource(outputs[len(self.rate_ind)+j],variables))
+
+        #The derivatives of the intermediate values with respect to the states are
+        #computed in the same order as the values, with the chain rule
+        reach={}
+        for name in order:
+            reach[name]=set(s for s in states if s in ExpressionNames(intermediates[name]))
+            for dep in depends[name]:
+                reach[name]|=reach[dep]
+
+        def chain(node,state):
+            #Source of the derivative of node with respect to a state, or None if 0
+            parts=[]
+            for name in sorted(ExpressionNames(node)):
+                if name==state:
+                    partial=Derivative(node,name)
+                    if partial is not None:
+                        parts.append(ExpressionSource(partial,variables))
+                elif name in reach and state in reach[name]:
+                    partial=Derivative(node,name)
+                    if partial is not None:
+                        parts.append(ExpressionSource(partial,variables)+'*'+derivatives[(name,state)])
+            return '+'.join(parts) if parts else None
+
+        jac_lines=['def jacobian(c,k,p,h,jac):']+head
+        derivatives={}
+        for n,name in enumerate(order):
+            for j,state in enumerate(states):
+                if state in reach[name]:
+                    source=chain(intermediates[name],state)
+                    if source is not None:
+                        derivatives[(name,state)]='d_'+str(n)+'_'+str(j)
+                        jac_lines.append('    d_'+str(n)+'_'+str(j)+'='+source)
+        self.jac_pattern=np.zeros((len(states),len(states)),dtype=bool)
+        for i,node in enumerate(outputs):
+            for j,state in enumerate(states):
+                source=chain(node,state)
+                if source is not None:
+                    self.jac_pattern[i,j]=True
+                    jac_lines.append('    jac['+str(i)+','+str(j)+']='+source)
+        lines.append('')
+
+        self.source='\n'.join(lines+jac_lines+['    return jac'])
+        namespace={'np':np}
+        exec(self.source,namespace)
+        self.evaluate=namespace['evaluate']
+        self.jacobian=namespace['jacobian']
+
+#Parsed models by the hash of the contents of their msx file
+_models={}
+
+def LoadMSXModel(msx_file):
+    #Returns the MSXModel of an msx file. The model is parsed the first time the
+    #contents of the file are seen, and reused after that, with the functions it
+    #has already compiled
+    with open(msx_file,'rb') as fin:
+        contents=fin.read()
+    key=hashlib.sha1(contents).hexdigest()
+    if key not in _models:
+        _models[key]=MSXModel(_ReadSections(contents.decode(errors='replace').splitlines()))
+    return _models[key]
@@ -10,12 +10,15 @@ import ctypes
 import platform
 import datetime
 import os
+import numpy as np
+import epanet_toolkit as _epa
 
 #CHANGE THIS VARIABLE BASED ON YOUR COMPUTER
 main_folder=r'C:\Users\frank\Documents\Box Sync\working files\Leap-hi\Epanet-MSX\MSXpy\MSXPY'
 
 '''
 LIST OF FUNCTIONS:
+msx.load_library(library_path)
 msx.MSXopen(msx_file)
 msx.MSXaddpattern(pattern_name)
 msx.MSXsetpattern(pattern_index,[multipliers])
@@ -23,12 +26,16 @@ msx.MSXsetpatternvalue(pattern_index,time_index,value)
 msx.MSXsetconstant(constant_index,value)
 msx.MSXsetparameter(location_type,location_index,parameter_index,value)
 msx.MSXsetinitqual(location_type,location_index,species_index,value)
+msx.MSXsetconstants([constant_indices],[values])
+msx.MSXsetparameters(location_type,[location_indices],[parameter_indices],[values])
+msx.MSXsetinitquals(location_type,[location_indices],[species_indices],[values])
 msx.MSXsetsource(node_index,species_index,source_type,value,pattern_index)
 index = msx.MSXgetindex(object_type,object_label)
 label = msx.MSXgetID(object_type,object_index)
 length = msx.MSXgetIDlen(object_type,object_index)
 initqual = msx.MSXgetinitqual(location_type,location_index,species_index)
 qual = msx.MSXgetqual(location_type,location_ind,species_ind)
+reader = msx.MSXqualreader(location_type,[location_inds],[species_inds]); quals = reader.read()
 constant = msx.MSXgetconstant(constant_index)
 parameter = msx.MSXgetparameter(location_type,location_index,parameter_index)
 [type,value,pattern] = msx.MSXgetsource(node_index,species_index)
@@ -45,6 +52,7 @@ msx.MSXreport()
 msx.MSXsaveoutfile(binfile)
 msx.MSXsavemsxfile(new_msx_inpfile)
 msx.MSXclose()
+session = msx.MSXsession()
  // MSX constants
 # object type
 MSX_NODE      0
@@ -66,34 +74,151 @@ MSX_SETPOINT   2
 MSX_FLOWPACED  3
 '''
 
+#The MSX library is loaded the first time a toolkit function is called, from the
+#path given to load_library(), else the path in the MSXPY_MSX_LIB environment
+#variable, else the first file of _search_path which exists, else the system search
+#path of the platform. The EPANET library it runs with is loaded first by
+#epanet_toolkit, so both modules use the same one.
 _plat= platform.system()
-if _plat=='Linux':
-    _lib = ctypes.CDLL("/work/05881/mfrankel/stampede2/libepanet2.so",mode=ctypes.RTLD_GLOBAL)
-    _lib = ctypes.CDLL("/work/05881/mfrankel/stampede2/libepanetmsx.so",mode=ctypes.RTLD_GLOBAL)
+_env_var = 'MSXPY_MSX_LIB'
+if _plat=='Windows':
+    _lib_name = 'epanetmsx.dll'
+    _search_path = [os.path.join(main_folder,'EPANET_DLLs',_lib_name),
+                    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'EPANET_DLLs',_lib_name)]
 else:
-   # _lib = ctypes.windll.epanetmsx
-   # _lib = ctypes.windll(r'C:\Users\frank\Documents\Box Sync\working files\Leap-hi\Epanet-MSX\MSXpy\MSXPY\EPANET DLLs\epanetmsx.dll')
-   _lib = ctypes.CDLL(main_folder+'\EPANET_DLLs\epanetmsx.dll')
-
-
-# # os.chdir('C:\Users\User1\Dropbox (MIT)\\2018 Mekorot\Python EPANET wrapper\epanet-module')
-# # ctypes.windll.kernel1.SetDllDirectoryW(None)
-# _plat= platform.system()
-# if _plat=='Windows':
-#     os.environ['PATH'] = os.path.dirname(__file__) + ';' + os.environ['PATH']
-#     try:
-#         # if epanetmsx.dll compiled with __cdecl (as in OpenWaterAnalytics)
-#         _lib = ctypes.CDLL("epanetmsx.dll")
-#     except ValueError:
-#         # if epanetmsx.dll compiled with __stdcall (as in EPA original DLL)
-#         try:
-#             _lib = ctypes.windll.epanetmsx
-#         except ValueError:
-#             raise Exception("epanetmsx.dll not suitable")
-
-# else:
-#     Exception('Platform '+ _plat +' unsupported (not yet)')
-
+    _lib_name = 'libepanetmsx.so'
+    _search_path = ['/work/05881/mfrankel/stampede2/'+_lib_name,
+                    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'EPANET_DLLs',_lib_name)]
+
+def library_path():
+    """Returns the path of the MSX library which load_library() loads when it is not given one"""
+    if os.environ.get(_env_var):
+        return os.environ[_env_var]
+    for path in _search_path:
+        if os.path.isfile(path):
+            return path
+    return _lib_name
+
+#argument and return types of every toolkit function, set on the library's function
+#pointers when it is loaded, so that ctypes converts python ints and floats directly and
+#the wrappers do not build a ctypes object per argument. Out arguments are void pointers,
+#which accept the shared byref() buffers below and byref(array, offset) alike. No errcheck
+#is set: its python callback would cost more per call than the ierr checks it replaces
+_c_int = ctypes.c_int
+_c_double = ctypes.c_double
+_c_char_p = ctypes.c_char_p
+_c_void_p = ctypes.c_void_p
+_prototypes = {
+    'MSXopen': [_c_char_p],
+    'MSXclose': [],
+    'MSXusehydfile': [_c_char_p],
+    'MSXsolveH': [],
+    'MSXinit': [_c_int],
+    'MSXsolveQ': [],
+    'MSXstep': [_c_void_p, _c_void_p],
+    'MSXsaveoutfile': [_c_char_p],
+    'MSXsavemsxfile': [_c_char_p],
+    'MSXreport': [],
+    'MSXgetindex': [_c_int, _c_char_p, _c_void_p],
+    'MSXgetIDlen': [_c_int, _c_int, _c_void_p],
+    'MSXgetID': [_c_int, _c_int, _c_void_p, _c_int],
+    'MSXgetinitqual': [_c_int, _c_int, _c_int, _c_void_p],
+    'MSXgetqual': [_c_int, _c_int, _c_int, _c_void_p],
+    'MSXgetconstant': [_c_int, _c_void_p],
+    'MSXgetparameter': [_c_int, _c_int, _c_int, _c_void_p],
+    'MSXgetsource': [_c_int, _c_int, _c_void_p, _c_void_p, _c_void_p],
+    'MSXgetpatternlen': [_c_int, _c_void_p],
+    'MSXgetpatternvalue': [_c_int, _c_int, _c_void_p],
+    'MSXgetcount': [_c_int, _c_void_p],
+    'MSXgetspecies': [_c_int, _c_void_p, _c_void_p, _c_void_p, _c_void_p],
+    'MSXgeterror': [_c_int, _c_void_p, _c_int],
+    'MSXsetconstant': [_c_int, _c_double],
+    'MSXsetparameter': [_c_int, _c_int, _c_int, _c_double],
+    'MSXsetinitqual': [_c_int, _c_int, _c_int, _c_double],
+    'MSXsetsource': [_c_int, _c_int, _c_int, _c_double, _c_int],
+    'MSXsetpattern': [_c_int, ctypes.POINTER(_c_double), _c_int],
+    'MSXsetpatternvalue': [_c_int, _c_int, _c_double],
+    'MSXaddpattern': [_c_char_p],
+}
+
+def _prototype(lib):
+    """Sets the argument and return types of _prototypes on the functions of lib
+    (ctypes keeps the function pointers, so later lookups return the prototyped ones)"""
+    for name, argtypes in _prototypes.items():
+        func = getattr(lib, name, None)
+        if func is None:
+            continue
+        func.restype = _c_int
+        func.argtypes = argtypes
+
+def load_library(path=None):
+    """Loads the MSX library, which the toolkit functions then use, and returns it.
+    Only needed to use a library which library_path() does not find, or to load it before
+    the first call. The EPANET library is set with epanet_toolkit.load_library().
+    Arguments:
+    path: path of epanetmsx.dll / libepanetmsx.so (default library_path())"""
+    global _lib, _lib_path
+    if path is None:
+        path = library_path()
+    if isinstance(_epa._lib,_epa._UnloadedLibrary):
+        _epa.load_library()
+    if _plat=='Windows':
+        lib = ctypes.CDLL(path)
+    else:
+        try:
+            lib = ctypes.CDLL(path,mode=ctypes.RTLD_GLOBAL)
+        except OSError as e:
+            raise Exception('The MSX library could not be loaded ('+str(e)+'), set the '+_env_var+
+                            ' environment variable to its path or call msx_toolkit.load_library(path)')
+    _prototype(lib)
+    _lib = lib
+    _lib_path = path
+    return lib
+
+class _UnloadedLibrary:
+    """Stands in for _lib until the library is loaded, which happens on the first attribute
+    lookup; load_library() then replaces it, so later calls go directly to the library"""
+    def __getattr__(self, name):
+        return getattr(load_library(_lib_path),name)
+
+_lib_path = None
+_lib = _UnloadedLibrary()
+
+
+#changes every time the MSX Toolkit is opened or closed, or a pattern is added
+_session_id = 0
+
+def _new_session():
+    global _session_id
+    _session_id += 1
+
+#out arguments shared by the getters, with their references built once: creating a
+#ctypes object and a byref() on every call costs more than the call itself
+#(the toolkit is not thread safe in any case)
+_int_out = ctypes.c_int()
+_int_ref = ctypes.byref(_int_out)
+_double_out = ctypes.c_double()
+_double_ref = ctypes.byref(_double_out)
+_t_out = ctypes.c_long()
+_t_ref = ctypes.byref(_t_out)
+_tleft_out = ctypes.c_long()
+_tleft_ref = ctypes.byref(_tleft_out)
+_label_out = ctypes.create_string_buffer(32)
+_label_ref = ctypes.byref(_label_out)
+
+#location types accepted by the node and link functions
+_location_types = {'MSX_NODE': 0, 0: 0, 'MSX_LINK': 1, 1: 1}
+
+def _location_type(type):
+    type_ind = _location_types.get(type)
+    if type_ind is None: raise Exception('unrecognized type')
+    return type_ind
+
+def MSXsession():
+    """Returns a number which changes each time the MSX Toolkit is opened or closed, or a
+    pattern is added, so saved ID and index lookups (e.g. MSXPY_toolkit.ModelRegistry)
+    can check that they still describe the open model"""
+    return _session_id
 
 #----------running the simulation-----------------------------------------------------
 def MSXopen(nomeinp):
@@ -101,17 +226,19 @@ def MSXopen(nomeinp):
     Arguments:
     nomeinp: name of the msx input file
     """
-    ierr= _lib.MSXopen(ctypes.c_char_p(nomeinp.encode()))
+    _new_session()
+    ierr= _lib.MSXopen(nomeinp.encode())
     if ierr!=0: raise MSXtoolkitError(ierr)
 
 def MSXclose():
   """Closes down the Toolkit system (including all files being processed)"""
+  _new_session()
   ierr= _lib.MSXclose()
   if ierr!=0: raise MSXtoolkitError(ierr)
 
 def MSXusehydfile(fname):
     """Uses the contents of the specified file as the current binary hydraulics file"""
-    ierr = _lib.MSXusehydfile(ctypes.c_char_p(fname.encode()))
+    ierr = _lib.MSXusehydfile(fname.encode())
     if ierr != 0: raise MSXtoolkitError(ierr)
 
 def MSXsolveH():
@@ -134,21 +261,19 @@ def MSXsolveQ():
 def MSXstep():
     """Advances the water quality simulation one water quality time step.
     The time remaining in the overall simulation is returned as tleft, the current time as t."""
-    t = ctypes.c_long()
-    tleft = ctypes.c_long()
-    ierr = _lib.MSXstep(ctypes.byref(t),ctypes.byref(tleft))
+    ierr = _lib.MSXstep(_t_ref,_tleft_ref)
     if ierr != 0: raise MSXtoolkitError(ierr)
-    out = [t.value, tleft.value]
+    out = [_t_out.value, _tleft_out.value]
     return out
 
 def MSXsaveoutfile(fname):
     """saves water quality results computed for each node, link and reporting time period to a named binary file"""
-    ierr = _lib.MSXsaveoutfile(ctypes.c_char_p(fname.encode()))
+    ierr = _lib.MSXsaveoutfile(fname.encode())
     if ierr != 0: raise MSXtoolkitError(ierr)
 
 def MSXsavemsxfile(fname):
     """saves the data associated with the current MSX project into a new MSX input file"""
-    ierr = _lib.MSXsavemsxfile(ctypes.c_char_p(fname.encode()))
+    ierr = _lib.MSXsavemsxfile(fname.encode())
     if ierr != 0: raise MSXtoolkitError(ierr)
 
 def MSXreport():
@@ -175,10 +300,9 @@ def MSXgetindex(type,name):
     if type == 'MSX_PATTERN' or type == 7:
         type_ind = 7
     if type_ind == 100: raise Exception('unrecognized type')
-    ind = ctypes.c_int()
-    ierr= _lib.MSXgetindex(type_ind,ctypes.c_char_p(name.encode()),ctypes.byref(ind))
+    ierr= _lib.MSXgetindex(type_ind,name.encode(),_int_ref)
     if ierr!=0: raise MSXtoolkitError(ierr)
-    return ind.value
+    return _int_out.value
 
 def MSXgetIDlen(type,index):
     """Retrieves the number of characters in the ID name of an MSX object given its internal index number.
@@ -198,10 +322,9 @@ def MSXgetIDlen(type,index):
     if type == 'MSX_PATTERN' or type == 7:
         type_ind = 7
     if type_ind == 100: raise Exception('unrecognized type')
-    len = ctypes.c_int()
-    ierr= _lib.MSXgetIDlen(type_ind,ctypes.c_int(index),ctypes.byref(len))
+    ierr= _lib.MSXgetIDlen(type_ind,index,_int_ref)
     if ierr!=0: raise MSXtoolkitError(ierr)
-    return len.value
+    return _int_out.value
 
 def MSXgetID(type,index):
     """Retrieves the ID name of an object given its internal index number
@@ -222,12 +345,11 @@ def MSXgetID(type,index):
     if type == 'MSX_PATTERN' or type == 7:
         type_ind = 7
     if type_ind == 100: raise Exception('unrecognized type')
-    maxlen = 32
-    id = ctypes.create_string_buffer(maxlen)
-    ierr= _lib.MSXgetID(type_ind,ctypes.c_int(index),ctypes.byref(id),ctypes.c_int(maxlen-1))
+    maxlen = len(_label_out)
+    ierr= _lib.MSXgetID(type_ind,int(index),_label_ref,maxlen-1)
     if ierr!=0: raise MSXtoolkitError(ierr)
     #the .decode() added my MF 6/3/21
-    return id.value.decode()
+    return _label_out.value.decode()
 
 def MSXgetinitqual(type,ind,spe):
     """Retrieves the initial concentration of a particular chemical species assigned to a specific node
@@ -236,16 +358,9 @@ def MSXgetinitqual(type,ind,spe):
     type is type of object: MSX_NODE (0), MSX_LINK (1)
     ind is the internal sequence number (starting from 1) assigned to the node or link
     speicies is the sequence number of teh species (starting  from 1)"""
-    type_ind = 100
-    if type == 'MSX_NODE' or type == 0:
-        type_ind = 0
-    if type == 'MSX_LINK' or type == 1:
-        type_ind = 1
-    if type_ind == 100: raise Exception('unrecognized type')
-    iniqual = ctypes.c_double()
-    ierr= _lib.MSXgetinitqual(ctypes.c_int(type_ind),ctypes.c_int(ind),ctypes.c_int(spe),ctypes.byref(iniqual))
+    ierr= _lib.MSXgetinitqual(_location_type(type),int(ind),int(spe),_double_ref)
     if ierr!=0: raise MSXtoolkitError(ierr)
-    return iniqual.value
+    return _double_out.value
 
 def MSXgetqual(type,ind,spe):
     """Retrieves a chemical species concentration at a given node or the average concentration along a link at the current simulation time step
@@ -254,25 +369,48 @@ def MSXgetqual(type,ind,spe):
     ind is the internal sequence number (starting from 1) assigned to the node or link
     speicies is the sequence number of teh species (starting  from 1)
     concentrations expressed as: mass units per liter for bulk species and mass per unit area for surface species"""
-    type_ind = 100
-    if type == 'MSX_NODE' or type == 0:
-        type_ind = 0
-    if type == 'MSX_LINK' or type == 1:
-        type_ind = 1
-    if type_ind == 100: raise Exception('unrecognized type')
-    qual = ctypes.c_double()
-    ierr= _lib.MSXgetqual(ctypes.c_int(type_ind),ctypes.c_int(ind),ctypes.c_int(spe),ctypes.byref(qual))
+    ierr= _lib.MSXgetqual(_location_type(type),int(ind),int(spe),_double_ref)
     if ierr!=0: raise MSXtoolkitError(ierr)
-    return qual.value
+    return _double_out.value
+
+class MSXqualreader:
+    """Retrieves the concentrations of a fixed set of species at a fixed set of nodes or links
+    at the current simulation time step, filling one preallocated array per call.
+    The arguments of every (element, species) cell are built once, and MSXgetqual writes
+    each value directly into the array, so repeated reads during a step-wise simulation do not
+    create any new Python objects.
+    Arguments:
+    type is type of object: MSX_NODE (0), MSX_LINK (1)
+    inds is a list of the internal sequence numbers (starting from 1) assigned to the nodes or links
+    spes is a list of the sequence numbers of the species (starting from 1)
+    read() returns the array of shape (len(inds), len(spes)); the same array is refilled on every call"""
+    def __init__(self, type, inds, spes):
+        type_ind = _location_type(type)
+        inds = [int(i) for i in inds]
+        spes = [int(s) for s in spes]
+        self._buffer = (ctypes.c_double*max(len(inds)*len(spes),1))()
+        self.values = np.frombuffer(self._buffer,dtype=np.float64)[:len(inds)*len(spes)].reshape((len(inds),len(spes)))
+        size = ctypes.sizeof(ctypes.c_double)
+        self._calls = []
+        for j in range(len(inds)):
+            for i in range(len(spes)):
+                self._calls.append((type_ind,inds[j],spes[i],ctypes.byref(self._buffer,(j*len(spes)+i)*size)))
+        self._getqual = _lib.MSXgetqual
+
+    def read(self):
+        getqual = self._getqual
+        for args in self._calls:
+            ierr = getqual(*args)
+            if ierr!=0: raise MSXtoolkitError(ierr)
+        return self.values
 
 def MSXgetconstant(ind):
     """Retrieves the value of a particular reaction constant
     Arguments:
     ind is the sequence number of the reaction constant (starting from 1) as it appeared in the MSX input file"""
-    const = ctypes.c_double()
-    ierr= _lib.MSXgetconstant(ind,ctypes.byref(const))
+    ierr= _lib.MSXgetconstant(ind,_double_ref)
     if ierr!=0: raise MSXtoolkitError(ierr)
-    return const.value
+    return _double_out.value
 
 
 def MSXgetparameter(type,ind,param_ind):
@@ -281,16 +419,9 @@ def MSXgetparameter(type,ind,param_ind):
     type is the type of object: MSX_NODE (0) or MSX_LINK (1)
     ind is the internal sequence number(starting from 1) assigned to the node or link
     param is the sequence number of the parameter (starting from 1 as listed in the MSX input file)"""
-    type_ind = 100  # in case type input is in text
-    if type == 'MSX_NODE' or type == 0:
-        type_ind = 0
-    if type == 'MSX_LINK' or type == 1:
-        type_ind = 1
-    if type_ind == 100: raise Exception('unrecognized type')
-    param = ctypes.c_double()
-    ierr= _lib.MSXgetparameter(ctypes.c_int(type_ind),ctypes.c_int(ind),ctypes.c_int(param_ind),ctypes.byref(param))
+    ierr= _lib.MSXgetparameter(_location_type(type),int(ind),int(param_ind),_double_ref)
     if ierr!=0: raise MSXtoolkitError(ierr)
-    return param.value
+    return _double_out.value
 
 def MSXgetsource(node,spe):
     """Retrieves information on any external source of a particular chemical species assigned to a specific node of the pipe network
@@ -305,7 +436,7 @@ def MSXgetsource(node,spe):
     level = ctypes.c_double()
     type = ctypes.c_int()
     pat = ctypes.c_int()
-    ierr = _lib.MSXgetsource(ctypes.c_int(node),ctypes.c_int(spe),ctypes.byref(type),ctypes.byref(level),ctypes.byref(pat))
+    ierr = _lib.MSXgetsource(node,spe,ctypes.byref(type),ctypes.byref(level),ctypes.byref(pat))
     if ierr!=0: raise MSXtoolkitError(ierr)
     src_out = [type.value,level.value,pat.value]
     return src_out
@@ -314,10 +445,9 @@ def MSXgetpatternlen(pat):
     """Retrieves the number of time periods within a SOURCE time pattern
     Arguments:
     pat is the internal sequence number (starting from 1) of the pattern as appears in the MSX input file"""
-    len = ctypes.c_int()
-    ierr = _lib.MSXgetpatternlen(pat,ctypes.byref(len))
+    ierr = _lib.MSXgetpatternlen(pat,_int_ref)
     if ierr!=0: raise MSXtoolkitError(ierr)
-    return len.value
+    return _int_out.value
 
 def MSXgetpatternvalue(pat,period):
     """Retrieves the multiplier at a specific time period for a given SOURCE time pattern
@@ -325,10 +455,9 @@ def MSXgetpatternvalue(pat,period):
     pat is the internal sequence number (starting from 1) of the pattern as appears in the MSX input file
     period is the index of the time period (starting from 1) whose multiplier is being sought
     value is the vlaue of teh pattern's multiplier in teh desired period"""
-    val = ctypes.c_double()
-    ierr = _lib.MSXgetpatternvalue(pat,period,ctypes.byref(val))
+    ierr = _lib.MSXgetpatternvalue(pat,period,_double_ref)
     if ierr!=0: raise MSXtoolkitError(ierr)
-    return val.value
+    return _double_out.value
 
 def MSXgetcount(type):
     """Retrieves the number of objects of a specified type.
@@ -348,10 +477,9 @@ def MSXgetcount(type):
     if type == 'MSX_PATTERN' or type == 7:
         type_ind = 7
     if type_ind == 100: raise Exception('unrecognized type')
-    count = ctypes.c_int()
-    ierr= _lib.MSXgetcount(type_ind,ctypes.byref(count))
+    ierr= _lib.MSXgetcount(type_ind,_int_ref)
     if ierr!=0: raise MSXtoolkitError(ierr)
-    return count.value
+    return _int_out.value
 
 def MSXgetspecies(spe):
     """Retrieves the attributes of a chemical species given its internal index number.
@@ -386,7 +514,7 @@ def MSXsetconstant(ind,value):
     Arguments:
     ind is the sequence number of the reaction constant (starting from 1) as it appreaed in the MSX input file
     value is the new value to be assigned to the constant"""
-    ierr= _lib.MSXsetconstant(ctypes.c_int(ind),ctypes.c_double(value))
+    ierr= _lib.MSXsetconstant(int(ind),value)
     if ierr!=0: raise MSXtoolkitError(ierr)
 
 def MSXsetparameter(type,ind,param,value):
@@ -395,13 +523,7 @@ def MSXsetparameter(type,ind,param,value):
     type is the type of object: MSX_NODE (0) or MSX_LINK (1)
     ind is the internal sequence number(starting from 1) assigned to the node or link
     param is the sequence number of the parameter (starting from 1 as listed in the MSX input file"""
-    type_ind = 100
-    if type == 'MSX_NODE' or type == 0:
-        type_ind = 0
-    if type == 'MSX_LINK' or type == 1:
-        type_ind = 1
-    if type_ind == 100: raise Exception('unrecognized type')
-    ierr= _lib.MSXsetparameter(ctypes.c_int(type_ind),ctypes.c_int(ind),ctypes.c_int(param),ctypes.c_double(value))
+    ierr= _lib.MSXsetparameter(_location_type(type),int(ind),int(param),value)
     if ierr!=0: raise MSXtoolkitError(ierr)
 
 def MSXsetinitqual(type,ind,spe,value):
@@ -411,15 +533,66 @@ def MSXsetinitqual(type,ind,spe,value):
     type is type of object: MSX_NODE (0), MSX_LINK (1)
     ind is the internal sequence number (starting from 1) assigned to the node or link
     speicies is the sequence number of teh species (starting  from 1)"""
-    type_ind = 100
-    if type == 'MSX_NODE' or type == 0:
-        type_ind = 0
-    if type == 'MSX_LINK' or type == 1:
-        type_ind = 1
-    if type_ind == 100: raise Exception('unrecognized type')
-    ierr= _lib.MSXsetinitqual(ctypes.c_int(type_ind),ctypes.c_int(ind),ctypes.c_int(spe),ctypes.c_double(value))
+    ierr= _lib.MSXsetinitqual(_location_type(type),int(ind),int(spe),value)
     if ierr!=0: raise MSXtoolkitError(ierr)
 
+def _broadcast_lists(*arrays):
+    """Broadcasts (array, dtype) pairs against each other and returns each one as a flat
+    list of python numbers"""
+    arrays = [np.asarray(a, dtype=dtype) for a, dtype in arrays]
+    shape = np.broadcast(*arrays).shape
+    out = []
+    for a in arrays:
+        if a.shape!=shape:
+            full = np.empty(shape, dtype=a.dtype)
+            full[...] = a
+            a = full
+        out.append(a.ravel().tolist())
+    return out
+
+def MSXsetinitquals(type,inds,spes,values):
+    """Sets the initial concentrations of many (node or link, species) pairs, like MSXsetinitqual.
+    inds, spes and values are broadcast against each other, e.g. inds[:,None], spes[None,:] and
+    values[None,:] set each species to one value at every node or link in inds
+    Arguments:
+    type is type of object: MSX_NODE (0), MSX_LINK (1)
+    inds is an array of the internal sequence numbers (starting from 1) of the nodes or links
+    spes is an array of the sequence numbers of the species (starting from 1)
+    values is an array of the initial concentrations"""
+    type_ind = _location_type(type)
+    inds, spes, values = _broadcast_lists((inds,np.int64),(spes,np.int64),(values,np.float64))
+    setinitqual = _lib.MSXsetinitqual
+    for ind, spe, value in zip(inds,spes,values):
+        ierr = setinitqual(type_ind,ind,spe,value)
+        if ierr!=0: raise MSXtoolkitError(ierr)
+
+def MSXsetconstants(inds,values):
+    """Assigns new values to many reaction constants, like MSXsetconstant.
+    Arguments:
+    inds is an array of the sequence numbers of the reaction constants (starting from 1)
+    values is an array of the new values of the constants"""
+    inds, values = _broadcast_lists((inds,np.int64),(values,np.float64))
+    setconstant = _lib.MSXsetconstant
+    for ind, value in zip(inds,values):
+        ierr = setconstant(ind,value)
+        if ierr!=0: raise MSXtoolkitError(ierr)
+
+def MSXsetparameters(type,inds,params,values):
+    """Assigns values to a reaction parameter of many TANKS or PIPES, like MSXsetparameter.
+    inds, params and values are broadcast against each other, e.g. one parameter can be set
+    to a different value in each pipe with an array of inds and values
+    Arguments:
+    type is the type of object: MSX_NODE (0) or MSX_LINK (1)
+    inds is an array of the internal sequence numbers (starting from 1) of the nodes or links
+    params is an array of the sequence numbers of the parameters (starting from 1)
+    values is an array of the parameter values"""
+    type_ind = _location_type(type)
+    inds, params, values = _broadcast_lists((inds,np.int64),(params,np.int64),(values,np.float64))
+    setparameter = _lib.MSXsetparameter
+    for ind, param, value in zip(inds,params,values):
+        ierr = setparameter(type_ind,ind,param,value)
+        if ierr!=0: raise MSXtoolkitError(ierr)
+
 def MSXsetsource(node,spe,type_n,level,pat):
     """sets the attributes of an external source of a particular chemical species in a specific node of the pipe network
     Arguments:
@@ -442,7 +615,7 @@ def MSXsetsource(node,spe,type_n,level,pat):
     if type_n == 'MSX_FLOWPACED' or type_n == 3:
         type_ind = 3
     if type_ind == 100: raise Exception('unrecognized type')
-    ierr= _lib.MSXsetsource(ctypes.c_int(node),ctypes.c_int(spe),ctypes.c_int(type_ind),ctypes.c_double(level),ctypes.c_int(pat))
+    ierr= _lib.MSXsetsource(node,spe,type_ind,level,pat)
     if ierr!=0: raise MSXtoolkitError(ierr)
 
 def MSXsetpattern(pat,mult):
@@ -456,7 +629,7 @@ def MSXsetpattern(pat,mult):
     cfactors = cfactors_type()
     for i in range(length):
        cfactors[i]= float(mult[i])
-    ierr= _lib.MSXsetpattern(ctypes.c_int(pat),cfactors,ctypes.c_int(length))
+    ierr= _lib.MSXsetpattern(pat,cfactors,length)
     if ierr!=0: raise MSXtoolkitError(ierr)
 
 def MSXsetpatternvalue(pat,period,value):
@@ -465,14 +638,15 @@ def MSXsetpatternvalue(pat,period,value):
        index: time pattern index
        period: period within time pattern
        value:  multiplier factor for the period"""
-    ierr= _lib.MSXsetpatternvalue(ctypes.c_int(pat),ctypes.c_int(period),ctypes.c_double(value))
+    ierr= _lib.MSXsetpatternvalue(pat,period,value)
     if ierr!=0: raise MSXtoolkitError(ierr)
 
 def MSXaddpattern(patternid):
     """Adds a new, empty MSX source time pattern to an MSX project.
     Arguments:
       pattern id: c-string name of pattern"""
-    ierr=_lib.MSXaddpattern(ctypes.c_char_p(patternid.encode()))
+    _new_session()
+    ierr=_lib.MSXaddpattern(patternid.encode())
     if ierr!=0: raise MSXtoolkitError(ierr)
 
 #---------------error messages-------------------------------------------------------------------------
@@ -0,0 +1,804 @@
+# -*- coding: utf-8 -*-
+"""Deterministic stand-in for epanet_toolkit and msx_toolkit
+
+Simulates the network of an inp file in process with numpy instead of calling the
+EPANET and MSX libraries, so that the functions of MSXPY_toolkit can be run and
+profiled end to end on a machine without the libraries, with
+MSXPY_toolkit.SetBackend('standin'). This one module takes the place of both
+toolkits, and has the subset of their functions which MSXPY_toolkit uses, with the
+same arguments, index conventions (starting from 1) and error codes.
+
+The results are repeatable but are not those of EPANET-MSX:
+- hydraulics: water travels from the reservoirs (or the tanks of a network without
+  reservoirs) through every pipe at velocity (length units per second), scaled by
+  the total base demand relative to the inp file, with no flow if the demands are 0. The age of the water at a node is its
+  shortest travel time from a source, and in a link the mean age of its end nodes
+- quality: every bulk species decays with first order kinetics. Until the water
+  from the sources arrives, an element keeps its initial concentration decayed for
+  the simulation time; afterwards it has the concentration of its source decayed
+  for the age of the water. Wall species keep their initial concentrations
+- the rate of a bulk species is decay_rate times the geometric mean of the ratios of
+  the current to the original values of the constants and parameters that its
+  [PIPES] expression refers to (directly or through [TERMS]), so the results respond
+  to the setters in the way a sensitivity analysis needs
+- the level of a source of any type replaces the concentration of the water that
+  leaves its node. Source and demand patterns and the hydraulic options are stored,
+  but do not change the results
+"""
+import re
+import heapq
+import pickle
+import datetime
+import numpy as np
+
+#first order rate of the bulk species at the original values of the constants, per second
+decay_rate = 1.0/86400
+#speed of the water in the pipes at the base demands of the inp file, length units per second
+velocity = 1.0
+
+#network of the open inp file and model of the open msx file
+_net = None
+_model = None
+
+#changes every time a toolkit is opened or closed, as in the toolkit modules
+_en_session = 0
+_msx_session = 0
+
+_en_errors = {102: 'no network data available',
+              104: 'no hydraulics for water quality analysis',
+              203: 'function call contains undefined node',
+              204: 'function call contains undefined link',
+              205: 'function call contains undefined time pattern',
+              251: 'function call contains invalid parameter code',
+              302: 'cannot open input file',
+              305: 'cannot open hydraulics file',
+              306: 'hydraulics file does not match network data'}
+
+_msx_errors = {502: 'no EPANET data file supplied',
+               503: 'could not open MSX input file',
+               504: 'could not open hydraulic results file',
+               511: 'could not open binary results file',
+               515: 'reference made to an unknown type of object',
+               516: 'reference made to an illegal object index',
+               517: 'reference made to an undefined object ID',
+               519: 'an MSX project was not opened'}
+
+class StandinToolkitError(Exception):
+    def __init__(self, ierr):
+      self.warning = ierr < 100
+      self.args = (ierr,)
+      if ierr in _en_errors:
+          self.message = 'Error '+str(ierr)+': '+_en_errors[ierr]
+      else:
+          self.message = 'Error '+str(ierr)+' - '+_msx_errors.get(ierr,'undocumented error')+'.'
+    def __str__(self):
+      return self.message
+
+#MSXPY_toolkit catches the errors of each toolkit by these names
+ENtoolkitError = StandinToolkitError
+MSXtoolkitError = StandinToolkitError
+
+#---------reading inp and msx files----------------------------------------------------
+def _read_sections(filename):
+    #Returns a dictionary of the lines of each [SECTION] of an inp or msx file, in the
+    #order of the file, split into tokens without comments. Sections are named by their
+    #first 4 letters, since msx files use both e.g. [PIPE] and [PIPES]
+    sections = {}
+    current = None
+    with open(filename) as fin:
+        for line in fin:
+            line = line.split(';')[0].strip()
+            if not line:
+                continue
+            if line.startswith('['):
+                current = line.strip('[]').strip().upper()[:4]
+                sections.setdefault(current,[])
+            elif current is not None:
+                sections[current].append(line.split())
+    return sections
+
+_time_units = {'SEC':1, 'MIN':60, 'HOU':3600, 'HR':3600, 'HRS':3600, 'DAY':86400}
+
+def _seconds(tokens):
+    #Value of a time of an inp file in seconds: h:m[:s], or a number of hours or of
+    #the units that follow it
+    if ':' in tokens[0]:
+        parts = [float(p) for p in tokens[0].split(':')]+[0,0]
+        return int(round(parts[0]*3600+parts[1]*60+parts[2]))
+    unit = 3600
+    if len(tokens)>1:
+        unit = _time_units.get(tokens[1].upper()[:3],_time_units.get(tokens[1].upper(),3600))
+    return int(round(float(tokens[0])*unit))
+
+def _read_patterns(sections):
+    #Names and multipliers of the [PATTERNS] of an inp or msx file, where the
+    #multipliers of a pattern can continue over several lines
+    names = []
+    multipliers = []
+    for l in sections.get('PATT',[]):
+        if l[0] not in names:
+            names.append(l[0])
+            multipliers.append([])
+        multipliers[names.index(l[0])].extend(float(v) for v in l[1:])
+    return names, [np.array(m) for m in multipliers]
+
+#[TIMES] keywords of the time parameter codes of ENgettimeparam
+_time_keys = [('DURATION',0), ('HYDRAULIC TIMESTEP',1), ('QUALITY TIMESTEP',2), ('PATTERN TIMESTEP',3),
+              ('PATTERN START',4), ('REPORT TIMESTEP',5), ('REPORT START',6)]
+
+#[OPTIONS] keywords of the option codes of ENgetoption, and the flow units in the
+#order of their codes
+_option_keys = [('TRIALS',0), ('ACCURACY',1), ('TOLERANCE',2), ('EMITTER EXPONENT',3), ('DEMAND MULTIPLIER',4)]
+_flow_units = ['CFS', 'GPM', 'MGD', 'IMGD', 'AFD', 'LPS', 'LPM', 'MLD', 'CMH', 'CMD']
+
+class _Network:
+    #Nodes, links, patterns and times of an inp file. The junctions are the first
+    #nodes, followed by the reservoirs and tanks, as in EPANET
+    def __init__(self, inp_file):
+        sections = _read_sections(inp_file)
+
+        junctions = sections.get('JUNC',[])
+        self.node_names = [l[0] for l in junctions]
+        elevation = [float(l[1]) if len(l)>1 else 0. for l in junctions]
+        demand = [float(l[2]) if len(l)>2 else 0. for l in junctions]
+        self.n_junctions = len(junctions)
+        reservoirs = []
+        tanks = []
+        for name in sections:
+            if name in ('RESE','TANK'):
+                for l in sections[name]:
+                    (reservoirs if name=='RESE' else tanks).append(len(self.node_names))
+                    self.node_names.append(l[0])
+                    elevation.append(float(l[1]) if len(l)>1 else 0.)
+                    demand.append(0.)
+        #The water comes from the reservoirs, or from the tanks of a network without any
+        self.sources = reservoirs if reservoirs else tanks
+        self.node_map = {name:i for i,name in enumerate(self.node_names)}
+        self.elevation = np.array(elevation)
+        self.base_demand = np.array(demand)
+
+        #The [DEMANDS] section replaces the demands of the junctions it lists
+        listed = set()
+        for l in sections.get('DEMA',[]):
+            i = self._node(l[0])
+            if i not in listed:
+                self.base_demand[i] = 0.
+                listed.add(i)
+            self.base_demand[i] += float(l[1])
+        self.demand0 = self.base_demand.sum()
+
+        self.link_names = []
+        ends = []
+        length = []
+        diameter = []
+        for name in sections:
+            if name in ('PIPE','PUMP','VALV'):
+                for l in sections[name]:
+                    self.link_names.append(l[0])
+                    ends.append((self._node(l[1]),self._node(l[2])))
+                    length.append(float(l[3]) if name=='PIPE' else 0.)
+                    if name=='PIPE':
+                        diameter.append(float(l[4]))
+                    elif name=='VALV':
+                        diameter.append(float(l[3]))
+                    else:
+                        diameter.append(0.)
+        self.link_map = {name:i for i,name in enumerate(self.link_names)}
+        self.ends = np.array(ends,dtype=np.int64).reshape((-1,2))
+        self.length = np.array(length)
+        self.diameter = np.array(diameter)
+
+        self.pattern_names, self.patterns = _read_patterns(sections)
+
+        self.times = {0:0, 1:3600, 2:300, 3:3600, 4:0, 5:3600, 6:0}
+        for l in sections.get('TIME',[]):
+            text = ' '.join(l).upper()
+            for key, code in _time_keys:
+                if text.startswith(key):
+                    self.times[code] = _seconds(l[len(key.split()):])
+
+        self.options = {0:40., 1:0.001, 2:0.01, 3:0.5, 4:1.0}
+        self.flow_units = 1
+        for l in sections.get('OPTI',[]):
+            text = ' '.join(l).upper()
+            if text.startswith('UNITS') and len(l)>1 and l[1].upper() in _flow_units:
+                self.flow_units = _flow_units.index(l[1].upper())
+            for key, code in _option_keys:
+                if text.startswith(key) and len(l)>len(key.split()):
+                    self.options[code] = float(l[len(key.split())])
+
+        #Age of the water (s) and index of the source node of every node, once solved
+        self.hydraulics = None
+
+    def _node(self, name):
+        if name not in self.node_map: raise StandinToolkitError(203)
+        return self.node_map[name]
+
+    def solve(self):
+        #Shortest travel time from a source to every node
+        n_nodes = len(self.node_names)
+        if self.demand0>0:
+            speed = velocity*self.base_demand.sum()/self.demand0
+        else:
+            speed = velocity if self.base_demand.sum()>0 else 0.
+        age = np.full(n_nodes,np.inf)
+        source = np.full(n_nodes,-1,dtype=np.int64)
+        if speed>0:
+            neighbors = [[] for i in range(n_nodes)]
+            for (a, b), l in zip(self.ends.tolist(), self.length.tolist()):
+                neighbors[a].append((b,l/speed))
+                neighbors[b].append((a,l/speed))
+            heap = [(0.,i,i) for i in self.sources]
+            while heap:
+                t, i, src = heapq.heappop(heap)
+                if t>=age[i]:
+                    continue
+                age[i] = t
+                source[i] = src
+                for j, dt in neighbors[i]:
+                    if t+dt<age[j]:
+                        heapq.heappush(heap,(t+dt,j,src))
+        self.hydraulics = (age,source)
+
+class _Model:
+    #Species, coefficients and initial quality of an msx file for the open network
+    #The elements are the nodes followed by the links
+    def __init__(self, msx_file, net):
+        sections = _read_sections(msx_file)
+        n_nodes = len(net.node_names)
+        n_elements = n_nodes+len(net.link_names)
+
+        self.timestep = 300
+        for l in sections.get('OPTI',[]):
+            if l[0].upper()=='TIMESTEP':
+                self.timestep = int(float(l[1]))
+
+        species = sections.get('SPEC',[])
+        self.species_names = [l[1] for l in species]
+        self.species_units = [l[2] if len(l)>2 else '' for l in species]
+        self.wall = np.array([l[0].upper()=='WALL' for l in species],dtype=bool)
+
+        coefficients = sections.get('COEF',[])
+        self.constant_names = [l[1] for l in coefficients if l[0].upper().startswith('CONS')]
+        self.constants = np.array([float(l[2]) if len(l)>2 else 0. for l in coefficients if l[0].upper().startswith('CONS')])
+        self.constants0 = self.constants.copy()
+        self.parameter_names = [l[1] for l in coefficients if l[0].upper().startswith('PARA')]
+        self.parameters0 = np.array([float(l[2]) if len(l)>2 else 0. for l in coefficients if l[0].upper().startswith('PARA')])
+        self.parameters = np.tile(self.parameters0,(n_elements,1))
+
+        self.pattern_names, self.patterns = _read_patterns(sections)
+
+        for l in sections.get('PARA',[]):
+            p = self._index(self.parameter_names,l[2])
+            if l[0].upper().startswith('PIPE'):
+                self.parameters[n_nodes+self._element(net.link_map,l[1]),p] = float(l[3])
+            else:
+                self.parameters[self._element(net.node_map,l[1]),p] = float(l[3])
+
+        self.initqual = np.zeros((n_elements,len(self.species_names)))
+        for l in sections.get('QUAL',[]):
+            kind = l[0].upper()
+            if kind.startswith('GLOB'):
+                self.initqual[:,self._index(self.species_names,l[1])] = float(l[2])
+            elif kind.startswith('NODE'):
+                self.initqual[self._element(net.node_map,l[1]),self._index(self.species_names,l[2])] = float(l[3])
+            elif kind.startswith('LINK'):
+                self.initqual[n_nodes+self._element(net.link_map,l[1]),self._index(self.species_names,l[2])] = float(l[3])
+
+        #The level of a source replaces the initial quality of its node as the
+        #concentration of the water that leaves it. NaN, type -1 and pattern 0 where
+        #there is no source
+        self.source_level = np.full((n_nodes,len(self.species_names)),np.nan)
+        self.source_type = np.full((n_nodes,len(self.species_names)),-1,dtype=np.int64)
+        self.source_pattern = np.zeros((n_nodes,len(self.species_names)),dtype=np.int64)
+        for l in sections.get('SOUR',[]):
+            i, s = self._element(net.node_map,l[1]), self._index(self.species_names,l[2])
+            self.source_level[i,s] = float(l[3])
+            self.source_type[i,s] = _source_types.get(l[0].upper(),0)
+            if len(l)>4:
+                self.source_pattern[i,s] = self._index(self.pattern_names,l[4])+1
+
+        #The constants and parameters that the pipe expression of each species refers to
+        terms = {l[0]:' '.join(l[1:]) for l in sections.get('TERM',[])}
+        expressions = {l[1]:' '.join(l[2:]) for l in sections.get('PIPE',[]) if len(l)>2}
+        self.refs = []
+        for name in self.species_names:
+            names = set()
+            pending = re.findall(r'[A-Za-z_]\w*',expressions.get(name,''))
+            while pending:
+                token = pending.pop()
+                if token in names:
+                    continue
+                names.add(token)
+                if token in terms:
+                    pending.extend(re.findall(r'[A-Za-z_]\w*',terms[token]))
+            self.refs.append(([i for i,c in enumerate(self.constant_names) if c in names],
+                              [i for i,p in enumerate(self.parameter_names) if p in names]))
+
+        #State of a step-wise simulation
+        self.t = 0
+        self.quality = None
+        self.results = None
+
+    def _index(self, names, name):
+        if name not in names: raise StandinToolkitError(517)
+        return names.index(name)
+
+    def _element(self, lookup, name):
+        if name not in lookup: raise StandinToolkitError(517)
+        return lookup[name]
+
+    def rates(self):
+        #First order rate of every (element, species), per second
+        k = np.full(self.initqual.shape,decay_rate)
+        with np.errstate(divide='ignore'):
+            for s in range(len(self.species_names)):
+                constants, parameters = self.refs[s]
+                log_ratios = [np.full(k.shape[0],np.log(abs(self.constants[c]/self.constants0[c])))
+                              for c in constants if self.constants0[c]!=0]
+                log_ratios += [np.log(np.abs(self.parameters[:,p]/self.parameters0[p]))
+                               for p in parameters if self.parameters0[p]!=0]
+                if log_ratios:
+                    k[:,s] = decay_rate*np.exp(np.mean(log_ratios,axis=0))
+        k[:,self.wall] = 0.
+        return k
+
+    def start(self, net):
+        #Prepare the arrays of quality_at from the hydraulics and the current values
+        if net.hydraulics is None: raise StandinToolkitError(104)
+        node_age, node_source = net.hydraulics
+        a, b = net.ends[:,0], net.ends[:,1]
+        link_age = (node_age[a]+node_age[b])/2
+        link_source = np.where(node_age[a]<=node_age[b],node_source[a],node_source[b])
+        #Water which never arrives has an age that no simulation reaches
+        self._age = np.minimum(np.concatenate((node_age,link_age)),1e30)[:,None]
+        source = np.concatenate((node_source,link_source))
+
+        n_nodes = len(node_age)
+        source_quality = np.where(np.isnan(self.source_level),self.initqual[:n_nodes],self.source_level)
+        self._source_quality = np.where(source[:,None]>=0,source_quality[np.maximum(source,0)],0.)
+        self._k = self.rates()
+        self.t = 0
+        self.quality = self.quality_at(0)
+
+    def quality_at(self, t):
+        #(element, species) concentrations at time t (s)
+        k = self._k
+        quality = np.where(t<self._age,self.initqual*np.exp(-k*t),self._source_quality*np.exp(-k*self._age))
+        quality[:,self.wall] = self.initqual[:,self.wall]
+        return quality
+
+def _check_net():
+    if _net is None: raise StandinToolkitError(102)
+    return _net
+
+def _check_model():
+    if _model is None: raise StandinToolkitError(519)
+    return _model
+
+def _position(index, count, ierr):
+    #Position in the arrays of a toolkit index (starting from 1)
+    if not 1<=index<=count: raise StandinToolkitError(ierr)
+    return int(index)-1
+
+def _positions(indices, count, ierr):
+    indices = np.asarray(indices,dtype=np.int64)
+    if np.any(indices<1) or np.any(indices>count): raise StandinToolkitError(ierr)
+    return indices-1
+
+def _broadcast(*arrays):
+    #Broadcasts (array, dtype) pairs against each other, as flat arrays
+    arrays = [np.asarray(a,dtype=dtype) for a, dtype in arrays]
+    return [a.ravel() for a in np.broadcast_arrays(*arrays)]
+
+#---------EPANET toolkit------------------------------------------------------------
+def ENopen(nomeinp, nomerpt='', nomebin=''):
+    """Opens the network of an inp file
+    Arguments:
+    nomeinp: name of the input file
+    nomerpt, nomebin: not used"""
+    global _net, _model, _en_session
+    _en_session += 1
+    _model = None
+    try:
+        _net = _Network(nomeinp)
+    except OSError:
+        raise StandinToolkitError(302)
+
+def ENclose():
+    """Closes the network"""
+    global _net, _en_session
+    _en_session += 1
+    _net = None
+
+def ENsession():
+    """Returns a number which changes each time the network is opened or closed"""
+    return _en_session
+
+def ENgetcount(countcode):
+    """Retrieves the number of network components of a specified type.
+    Arguments:
+    countcode: 0 nodes, 1 tanks and reservoirs, 2 links, 3 patterns, 4 curves, 5 controls"""
+    net = _check_net()
+    counts = {0:len(net.node_names), 1:len(net.node_names)-net.n_junctions, 2:len(net.link_names),
+              3:len(net.pattern_names), 4:0, 5:0}
+    if countcode not in counts: raise StandinToolkitError(251)
+    return counts[countcode]
+
+def ENgetnodeid(index):
+    """Retrieves the ID label of a node with a specified index."""
+    net = _check_net()
+    return net.node_names[_position(index,len(net.node_names),203)]
+
+def ENgetnodeindex(nodeid):
+    """Retrieves the index of a node with a specified ID."""
+    return _check_net()._node(nodeid)+1
+
+def ENgetlinkid(index):
+    """Retrieves the ID label of a link with a specified index."""
+    net = _check_net()
+    return net.link_names[_position(index,len(net.link_names),204)]
+
+def ENgetlinkindex(linkid):
+    """Retrieves the index of a link with a specified ID."""
+    net = _check_net()
+    if linkid not in net.link_map: raise StandinToolkitError(204)
+    return net.link_map[linkid]+1
+
+def ENgetpatternid(index):
+    """Retrieves the ID label of a time pattern, as bytes like epanet_toolkit."""
+    net = _check_net()
+    return net.pattern_names[_position(index,len(net.pattern_names),205)].encode()
+
+def ENgetpatternlen(index):
+    """Retrieves the number of time periods in a time pattern."""
+    net = _check_net()
+    return len(net.patterns[_position(index,len(net.pattern_names),205)])
+
+def ENgetpatternvalue(index, period):
+    """Retrieves the multiplier of a time period (starting from 1) of a time pattern."""
+    net = _check_net()
+    pattern = net.patterns[_position(index,len(net.pattern_names),205)]
+    return float(pattern[_position(period,len(pattern),251)])
+
+def ENsetpattern(index, factors):
+    """Sets all of the multipliers of a time pattern."""
+    net = _check_net()
+    net.patterns[_position(index,len(net.pattern_names),205)] = np.array(factors,dtype=np.float64).ravel()
+
+def _node_values(net, paramcode):
+    #0 for elevation, 1 for base demand
+    if paramcode==0:
+        return net.elevation
+    if paramcode==1:
+        return net.base_demand
+    raise StandinToolkitError(251)
+
+def _link_values(net, paramcode):
+    #0 for diameter, 1 for length
+    if paramcode==0:
+        return net.diameter
+    if paramcode==1:
+        return net.length
+    raise StandinToolkitError(251)
+
+def ENgetnodevalue(index, paramcode):
+    """Retrieves the elevation (0) or base demand (1) of a node."""
+    net = _check_net()
+    return float(_node_values(net,paramcode)[_position(index,len(net.node_names),203)])
+
+def ENgetnodevalues(indices, paramcode):
+    """Retrieves the elevation (0) or base demand (1) of many nodes as a numpy array."""
+    net = _check_net()
+    return _node_values(net,paramcode)[_positions(indices,len(net.node_names),203)].astype(np.float64)
+
+def ENsetnodevalue(index, paramcode, value):
+    """Sets the elevation (0) or base demand (1) of a node."""
+    ENsetnodevalues([index],paramcode,[value])
+
+def ENsetnodevalues(indices, paramcode, values):
+    """Sets the elevation (0) or base demand (1) of many nodes."""
+    net = _check_net()
+    indices, values = _broadcast((indices,np.int64),(values,np.float64))
+    _node_values(net,paramcode)[_positions(indices,len(net.node_names),203)] = values
+
+def ENgetlinkvalue(index, paramcode):
+    """Retrieves the diameter (0) or length (1) of a link."""
+    net = _check_net()
+    return float(_link_values(net,paramcode)[_position(index,len(net.link_names),204)])
+
+def ENgetlinkvalues(indices, paramcode):
+    """Retrieves the diameter (0) or length (1) of many links as a numpy array."""
+    net = _check_net()
+    return _link_values(net,paramcode)[_positions(indices,len(net.link_names),204)].astype(np.float64)
+
+def ENsetlinkvalue(index, paramcode, value):
+    """Sets the diameter (0) or length (1) of a link."""
+    ENsetlinkvalues([index],paramcode,[value])
+
+def ENsetlinkvalues(indices, paramcode, values):
+    """Sets the diameter (0) or length (1) of many links."""
+    net = _check_net()
+    indices, values = _broadcast((indices,np.int64),(values,np.float64))
+    _link_values(net,paramcode)[_positions(indices,len(net.link_names),204)] = values
+
+def ENgettimeparam(paramcode):
+    """Retrieves a time parameter in seconds: 0 duration, 1 hydraulic step, 2 quality step,
+    3 pattern step, 4 pattern start, 5 report step, 6 report start"""
+    net = _check_net()
+    if paramcode not in net.times: raise StandinToolkitError(251)
+    return net.times[paramcode]
+
+def ENsettimeparam(paramcode, timevalue):
+    """Sets a time parameter in seconds (see ENgettimeparam)"""
+    net = _check_net()
+    if paramcode not in net.times: raise StandinToolkitError(251)
+    net.times[paramcode] = int(timevalue)
+
+def ENgetoption(optioncode):
+    """Retrieves a hydraulic option: 0 trials, 1 accuracy, 2 tolerance, 3 emitter exponent,
+    4 demand multiplier"""
+    net = _check_net()
+    if optioncode not in net.options: raise StandinToolkitError(251)
+    return net.options[optioncode]
+
+def ENsetoption(optioncode, value):
+    """Sets a hydraulic option (see ENgetoption)"""
+    net = _check_net()
+    if optioncode not in net.options: raise StandinToolkitError(251)
+    net.options[optioncode] = float(value)
+
+def ENgetflowunits():
+    """Retrieves the code of the flow units: 0 CFS, 1 GPM, 2 MGD, 3 IMGD, 4 AFD, 5 LPS,
+    6 LPM, 7 MLD, 8 CMH, 9 CMD"""
+    return _check_net().flow_units
+
+def ENsimtime():
+    """Retrieves the current quality simulation time as datetime.timedelta instance"""
+    return datetime.timedelta(seconds=_model.t if _model is not None else 0)
+
+def ENsolveH():
+    """Solves the hydraulics (the age and source of the water at every node)"""
+    _check_net().solve()
+
+def ENsavehydfile(fname):
+    """Saves the solved hydraulics to a file which MSXusehydfile reads."""
+    net = _check_net()
+    if net.hydraulics is None: raise StandinToolkitError(104)
+    with open(fname,'wb') as fout:
+        pickle.dump({'n_nodes':len(net.node_names),'hydraulics':net.hydraulics},fout)
+
+#---------MSX toolkit----------------------------------------------------------------
+_object_types = {'MSX_SPECIES':3, 3:3, 'MSX_PARAMETER':5, 5:5, 'MSX_CONSTANT':6, 6:6, 'MSX_PATTERN':7, 7:7}
+_location_types = {'MSX_NODE':0, 0:0, 'MSX_LINK':1, 1:1}
+_source_types = {'MSX_NOSOURCE':-1, -1:-1, 'MSX_CONCEN':0, 0:0, 'CONCEN':0, 'MSX_MASS':1, 1:1, 'MASS':1,
+                 'MSX_SETPOINT':2, 2:2, 'SETPOINT':2, 'MSX_FLOWPACED':3, 3:3, 'FLOWPACED':3}
+
+def _object_names(model, type):
+    type_ind = _object_types.get(type)
+    if type_ind is None: raise StandinToolkitError(515)
+    return {3:model.species_names, 5:model.parameter_names, 6:model.constant_names, 7:model.pattern_names}[type_ind]
+
+def _rows(type, inds):
+    #Rows of the (element, species) arrays of nodes or links
+    net = _check_net()
+    type_ind = _location_types.get(type)
+    if type_ind is None: raise StandinToolkitError(515)
+    if type_ind==0:
+        return _positions(inds,len(net.node_names),516)
+    return len(net.node_names)+_positions(inds,len(net.link_names),516)
+
+def MSXopen(nomeinp):
+    """Opens the model of an msx file for the open network"""
+    global _model, _msx_session
+    net = _check_net() if _net is not None else None
+    if net is None: raise StandinToolkitError(502)
+    _msx_session += 1
+    try:
+        _model = _Model(nomeinp,net)
+    except OSError:
+        raise StandinToolkitError(503)
+
+def MSXclose():
+    """Closes the model"""
+    global _model, _msx_session
+    _msx_session += 1
+    _model = None
+
+def MSXsession():
+    """Returns a number which changes each time the model is opened or closed"""
+    return _msx_session
+
+def MSXsolveH():
+    """Solves the hydraulics (the age and source of the water at every node)"""
+    _check_model()
+    _net.solve()
+
+def MSXusehydfile(fname):
+    """Uses the hydraulics saved by ENsavehydfile"""
+    _check_model()
+    try:
+        with open(fname,'rb') as fin:
+            saved = pickle.load(fin)
+    except OSError:
+        raise StandinToolkitError(504)
+    if saved['n_nodes']!=len(_net.node_names): raise StandinToolkitError(504)
+    _net.hydraulics = saved['hydraulics']
+
+def MSXinit(saveFlag=0):
+    """Initializes the simulation at time 0 with the current initial quality and coefficients"""
+    _check_model().start(_net)
+
+def MSXstep():
+    """Advances the simulation one quality time step (the TIMESTEP of the msx file).
+    Returns [t, tleft], the current time and the time left in the simulation"""
+    model = _check_model()
+    if model.quality is None: raise StandinToolkitError(519)
+    duration = _net.times[0]
+    model.t = min(model.t+model.timestep,max(duration,model.timestep))
+    model.quality = model.quality_at(model.t)
+    return [model.t, max(duration-model.t,0)]
+
+def MSXsolveQ():
+    """Computes the quality at every reporting time (report start + n report steps up to
+    the duration) for MSXsaveoutfile"""
+    model = _check_model()
+    model.start(_net)
+    times = np.arange(_net.times[6],_net.times[0]+1,max(_net.times[5],1))
+    model.results = np.array([model.quality_at(t) for t in times]).reshape((len(times),)+model.initqual.shape)
+
+def MSXsaveoutfile(fname):
+    """Saves the results of MSXsolveQ to a binary file in the format of the MSX toolkit
+    (version 1), which MSXPY_toolkit.MSXBinaryOutput reads"""
+    model = _check_model()
+    if model.results is None: raise StandinToolkitError(511)
+    magic = 516114521
+    n_nodes = len(_net.node_names)
+    n_periods = model.results.shape[0]
+    with open(fname,'wb') as fout:
+        fout.write(np.array([magic,100000,n_nodes,len(_net.link_names),len(model.species_names),
+                             _net.times[5]],dtype=np.int32).tobytes())
+        for name in model.species_names:
+            fout.write(np.array([len(name)],dtype=np.int32).tobytes()+name.encode())
+        for units in model.species_units:
+            fout.write(units.encode()[:15].ljust(16,b'\0'))
+        offset = fout.tell()
+        #Each reporting period has the values of every node for each species followed
+        #by the values of every link for each species
+        rows = np.concatenate((model.results[:,:n_nodes,:].transpose((0,2,1)).reshape((n_periods,-1)),
+                               model.results[:,n_nodes:,:].transpose((0,2,1)).reshape((n_periods,-1))),axis=1)
+        fout.write(rows.astype(np.float32).tobytes())
+        fout.write(np.array([offset,n_periods,0,magic],dtype=np.int32).tobytes())
+
+def MSXgetcount(type):
+    """Retrieves the number of species (3), parameters (5), constants (6) or patterns (7)"""
+    return len(_object_names(_check_model(),type))
+
+def MSXgetID(type, index):
+    """Retrieves the ID of a species (3), parameter (5), constant (6) or pattern (7)"""
+    names = _object_names(_check_model(),type)
+    return names[_position(index,len(names),516)]
+
+def MSXgetIDlen(type, index):
+    """Retrieves the number of characters of the ID of an object"""
+    return len(MSXgetID(type,index))
+
+def MSXgetindex(type, name):
+    """Retrieves the index of a species (3), parameter (5), constant (6) or pattern (7)"""
+    names = _object_names(_check_model(),type)
+    if name not in names: raise StandinToolkitError(517)
+    return names.index(name)+1
+
+def MSXgetspecies(spe):
+    """Retrieves [type, units, aTol, rTol] of a species (type 0 bulk, 1 wall)"""
+    model = _check_model()
+    s = _position(spe,len(model.species_names),516)
+    return [int(model.wall[s]), model.species_units[s].encode(), 0.0, 0.0]
+
+def MSXgetinitqual(type, ind, spe):
+    """Retrieves the initial concentration of a species at a node (0) or link (1)"""
+    model = _check_model()
+    return float(model.initqual[_rows(type,[ind])[0],_position(spe,len(model.species_names),516)])
+
+def MSXsetinitqual(type, ind, spe, value):
+    """Sets the initial concentration of a species at a node (0) or link (1)"""
+    MSXsetinitquals(type,[ind],[spe],[value])
+
+def MSXsetinitquals(type, inds, spes, values):
+    """Sets the initial concentrations of many (node or link, species) pairs, broadcasting
+    inds, spes and values against each other like msx_toolkit.MSXsetinitquals"""
+    model = _check_model()
+    inds, spes, values = _broadcast((inds,np.int64),(spes,np.int64),(values,np.float64))
+    model.initqual[_rows(type,inds),_positions(spes,len(model.species_names),516)] = values
+
+def MSXgetqual(type, ind, spe):
+    """Retrieves the concentration of a species at a node (0) or link (1) at the current time"""
+    model = _check_model()
+    if model.quality is None: raise StandinToolkitError(519)
+    return float(model.quality[_rows(type,[ind])[0],_position(spe,len(model.species_names),516)])
+
+class MSXqualreader:
+    """Retrieves the concentrations of a fixed set of species at a fixed set of nodes or links
+    at the current time, like msx_toolkit.MSXqualreader.
+    read() returns the array of shape (len(inds), len(spes)); the same array is refilled on every call"""
+    def __init__(self, type, inds, spes):
+        model = _check_model()
+        self._rows = _rows(type,inds)[:,None]
+        self._cols = _positions(spes,len(model.species_names),516)[None,:]
+        self.values = np.zeros((self._rows.shape[0],self._cols.shape[1]))
+
+    def read(self):
+        model = _check_model()
+        if model.quality is None: raise StandinToolkitError(519)
+        self.values[...] = model.quality[self._rows,self._cols]
+        return self.values
+
+def MSXgetconstant(ind):
+    """Retrieves the value of a reaction constant"""
+    model = _check_model()
+    return float(model.constants[_position(ind,len(model.constants),516)])
+
+def MSXsetconstant(ind, value):
+    """Assigns a new value to a reaction constant"""
+    MSXsetconstants([ind],[value])
+
+def MSXsetconstants(inds, values):
+    """Assigns new values to many reaction constants"""
+    model = _check_model()
+    inds, values = _broadcast((inds,np.int64),(values,np.float64))
+    model.constants[_positions(inds,len(model.constants),516)] = values
+
+def MSXgetparameter(type, ind, param_ind):
+    """Retrieves the value of a reaction parameter at a node (0) or link (1)"""
+    model = _check_model()
+    return float(model.parameters[_rows(type,[ind])[0],_position(param_ind,len(model.parameter_names),516)])
+
+def MSXsetparameter(type, ind, param, value):
+    """Assigns a value to a reaction parameter at a node (0) or link (1)"""
+    MSXsetparameters(type,[ind],[param],[value])
+
+def MSXsetparameters(type, inds, params, values):
+    """Assigns values to reaction parameters of many nodes or links, broadcasting inds,
+    params and values against each other like msx_toolkit.MSXsetparameters"""
+    model = _check_model()
+    inds, params, values = _broadcast((inds,np.int64),(params,np.int64),(values,np.float64))
+    model.parameters[_rows(type,inds),_positions(params,len(model.parameter_names),516)] = values
+
+def MSXgetsource(node, spe):
+    """Retrieves [type, level, pattern] of the source of a species at a node, where type is
+    -1 (no source), 0 (concentration), 1 (mass), 2 (setpoint) or 3 (flow paced)"""
+    model = _check_model()
+    i = _position(node,len(_net.node_names),516)
+    s = _position(spe,len(model.species_names),516)
+    if model.source_type[i,s]==-1:
+        return [-1, 0.0, 0]
+    return [int(model.source_type[i,s]), float(model.source_level[i,s]), int(model.source_pattern[i,s])]
+
+def MSXsetsource(node, spe, type_n, level, pat):
+    """Sets the type, level and pattern of the source of a species at a node"""
+    model = _check_model()
+    if type_n not in _source_types: raise Exception('unrecognized type')
+    i = _position(node,len(_net.node_names),516)
+    s = _position(spe,len(model.species_names),516)
+    if pat!=0:
+        _position(pat,len(model.pattern_names),516)
+    type_ind = _source_types[type_n]
+    model.source_type[i,s] = type_ind
+    model.source_level[i,s] = np.nan if type_ind==-1 else float(level)
+    model.source_pattern[i,s] = 0 if type_ind==-1 else int(pat)
+
+def MSXgetpatternlen(pat):
+    """Retrieves the number of time periods of a source pattern"""
+    model = _check_model()
+    return len(model.patterns[_position(pat,len(model.pattern_names),516)])
+
+def MSXgetpatternvalue(pat, period):
+    """Retrieves the multiplier of a time period (starting from 1) of a source pattern"""
+    model = _check_model()
+    pattern = model.patterns[_position(pat,len(model.pattern_names),516)]
+    return float(pattern[_position(period,len(pattern),516)])
+
+def MSXsetpattern(pat, mult):
+    """Assigns a new set of multipliers to a source pattern"""
+    model = _check_model()
+    model.patterns[_position(pat,len(model.pattern_names),516)] = np.array(mult,dtype=np.float64).ravel()